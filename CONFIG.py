@@ -3,4 +3,43 @@ class Config:
     DATABASE = "bigdata"
     USER = "ddertopod"
     PASSWORD = ".."
-    HOST = "127.0.0.1"
\ No newline at end of file
+    HOST = "127.0.0.1"
+    SMOOTHING = "windowed"
+    PARTITIONED = False
+    POOL_SIZE = 8
+    STREAM_ITERSIZE = 50000
+    CALIBRATION_CACHE_MB = 64
+    CALIBRATION_CHECK_INTERVAL = 60
+    PLOT_CACHE_DIR = "cache/plots"
+    PLOT_CACHE_MB = 256
+    PLOT_CACHE_TTL = 86400
+    WORKERS = 4
+    QUEUE_SIZE = 32
+    QUEUE_PER_CHAT = 3
+    QUEUE_TIMEOUT = 300
+    PLOT_POINTS = 2000
+    DOWNSAMPLING = "minmax"
+    ROLLUP_MINUTE_AFTER_DAYS = 3
+    ROLLUP_HOUR_AFTER_DAYS = 60
+    LOAD_WORKERS = 4
+    LOAD_CHUNK_MB = 64
+    LOAD_BATCH_ROWS = 50000
+    LOAD_REJECT_DIR = "data/rejects"
+    LOAD_INDEX_MEMORY = "512MB"
+    SCAN_WORKERS = 4
+    SCAN_WINDOW = 99
+    TERMINAL_PAGE = 20
+    COLUMNAR_DIR = "cache/columnar"
+    BINARY_COPY = True
+    # Корзины шире RAPID_CHANGE_DURATION: события на таких графиках - из таблицы events (scan.py).
+    PUSHDOWN = False
+    PUSHDOWN_BUCKETS = 2000
+    METRICS_LOG = "logs/requests.log"
+    METRICS_FILE = "logs/metrics.prom"
+    METRICS_PORT = 0
+    SLOW_REQUEST_SECONDS = 5
+    SLOW_TRACE_SAMPLE = 1.0
+    SLOW_TRACE_DIR = "logs/slow"
+    PROFILE_SAMPLE = 0.01
+    BENCH_DATABASE = "bigdata_bench"
+    BENCH_DIR = "logs/bench"
\ No newline at end of file
@@ -0,0 +1,356 @@
+import argparse
+import json
+import os
+import platform
+import queue
+import runpy
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+import numpy as np
+import psycopg2
+from CONFIG import Config
+import synthetic
+
+# Воспроизводимые замеры по этапам на синтетических данных (synthetic.py) в
+# отдельной базе BENCH_DATABASE: она пересоздаётся на каждый запуск теми же
+# скриптами preparation*.py, что и рабочая. Этапы: COPY-загрузка, запрос окна
+# (двоичный и текстовый COPY), тарировка, сглаживание, поиск событий,
+# прореживание, отрисовка, весь fuel_series и обработчик бота с подменённым
+# клиентом Telegram. Результат - JSON с коммитом, настройками и временем
+# этапов; --compare сравнивает его с прошлым запуском.
+BASE_DIR = Path(__file__).resolve().parent
+BOT_TIMEOUT = 300
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=BASE_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(dirty)
+
+
+def measure(function, repeat, rows=None, setup=None):
+    # Лучшее и медианное время из repeat запусков; результат - последнего запуска.
+    runs = []
+    result = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        result = function()
+        runs.append(time.perf_counter() - started)
+    best = min(runs)
+    entry = {'seconds': round(best, 6), 'median': round(statistics.median(runs), 6),
+             'runs': [round(run, 6) for run in runs], 'rows': rows}
+    if rows:
+        entry['rows_per_second'] = round(rows / max(best, 1e-9))
+    return result, entry
+
+
+def recreate_database(database):
+    conn = psycopg2.connect(database = Config.FIRSTBASE,
+                                  user = Config.USER,
+                                  password = Config.PASSWORD,
+                                  host = Config.HOST)
+    conn.autocommit = True
+    cursor = conn.cursor()
+    cursor.execute(f'drop database if exists "{database}"')
+    cursor.execute(f'create database "{database}"')
+    cursor.close()
+    conn.close()
+
+
+def load_dataset(summary):
+    # Порядок make prepare: таблица messages, загрузка, calibrating, миграция.
+    from bulk_load import load
+    runpy.run_path(str(BASE_DIR / 'preparation2.py'))
+    _, copy_load = measure(lambda: load([summary['messages']]), 1, summary['rows'])
+    runpy.run_path(str(BASE_DIR / 'preparation4.py'))
+    conn = psycopg2.connect(database = Config.DATABASE,
+                                  user = Config.USER,
+                                  password = Config.PASSWORD,
+                                  host = Config.HOST)
+    cursor = conn.cursor()
+    with open(summary['calibrating'], 'r') as f:
+        cursor.copy_expert("copy calibrating from STDIN delimiter ',' csv header", f)
+    conn.commit()
+    cursor.close()
+    conn.close()
+    runpy.run_path(str(BASE_DIR / 'preparation6.py'))
+    return copy_load
+
+
+def read_window(kind, terminal_id, start, end, binary):
+    from db import stream_window
+    Config.BINARY_COPY = binary
+    timestamps, values = [], []
+    for chunk_times, chunk_values in stream_window(kind, terminal_id, start, end):
+        timestamps.append(chunk_times)
+        values.append(chunk_values)
+    return np.concatenate(timestamps), np.concatenate(values)
+
+
+def match_events(found, truth, tolerance=3600):
+    # Сколько найденных событий совпало с настоящими того же типа: момент
+    # настоящего события внутри найденного [начало, конец] с запасом tolerance
+    # секунд (сглаживание размывает ступеньку на ширину своего окна).
+    unmatched = [event for event in truth]
+    matched = 0
+    for event in found:
+        start, end = int(event['start_time']) - tolerance, int(event['end_time']) + tolerance
+        for candidate in unmatched:
+            if candidate['type'] == event['type'] and start <= candidate['timestamp'] <= end:
+                unmatched.remove(candidate)
+                matched += 1
+                break
+    return matched
+
+
+def bench_stages(terminal_id, start, end, repeat, method, truth):
+    from db import fetch_calibration
+    from detection import REFUEL, DRAIN, detect_events
+    from downsample import downsample_events
+    from pipeline import fuel_series, local_times
+    from rendering import render_fuel
+    from smoothing import smooth
+    stages = {}
+    binary = Config.BINARY_COPY
+    (timestamps, raw), stages['window_query'] = measure(
+        lambda: read_window('fuel', terminal_id, start, end, True), repeat)
+    _, stages['window_query_text'] = measure(lambda: read_window('fuel', terminal_id, start, end, False), repeat)
+    Config.BINARY_COPY = binary
+    rows = len(timestamps)
+    for name in ('window_query', 'window_query_text'):
+        stages[name]['rows'] = rows
+        stages[name]['rows_per_second'] = round(rows / max(stages[name]['seconds'], 1e-9))
+
+    calibration = fetch_calibration(terminal_id)
+    litres, stages['calibration'] = measure(lambda: calibration(raw), repeat, rows)
+    smoothed, stages['smoothing'] = measure(lambda: smooth(litres, timestamps, method), repeat, rows)
+    events, stages['detection'] = measure(lambda: detect_events(timestamps, smoothed), repeat, rows)
+    truth = [event for event in truth if event['terminal_id'] == terminal_id
+             and start.timestamp() <= event['timestamp'] <= end.timestamp()]
+    for kind, key in ((REFUEL, 'refuels'), (DRAIN, 'drains')):
+        entry = {'expected': sum(1 for event in truth if event['type'] == kind),
+                 'found': sum(1 for event in events if event['type'] == kind),
+                 'matched': match_events([event for event in events if event['type'] == kind], truth)}
+        # Полнота - доля настоящих событий, которые нашлись, точность - доля найденных, которые настоящие.
+        entry['recall'] = round(entry['matched'] / entry['expected'], 3) if entry['expected'] else None
+        entry['precision'] = round(entry['matched'] / entry['found'], 3) if entry['found'] else None
+        stages['detection'][key] = entry
+    for event in events:
+        event['start_time'] = datetime.fromtimestamp(int(event['start_time']))
+        event['end_time'] = datetime.fromtimestamp(int(event['end_time']))
+    times = local_times(timestamps)
+    (times, values, events), stages['downsample'] = measure(
+        lambda: downsample_events(times, smoothed, [dict(event) for event in events]), repeat, rows)
+    _, stages['render'] = measure(lambda: render_fuel(terminal_id, times, values, events), repeat, len(times))
+    _, stages['fuel_series'] = measure(lambda: fuel_series(terminal_id, start, end, method, resolution=None),
+                                       repeat, rows)
+    return stages
+
+
+class StubBot:
+    # Клиент Telegram для замера обработчиков бота: ответы складываются в
+    # очередь, в сеть ничего не уходит.
+    def __init__(self):
+        self.replies = queue.Queue()
+
+    def send_message(self, chat_id, text, **kwargs):
+        self.replies.put(('message', text))
+
+    def send_photo(self, chat_id, photo, **kwargs):
+        self.replies.put(('photo', photo))
+
+    def reply_to(self, message, text, **kwargs):
+        self.replies.put(('message', text))
+
+    def answer(self, timeout=BOT_TIMEOUT):
+        # Итоговый ответ: картинка или сообщение, кроме места в очереди.
+        while True:
+            kind, content = self.replies.get(timeout=timeout)
+            if kind == 'photo' or not content.startswith("Бот занят"):
+                return kind, content
+
+
+def read_traces():
+    path = BASE_DIR / Config.METRICS_LOG
+    return path.read_text().splitlines() if path.exists() else []
+
+
+def last_trace(count, timeout=10):
+    # Этапы последнего запроса из журнала metrics.py. Трасса пишется сразу после
+    # отправки картинки, поэтому ждём, пока в журнале наберётся count строк.
+    deadline = time.monotonic() + timeout
+    lines = read_traces()
+    while len(lines) < count and time.monotonic() < deadline:
+        time.sleep(0.05)
+        lines = read_traces()
+    record = json.loads(lines[-1]) if lines else {}
+    return {entry['stage']: entry['seconds'] for entry in record.get('stages', [])}
+
+
+def bench_bot(terminal_id, start, end, repeat):
+    # /plot_fuel и /plot_speed через process_id_input(), как при сообщении с ID:
+    # ключ, кэш, очередь, процесс пула, отправка. Без кэша графиков и из кэша.
+    os.environ.setdefault('TELEAPI', '0:bench')
+    try:
+        import tgbotfinal
+    except ImportError as e:
+        print(f"Обработчик бота пропущен: {e}")
+        return {}
+    client = StubBot()
+    tgbotfinal.bot = client
+    chat_id = 1
+
+    def request(kind):
+        tgbotfinal.user_data[chat_id] = {"start_time": start, "end_time": end, "selecting": None}
+        tgbotfinal.set_user_state(chat_id, f"plot_{kind}_waiting_for_id")
+        tgbotfinal.process_id_input(SimpleNamespace(chat=SimpleNamespace(id=chat_id), text=terminal_id))
+        reply, content = client.answer()
+        if reply != 'photo':
+            raise RuntimeError(content)
+
+    stages = {}
+    try:
+        for kind in ('fuel', 'speed'):
+            written = len(read_traces())
+            _, stages[f'bot_plot_{kind}'] = measure(lambda: request(kind), repeat, setup=tgbotfinal.plot_cache.clear)
+            stages[f'bot_plot_{kind}']['trace'] = last_trace(written + repeat)
+            _, stages[f'bot_plot_{kind}_cached'] = measure(lambda: request(kind), repeat)
+    except (queue.Empty, RuntimeError) as e:
+        print(f"Ошибка обработчика бота: {e or 'нет ответа'}")
+    finally:
+        tgbotfinal.plot_queue.shutdown()
+    return stages
+
+
+def compare(previous, current, tolerance):
+    # Печатает отношение времени этапов к прошлому запуску. Возвращает число замедлений.
+    print(f"\nСравнение с {previous.get('commit')} ({previous.get('time')}):")
+    if previous.get('dataset', {}).get('rows') != current['dataset']['rows']:
+        print("  Внимание: наборы данных различаются, сравнение приблизительное")
+    slower = 0
+    for name, entry in current['stages'].items():
+        before = previous.get('stages', {}).get(name)
+        if not before:
+            continue
+        ratio = entry['seconds'] / max(before['seconds'], 1e-9)
+        mark = ""
+        if ratio > 1 + tolerance:
+            mark = "  медленнее"
+            slower += 1
+        elif ratio < 1 - tolerance:
+            mark = "  быстрее"
+        print(f"  {name:<24} {before['seconds']:>10.4f} -> {entry['seconds']:>10.4f} с  x{ratio:.2f}{mark}")
+    return slower
+
+
+def _share(value):
+    return "-" if value is None else f"{value:.0%}"
+
+
+def report(result):
+    print(f"\nСтрок в базе: {result['dataset']['rows']}, окно: {result['window']['rows']} строк")
+    print(f"{'этап':<24} {'лучшее, с':>10} {'медиана, с':>11} {'строк/с':>12}")
+    for name, entry in result['stages'].items():
+        rate = f"{entry['rows_per_second']:,}" if entry.get('rows_per_second') else ""
+        print(f"{name:<24} {entry['seconds']:>10.4f} {entry['median']:>11.4f} {rate:>12}")
+    detection = result['stages'].get('detection')
+    if detection:
+        for key in ('refuels', 'drains'):
+            entry = detection[key]
+            print(f"События {key}: настоящих {entry['expected']}, найдено {entry['found']}, "
+                  f"совпало {entry['matched']}, полнота {_share(entry.get('recall'))}, "
+                  f"точность {_share(entry.get('precision'))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры этапов на синтетических данных, результат в JSON")
+    synthetic.add_arguments(parser)
+    parser.add_argument('--data', default='data/synthetic', help="каталог синтетических выгрузок")
+    parser.add_argument('--database', default=Config.BENCH_DATABASE, help="база для замеров, пересоздаётся")
+    parser.add_argument('--no-load', action='store_true', help="не пересоздавать базу, взять уже загруженные данные")
+    parser.add_argument('--window-days', type=float, default=7, help="длина окна запроса в днях")
+    parser.add_argument('--method', default=Config.SMOOTHING, help="метод сглаживания")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-bot', action='store_true', help="без замера обработчика бота")
+    parser.add_argument('--output', help="файл результата (по умолчанию BENCH_DIR/<время>-<коммит>.json)")
+    parser.add_argument('--compare', help="JSON прошлого запуска для сравнения")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="допустимое замедление при сравнении")
+    args = parser.parse_args()
+
+    if args.database == Config.DATABASE:
+        print(f"База {args.database} пересоздаётся при замерах, укажите отдельную (BENCH_DATABASE в CONFIG.py)")
+        sys.exit(2)
+    # Замеры не трогают рабочую базу, кэши и журналы: всё во временном каталоге.
+    scratch = tempfile.mkdtemp(prefix='bench_')
+    Config.DATABASE = args.database
+    Config.PLOT_CACHE_DIR = os.path.join(scratch, 'plots')
+    Config.COLUMNAR_DIR = os.path.join(scratch, 'columnar')
+    Config.LOAD_REJECT_DIR = os.path.join(scratch, 'rejects')
+    Config.METRICS_LOG = os.path.join(scratch, 'requests.log')
+    Config.METRICS_FILE = os.path.join(scratch, 'metrics.prom')
+    Config.METRICS_PORT = 0
+    Config.SLOW_TRACE_SAMPLE = 0
+    Config.PROFILE_SAMPLE = 0
+
+    commit, dirty = git_revision()
+    result = {'commit': commit, 'dirty': dirty, 'time': datetime.now().isoformat(timespec='seconds'),
+              'host': platform.node(), 'python': platform.python_version(),
+              'config': {key: getattr(Config, key) for key in (
+                  'SMOOTHING', 'BINARY_COPY', 'STREAM_ITERSIZE', 'PLOT_POINTS', 'DOWNSAMPLING', 'WORKERS',
+                  'LOAD_WORKERS', 'PARTITIONED')},
+              'method': args.method, 'stages': {}}
+    try:
+        if args.no_load:
+            with open(Path(args.data) / 'synthetic.json') as f:
+                summary = json.load(f)
+        else:
+            summary = synthetic.generate(args.data, **synthetic.generator_params(args))
+            print(f"Сгенерировано строк: {summary['rows']}, терминалов: {summary['terminals']}")
+            recreate_database(args.database)
+            result['stages']['copy_load'] = load_dataset(summary)
+        with open(Path(args.data) / 'events.json') as f:
+            truth = json.load(f)
+        result['dataset'] = summary
+
+        terminal_id = synthetic.terminal_ids(summary['terminals'])[0]
+        start = datetime.fromisoformat(summary['start'])
+        end = start + timedelta(days=min(args.window_days, summary['days']))
+        stages = bench_stages(terminal_id, start, end, args.repeat, args.method, truth)
+        result['window'] = {'terminal_id': terminal_id, 'start': start.isoformat(), 'end': end.isoformat(),
+                            'rows': stages['window_query']['rows']}
+        result['stages'].update(stages)
+        if not args.no_bot:
+            result['stages'].update(bench_bot(terminal_id, start, end, args.repeat))
+    except Exception as e:
+        print(f"Ошибка при работе с PostgreSQL: {e}")
+        sys.exit(1)
+
+    report(result)
+    output = Path(args.output) if args.output else \
+        BASE_DIR / Config.BENCH_DIR / f"{datetime.now():%Y%m%d-%H%M%S}-{commit or 'nogit'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(result, f, ensure_ascii=False, indent=1)
+    print(f"Результат: {output}")
+    if args.compare:
+        with open(args.compare) as f:
+            slower = compare(json.load(f), result, args.tolerance)
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
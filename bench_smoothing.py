@@ -0,0 +1,89 @@
+import argparse
+import time
+from datetime import datetime
+import numpy as np
+from smoothing import SMOOTHERS, smooth
+
+
+def synthetic_fuel(n, seed=0):
+    rng = np.random.default_rng(seed)
+    timestamps = 1677672000 + np.cumsum(rng.integers(1, 30, n))
+    level = 300 - np.arange(n) * 40.0 / n
+    for position in rng.integers(0, n, max(n // 20000, 1)):
+        level[position:] += rng.choice([60.0, -40.0])
+    values = level + rng.normal(0, 3, n)
+    spikes = rng.integers(0, n, n // 100)
+    values[spikes] += rng.normal(0, 60, len(spikes))
+    return timestamps, values
+
+
+def load_terminal(terminal_id, start, end):
+    import psycopg2
+    from CONFIG import Config
+    from calibration import load_calibration, to_float_array
+    conn = psycopg2.connect(database=Config.DATABASE, user=Config.USER,
+                            password=Config.PASSWORD, host=Config.HOST)
+    cursor = conn.cursor()
+    calibration = load_calibration(cursor, terminal_id)
+    cursor.execute("""
+        SELECT timestamp, lls_0 AS fuel_level
+        FROM messages
+        WHERE terminal_id = %s AND timestamp BETWEEN %s AND %s AND lls_0 IS NOT NULL
+        ORDER BY timestamp
+    """, (terminal_id, int(start.timestamp()), int(end.timestamp())))
+    rows = [row for row in cursor.fetchall() if row[1] is not None]
+    cursor.close()
+    conn.close()
+    timestamps = np.array([row[0] for row in rows], dtype=np.int64)
+    return timestamps, calibration(to_float_array([row[1] for row in rows]))
+
+
+def run(timestamps, values, methods, repeat):
+    results = {}
+    for method in methods:
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            smoothed = smooth(values, timestamps, method)
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        results[method] = (best, smoothed)
+    return results
+
+
+def report(n, results):
+    baseline = results.get('lowess')
+    print(f"\nТочек: {n}")
+    print(f"{'метод':<10} {'время, с':>10} {'ускорение':>10} {'RMSE к lowess':>14} {'макс. откл.':>12}")
+    for method, (elapsed, smoothed) in results.items():
+        if baseline is None:
+            print(f"{method:<10} {elapsed:>10.4f}")
+            continue
+        difference = smoothed - baseline[1]
+        print(f"{method:<10} {elapsed:>10.4f} {baseline[0] / elapsed:>10.1f} "
+              f"{np.sqrt(np.mean(difference ** 2)):>14.3f} {np.max(np.abs(difference)):>12.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение методов сглаживания с LOWESS statsmodels")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5000, 20000, 50000])
+    parser.add_argument('--methods', nargs='+', default=list(SMOOTHERS), choices=list(SMOOTHERS))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--terminal', help="ID терминала: взять реальные данные из БД вместо синтетики")
+    parser.add_argument('--start', default="2023-03-01 12:00")
+    parser.add_argument('--end', default="2023-03-05 12:00")
+    args = parser.parse_args()
+
+    if args.terminal:
+        start = datetime.strptime(args.start, '%Y-%m-%d %H:%M')
+        end = datetime.strptime(args.end, '%Y-%m-%d %H:%M')
+        timestamps, values = load_terminal(args.terminal, start, end)
+        report(len(values), run(timestamps, values, args.methods, args.repeat))
+        return
+    for n in args.sizes:
+        timestamps, values = synthetic_fuel(n)
+        report(n, run(timestamps, values, args.methods, args.repeat))
+
+
+if __name__ == '__main__':
+    main()
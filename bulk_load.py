@@ -0,0 +1,434 @@
+import argparse
+import csv
+import io
+import multiprocessing
+import os
+import re
+import time
+from datetime import datetime
+from pathlib import Path
+import psycopg2
+from CONFIG import Config
+from ingest import BLOCK, ensure_ingest_tables, message_columns, open_source, source_files
+from catalog import ensure_catalog, rebuild_catalog
+from partitions import ensure_partitions, is_partitioned
+from events import checkpoints_exist, reset_checkpoints
+from rollups import refresh_rollups, rollups_exist
+from columnar import drop_month
+
+# Первичная загрузка больших выгрузок messages. Файлы режутся на куски по
+# LOAD_CHUNK_MB (по границам строк, .gz - целиком), куски грузятся COPY
+# параллельно в LOAD_WORKERS процессах, каждый со своим соединением. Индексы
+# messages снимаются на время загрузки и строятся один раз в конце. Пачка с
+# ошибкой делится пополам, пока не останутся отдельные плохие строки - они
+# уходят в файл отказов, остальное загружается.
+# Каждая пачка фиксируется одной транзакцией вместе с отметкой куска в
+# bulk_load_chunks (сколько байт куска загружено) и своими отказами в
+# bulk_load_rejects, а снятые индексы - в
+# bulk_load_indexes. Прерванную загрузку можно просто запустить ещё раз: она
+# продолжится с отметок тех же кусков, без повторов, и достроит индексы.
+# Месяцы терминалов, в которые легли строки, копятся в bulk_load_touched: по
+# ним после загрузки пересчитываются агрегаты и события только этих терминалов.
+# Строки CSV с переводом строки внутри кавычек не поддерживаются.
+BASE_DIR = Path(__file__).resolve().parent
+
+_conn = None
+
+
+def _connect():
+    global _conn
+    _conn = psycopg2.connect(database = Config.DATABASE,
+                                   user = Config.USER,
+                                   password = Config.PASSWORD,
+                                   host = Config.HOST)
+    cursor = _conn.cursor()
+    cursor.execute("set synchronous_commit = off")
+    _conn.commit()
+    cursor.close()
+
+
+def ensure_bulk_tables(cursor):
+    # position - байт от начала куска (для .gz - от конца заголовка), уже загруженных.
+    cursor.execute("""
+        create table if not exists bulk_load_chunks (
+            source text not null,
+            chunk integer not null,
+            start_byte bigint,
+            end_byte bigint,
+            position bigint not null default 0,
+            rows bigint not null default 0,
+            done boolean not null default false,
+            primary key (source, chunk)
+        )
+    """)
+    cursor.execute("""
+        create table if not exists bulk_load_rejects (
+            id bigserial primary key,
+            source text not null,
+            chunk integer not null,
+            line bytea not null,
+            error text not null
+        )
+    """)
+    cursor.execute("""
+        create table if not exists bulk_load_touched (
+            source text not null,
+            terminal_id text not null,
+            month text not null,
+            first integer not null,
+            primary key (source, terminal_id, month)
+        )
+    """)
+    cursor.execute("create table if not exists bulk_load_indexes (definition text primary key)")
+
+
+def split_file(path, chunk_bytes):
+    # Куски [start, end) по границам строк после заголовка. Для .gz - один кусок (None, None).
+    with open_source(path) as f:
+        header = f.readline()
+        if not isinstance(f, io.BufferedReader):
+            return header, [(None, None)]
+        size = os.path.getsize(path)
+        bounds = [f.tell()]
+        while bounds[-1] < size:
+            f.seek(min(bounds[-1] + chunk_bytes, size))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    return header, list(zip(bounds[:-1], bounds[1:]))
+
+
+def _read_lines(path, start, end, position=0):
+    # Строки куска [start, end) начиная с position байт от его начала, включая пустые.
+    with open_source(path) as f:
+        if start is None:
+            f.readline()
+            while position > 0:
+                position -= len(f.read(min(position, BLOCK)))
+        else:
+            start += position
+            f.seek(start)
+        for line in f:
+            if end is not None and start >= end:
+                break
+            if start is not None:
+                start += len(line)
+            yield line
+
+
+def _copy(cursor, columns, lines):
+    cursor.copy_expert(f"copy messages ({', '.join(columns)}) from stdin with (format csv)",
+                       io.BytesIO(b''.join(lines)))
+
+
+def _load_batch(cursor, columns, lines, rejects):
+    # COPY пачки внутри текущей транзакции; при ошибке данных или ограничения
+    # (в том числе строки вне всех секций) - откат к точке сохранения и деление
+    # пополам до отдельных плохих строк. Возвращает число загруженных строк,
+    # плохие строки дописывает в rejects.
+    cursor.execute("savepoint batch")
+    try:
+        _copy(cursor, columns, lines)
+        cursor.execute("release savepoint batch")
+        return len(lines)
+    except (psycopg2.DataError, psycopg2.IntegrityError) as e:
+        cursor.execute("rollback to savepoint batch")
+        cursor.execute("release savepoint batch")
+        if len(lines) == 1:
+            rejects.append((lines[0], str(e).splitlines()[0]))
+            return 0
+    middle = len(lines) // 2
+    return (_load_batch(cursor, columns, lines[:middle], rejects) +
+            _load_batch(cursor, columns, lines[middle:], rejects))
+
+
+def _touched(columns, lines):
+    # {(терминал, месяц 'YYYY-MM' по локальному времени): первый timestamp} пачки.
+    # Месяц считается один раз на четверть часа: смещения часовых поясов им кратны.
+    if 'terminal_id' not in columns or 'timestamp' not in columns:
+        return {}
+    terminal_column, timestamp_column = columns.index('terminal_id'), columns.index('timestamp')
+    months = {}
+    touched = {}
+    for row in csv.reader(line.decode(errors='replace') for line in lines):
+        try:
+            terminal_id, timestamp = row[terminal_column], int(float(row[timestamp_column]))
+        except (IndexError, ValueError):
+            continue
+        quarter = timestamp // 900
+        if quarter not in months:
+            months[quarter] = f"{datetime.fromtimestamp(timestamp):%Y-%m}"
+        key = (terminal_id, months[quarter])
+        touched[key] = min(touched.get(key, timestamp), timestamp)
+    return touched
+
+
+def _commit_batch(cursor, source, chunk, columns, lines, size, done=False):
+    # Пачка, её отказы и отметка куска - одна транзакция: после сбоя кусок
+    # продолжится ровно после неё, а отказы прошлых запусков сохранятся.
+    rejects = []
+    loaded = _load_batch(cursor, columns, lines, rejects) if lines else 0
+    cursor.executemany("insert into bulk_load_rejects (source, chunk, line, error) values (%s, %s, %s, %s)",
+                       [(source, chunk, psycopg2.Binary(line), error) for line, error in rejects])
+    cursor.executemany("""
+        insert into bulk_load_touched (source, terminal_id, month, first) values (%s, %s, %s, %s)
+        on conflict (source, terminal_id, month) do update set first = least(bulk_load_touched.first, excluded.first)
+    """, [(source, terminal_id, month, first) for (terminal_id, month), first in _touched(columns, lines).items()])
+    cursor.execute("""
+        update bulk_load_chunks set position = position + %s, rows = rows + %s, done = %s
+        where source = %s and chunk = %s
+    """, (size, loaded, done, source, chunk))
+    _conn.commit()
+    return loaded
+
+
+def load_chunk(task):
+    # Выполняется в процессе пула. Возвращает статистику куска, отказы - в bulk_load_rejects.
+    path, chunk, start, end, position, columns = task
+    source = str(Path(path).resolve())
+    started = time.perf_counter()
+    loaded = size = batch_size = 0
+    batch = []
+    cursor = _conn.cursor()
+    for line in _read_lines(path, start, end, position):
+        batch_size += len(line)
+        if line.strip():
+            batch.append(line)
+        if len(batch) >= Config.LOAD_BATCH_ROWS:
+            loaded += _commit_batch(cursor, source, chunk, columns, batch, batch_size)
+            size += batch_size
+            batch = []
+            batch_size = 0
+    loaded += _commit_batch(cursor, source, chunk, columns, batch, batch_size, done=True)
+    size += batch_size
+    cursor.close()
+    return {'path': path, 'worker': os.getpid(), 'rows': loaded, 'bytes': size,
+            'seconds': time.perf_counter() - started}
+
+
+def timestamp_range(path, columns):
+    # Диапазон timestamp файла, чтобы заранее создать секции.
+    column = columns.index('timestamp')
+    first = last = None
+    with open_source(path) as f:
+        reader = csv.reader(io.TextIOWrapper(f, newline=''))
+        next(reader)
+        for row in reader:
+            try:
+                timestamp = int(float(row[column]))
+            except (IndexError, ValueError):
+                continue
+            first = timestamp if first is None else min(first, timestamp)
+            last = timestamp if last is None else max(last, timestamp)
+    return first, last
+
+
+def drop_indexes(cursor):
+    # Определения снятых индексов сохраняются в bulk_load_indexes до их
+    # построения: после сбоя их достроит следующий запуск.
+    cursor.execute("""
+        select indexname, indexdef from pg_indexes
+        where schemaname = current_schema() and tablename = 'messages'
+    """)
+    indexes = cursor.fetchall()
+    for name, definition in indexes:
+        cursor.execute("insert into bulk_load_indexes values (%s) on conflict do nothing", (definition,))
+        cursor.execute(f"drop index if exists {name}")
+    return saved_indexes(cursor)
+
+
+def saved_indexes(cursor):
+    cursor.execute("select definition from bulk_load_indexes order by definition")
+    return [row[0] for row in cursor.fetchall()]
+
+
+def create_indexes(cursor, definitions):
+    cursor.execute(f"set maintenance_work_mem = '{Config.LOAD_INDEX_MEMORY}'")
+    for definition in definitions:
+        cursor.execute(re.sub(r'^CREATE (UNIQUE )?INDEX ', r'CREATE \1INDEX IF NOT EXISTS ', definition))
+    cursor.execute("delete from bulk_load_indexes")
+
+
+def write_rejects(path, header, rejects):
+    # Отказавшие строки - в <файл>.rejects.csv (с заголовком, можно исправить и
+    # догрузить через ingest.py), причины - в <файл>.rejects.log. rejects - все
+    # отказы файла из bulk_load_rejects, включая прерванные запуски.
+    directory = BASE_DIR / Config.LOAD_REJECT_DIR
+    directory.mkdir(parents=True, exist_ok=True)
+    name = Path(path).name
+    rejects_path = directory / f"{name}.rejects.csv"
+    with open(rejects_path, 'wb') as f:
+        f.write(header)
+        for line, _ in rejects:
+            f.write(line if line.endswith(b'\n') else line + b'\n')
+    with open(directory / f"{name}.rejects.log", 'w') as f:
+        for line, error in rejects:
+            f.write(f"{error}\t{line.decode(errors='replace').rstrip()}\n")
+    return rejects_path
+
+
+def _rate(rows, size, seconds):
+    seconds = max(seconds, 1e-9)
+    return f"{rows / seconds:,.0f} строк/с, {size / 2 ** 20 / seconds:.1f} МБ/с"
+
+
+def load(paths, workers=None, chunk_mb=None, defer_indexes=True):
+    workers = workers or Config.LOAD_WORKERS
+    chunk_bytes = int((chunk_mb or Config.LOAD_CHUNK_MB) * 2 ** 20)
+    conn = psycopg2.connect(database = Config.DATABASE,
+                                  user = Config.USER,
+                                  password = Config.PASSWORD,
+                                  host = Config.HOST)
+    cursor = conn.cursor()
+    ensure_ingest_tables(cursor)
+    ensure_catalog(cursor)
+    ensure_bulk_tables(cursor)
+    known = message_columns(cursor)
+    partitioned = Config.PARTITIONED and is_partitioned(cursor)
+
+    tasks = []
+    headers = {}
+    for path in source_files(paths):
+        source = str(path.resolve())
+        cursor.execute("select 1 from ingest_state where source = %s", (source,))
+        if cursor.fetchone() is not None:
+            print(f"{path.name}: уже загружался, догрузка - через ingest.py")
+            continue
+        cursor.execute("""
+            select chunk, start_byte, end_byte, position, done from bulk_load_chunks
+            where source = %s order by chunk
+        """, (source,))
+        chunks = cursor.fetchall()
+        if chunks:
+            # Прерванная загрузка: те же куски, с отметок.
+            with open_source(path) as f:
+                header = f.readline()
+            print(f"{path.name}: продолжение прерванной загрузки, "
+                  f"осталось кусков {sum(not chunk[4] for chunk in chunks)} из {len(chunks)}")
+        else:
+            header, bounds = split_file(path, chunk_bytes)
+            chunks = [(chunk, start, end, 0, False) for chunk, (start, end) in enumerate(bounds)]
+        columns = [column.strip().strip('"') for column in header.decode().strip().split(',')]
+        unknown = set(columns) - known
+        if unknown:
+            print(f"{path.name}: неизвестные колонки {', '.join(sorted(unknown))}, файл пропущен")
+            continue
+        if partitioned:
+            first, last = timestamp_range(path, columns)
+            if first is not None:
+                ensure_partitions(cursor, first, last)
+        cursor.executemany("""
+            insert into bulk_load_chunks (source, chunk, start_byte, end_byte) values (%s, %s, %s, %s)
+            on conflict do nothing
+        """, [(source, chunk, start, end) for chunk, start, end, _, _ in chunks])
+        headers[str(path)] = header
+        tasks.extend((str(path), chunk, start, end, position, columns)
+                     for chunk, start, end, position, done in chunks if not done)
+    conn.commit()
+    if not headers and not saved_indexes(cursor):
+        conn.close()
+        return
+
+    definitions = drop_indexes(cursor) if defer_indexes else saved_indexes(cursor)
+    conn.commit()
+    results = []
+    started = time.perf_counter()
+    try:
+        if tasks:
+            # fork: воркерам не нужно заново импортировать модули проекта.
+            with multiprocessing.get_context('fork').Pool(min(workers, len(tasks)), initializer=_connect) as pool:
+                for result in pool.imap_unordered(load_chunk, tasks):
+                    results.append(result)
+                    print(f"  {Path(result['path']).name} [{result['worker']}]: {result['rows']} строк, "
+                          f"{_rate(result['rows'], result['bytes'], result['seconds'])}")
+    finally:
+        load_seconds = time.perf_counter() - started
+        if definitions:
+            print(f"Построение индексов: {len(definitions)}")
+            index_started = time.perf_counter()
+            create_indexes(cursor, definitions)
+            conn.commit()
+            print(f"  индексы построены за {time.perf_counter() - index_started:.1f} с")
+
+    per_worker = {}
+    per_file = {}
+    for result in results:
+        for totals, key in ((per_worker, result['worker']), (per_file, result['path'])):
+            entry = totals.setdefault(key, {'rows': 0, 'bytes': 0, 'seconds': 0.0, 'chunks': 0})
+            entry['rows'] += result['rows']
+            entry['bytes'] += result['bytes']
+            entry['seconds'] += result['seconds']
+            entry['chunks'] += 1
+    for worker, entry in sorted(per_worker.items()):
+        print(f"Воркер {worker}: кусков {entry['chunks']}, строк {entry['rows']}, "
+              f"{_rate(entry['rows'], entry['bytes'], entry['seconds'])}")
+    for path, header in headers.items():
+        source = str(Path(path).resolve())
+        cursor.execute("select line, error from bulk_load_rejects where source = %s order by chunk, id", (source,))
+        rejects = [(bytes(line), error) for line, error in cursor.fetchall()]
+        if rejects:
+            rejects_path = write_rejects(path, header, rejects)
+            print(f"{Path(path).name}: отклонено строк {len(rejects)}, см. {rejects_path}")
+        # Файл, все куски которого загружены, отмечается для ingest.py: повторно он
+        # грузиться не будет. Позиция - в байтах несжатого текста, как её считает ingest.py.
+        cursor.execute("""
+            select count(*) filter (where not done), sum(rows), sum(position), bool_or(start_byte is null)
+            from bulk_load_chunks where source = %s
+        """, (source,))
+        pending, loaded, size, compressed = cursor.fetchone()
+        if pending:
+            continue
+        position = len(header) + size if compressed else os.path.getsize(path)
+        cursor.execute("""
+            insert into ingest_state (source, header, position, rows, loaded) values (%s, %s, %s, %s, %s)
+            on conflict (source) do update set header = excluded.header, position = excluded.position,
+                rows = ingest_state.rows + excluded.rows, loaded = excluded.loaded
+        """, (source, header.decode().strip(), position, loaded, datetime.now()))
+        cursor.execute("delete from bulk_load_chunks where source = %s", (source,))
+        cursor.execute("delete from bulk_load_rejects where source = %s", (source,))
+    rows = sum(entry['rows'] for entry in per_file.values())
+    size = sum(entry['bytes'] for entry in per_file.values())
+    print(f"Итого: {rows} строк за {load_seconds:.1f} с, {_rate(rows, size, load_seconds)}")
+    cursor.execute("analyze messages")
+    # Построчно по COPY справочник не ведётся, он пересчитывается один раз после загрузки.
+    # Отметки файлов фиксируются той же транзакцией.
+    rebuild_catalog(cursor)
+    # Терминалы, в которые легли строки этого и прерванных запусков, с первым timestamp.
+    cursor.execute("select terminal_id, min(first) from bulk_load_touched group by terminal_id")
+    touched = cursor.fetchall()
+    if checkpoints_exist(cursor):
+        # Загруженная история может лечь раньше отметок событий.
+        for terminal_id, first in touched:
+            reset_checkpoints(cursor, terminal_id, first)
+    rollups = rollups_exist(cursor)
+    if rollups:
+        # Строки старше отметки агрегатов: пересчёт пойдёт с их часа, как в ingest.py.
+        for terminal_id, first in touched:
+            cursor.execute("update rollup_state set watermark = least(watermark, %s) where terminal_id = %s",
+                           (first, terminal_id))
+    # Колоночный кэш сбрасывается только по месяцам, в которые легли строки.
+    cursor.execute("select distinct terminal_id, month from bulk_load_touched")
+    for terminal_id, month in cursor.fetchall():
+        drop_month(terminal_id, month)
+    cursor.execute("delete from bulk_load_touched")
+    conn.commit()
+    if rollups and touched:
+        print(f"Агрегаты обновлены, обработано строк: {refresh_rollups(conn, [row[0] for row in touched])}")
+    cursor.close()
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Параллельная первичная загрузка выгрузок messages")
+    parser.add_argument('paths', nargs='+', help="файлы или каталоги с файлами *.csv, *.csv.gz")
+    parser.add_argument('--workers', type=int, help=f"число процессов (по умолчанию {Config.LOAD_WORKERS})")
+    parser.add_argument('--chunk-mb', type=float, help=f"размер куска (по умолчанию {Config.LOAD_CHUNK_MB})")
+    parser.add_argument('--keep-indexes', action='store_true', help="не снимать индексы на время загрузки")
+    args = parser.parse_args()
+    try:
+        load(args.paths, args.workers, args.chunk_mb, not args.keep_indexes)
+    except Exception as e:
+        print(f"Ошибка при работе с PostgreSQL: {e}")
+
+
+if __name__ == '__main__':
+    main()
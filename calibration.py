@@ -0,0 +1,103 @@
+import hashlib
+import numpy as np
+
+
+class Calibration:
+    # Кусочно-линейная тарировка ДУТ. Повторяет interp1d(kind='linear',
+    # fill_value="extrapolate"), но считает весь массив за один проход.
+    def __init__(self, input_values, output_values):
+        x = np.asarray(input_values, dtype=float)
+        y = np.asarray(output_values, dtype=float)
+        if x.ndim != 1 or x.shape != y.shape:
+            raise ValueError("Размеры input_value и output_value не совпадают")
+        if len(x) < 2:
+            raise ValueError("Для интерполяции нужно минимум две точки тарировки")
+        order = np.argsort(x, kind='mergesort')
+        self.x = x[order]
+        self.y = y[order]
+
+    def __call__(self, raw):
+        raw = np.asarray(raw, dtype=float)
+        hi = np.clip(np.searchsorted(self.x, raw), 1, len(self.x) - 1)
+        lo = hi - 1
+        x_lo = self.x[lo]
+        y_lo = self.y[lo]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = (self.y[hi] - y_lo) / (self.x[hi] - x_lo)
+        return slope * (raw - x_lo) + y_lo
+
+    def __len__(self):
+        return len(self.x)
+
+    @property
+    def nbytes(self):
+        return self.x.nbytes + self.y.nbytes
+
+
+class CalibrationSet:
+    # Тарировки всех портов одного терминала. Без указания порта используется
+    # объединённая таблица всех портов, как и раньше в боте и GUI.
+    def __init__(self, terminal_id, ports):
+        if not ports:
+            raise ValueError(f"Нет калибровочных данных для ID: {terminal_id}")
+        self.terminal_id = terminal_id
+        self.ports = {port: Calibration(*zip(*points))
+                      for port, points in ports.items() if len(points) >= 2}
+        merged = [point for points in ports.values() for point in points]
+        self.merged = Calibration(*zip(*merged))
+
+    def __call__(self, raw, port=None):
+        if port is None:
+            return self.merged(raw)
+        if port not in self.ports:
+            raise KeyError(f"Нет калибровки для порта {port} терминала {self.terminal_id}")
+        return self.ports[port](raw)
+
+    @property
+    def nbytes(self):
+        return self.merged.nbytes + sum(calibration.nbytes for calibration in self.ports.values())
+
+    @property
+    def digest(self):
+        # Отпечаток точек тарировки: меняется вместе с таблицей calibrating для этого терминала.
+        digest = hashlib.sha1()
+        for port, calibration in [(None, self.merged)] + sorted(self.ports.items()):
+            digest.update(f"{port}:".encode())
+            digest.update(calibration.x.tobytes())
+            digest.update(calibration.y.tobytes())
+        return digest.hexdigest()
+
+
+def split_deviceid_port(deviceid_port):
+    terminal_id, _, port = deviceid_port.rpartition('_')
+    return terminal_id, port
+
+
+def group_calibrating_rows(rows):
+    # Строки всей таблицы calibrating по терминалам, как их выбирает LIKE 'ID_%'.
+    terminals = {}
+    for row in rows:
+        terminal_id, _ = split_deviceid_port(row[0])
+        terminals.setdefault(terminal_id, []).append(row)
+    return terminals
+
+
+def parse_calibrating_rows(rows):
+    ports = {}
+    for deviceid_port, calibrating_data in rows:
+        if calibrating_data and isinstance(calibrating_data, list):
+            _, port = split_deviceid_port(deviceid_port)
+            points = ports.setdefault(port, [])
+            for entry in calibrating_data:
+                points.append((entry['input_value'], entry['output_value']))
+    return ports
+
+
+def load_calibration(cursor, terminal_id):
+    cursor.execute("SELECT deviceid_port, calibrating_data FROM calibrating WHERE deviceid_port LIKE %s ORDER BY id",
+                   (f'{terminal_id}_%',))
+    return CalibrationSet(terminal_id, parse_calibrating_rows(cursor.fetchall()))
+
+
+def to_float_array(values):
+    return np.fromiter((np.nan if v is None else float(v) for v in values), dtype=float, count=len(values))
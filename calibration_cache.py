@@ -0,0 +1,149 @@
+import threading
+import time
+from collections import OrderedDict
+import psycopg2
+from CONFIG import Config
+
+CHANNEL = 'calibrating_changed'
+
+
+class CalibrationCache:
+    # LRU-кэш готовых тарировок (CalibrationSet с кривыми всех портов терминала)
+    # с ограничением по памяти. При любом изменении таблицы calibrating кэш
+    # сбрасывается целиком: сразу по NOTIFY calibrating_changed (его шлёт
+    # preparation5.py после загрузки) и, на случай правок в обход него, по
+    # отпечатку таблицы (число строк и сумма хешей) не чаще раза в check_interval секунд.
+    def __init__(self, max_bytes=Config.CALIBRATION_CACHE_MB * 2 ** 20,
+                 check_interval=Config.CALIBRATION_CHECK_INTERVAL):
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self._items = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._listener = None
+        self._fingerprint = None
+        self._checked = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def get(self, terminal_id):
+        with self._lock:
+            calibration = self._items.get(terminal_id)
+            if calibration is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(terminal_id)
+            self.hits += 1
+            return calibration
+
+    def put(self, terminal_id, calibration, generation=None):
+        # generation - номер поколения на момент чтения из базы: если кэш успели
+        # сбросить, пока шёл запрос, устаревшая тарировка не сохраняется.
+        size = calibration.nbytes
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return False
+            if size > self.max_bytes:
+                return False
+            old = self._items.pop(terminal_id, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._items[terminal_id] = calibration
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self.evictions += 1
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+            self._generation += 1
+            self.invalidations += 1
+
+    def validate(self, fingerprint):
+        # fingerprint - функция без аргументов, возвращающая отпечаток таблицы.
+        if self._notified():
+            self.clear()
+        now = time.monotonic()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        current = fingerprint()
+        if self._fingerprint is not None and current != self._fingerprint:
+            self.clear()
+        self._fingerprint = current
+
+    def _notified(self):
+        with self._lock:
+            connected = self._listener is not None
+        if not connected:
+            # Подключение идёт без блокировки, чтобы get/put других потоков не
+            # ждали сети. Если другой поток успел раньше, лишнее соединение закрывается.
+            listener = None
+            try:
+                listener = psycopg2.connect(database = Config.DATABASE,
+                                            user = Config.USER,
+                                            password = Config.PASSWORD,
+                                            host = Config.HOST)
+                listener.autocommit = True
+                with listener.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CHANNEL}")
+            except psycopg2.Error as e:
+                print(f"Ошибка при работе с PostgreSQL: {e}")
+                if listener is not None:
+                    listener.close()
+                return False
+            with self._lock:
+                if self._listener is None:
+                    self._listener, listener = listener, None
+            if listener is not None:
+                listener.close()
+        with self._lock:
+            if self._listener is None:
+                return False
+            try:
+                self._listener.poll()
+            except psycopg2.Error as e:
+                print(f"Ошибка при работе с PostgreSQL: {e}")
+                self._listener.close()
+                self._listener = None
+                return False
+            notified = bool(self._listener.notifies)
+            self._listener.notifies.clear()
+            return notified
+
+    def stats(self):
+        with self._lock:
+            return {
+                'items': len(self._items),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def after_fork(self):
+        # В дочернем процессе: блокировка могла быть захвачена другим потоком
+        # родителя, а соединение LISTEN принадлежит родителю. Возвращает его,
+        # чтобы вызывающий держал ссылку и соединение не закрылось сборщиком мусора.
+        self._lock = threading.Lock()
+        listener, self._listener = self._listener, None
+        return listener
+
+    def close(self):
+        with self._lock:
+            if self._listener is not None:
+                self._listener.close()
+                self._listener = None
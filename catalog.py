@@ -0,0 +1,90 @@
+import argparse
+import psycopg2
+from CONFIG import Config
+
+# Справочник терминалов: первое и последнее сообщение и число сообщений по
+# каждому ID. Ведётся при загрузке (ingest.py, bulk_load.py), поэтому списку ID
+# в боте и GUI не нужен SELECT DISTINCT по всей таблице messages. Поиск по
+# префиксу идёт по индексу с порядком "C" диапазоном [префикс, следующий префикс).
+TOP = '\U0010ffff'
+
+
+def ensure_catalog(cursor):
+    cursor.execute("""
+        create table if not exists terminals (
+            terminal_id text primary key,
+            first_seen integer not null,
+            last_seen integer not null,
+            messages bigint not null
+        )
+    """)
+    cursor.execute('create index if not exists terminals_prefix_idx on terminals (terminal_id collate "C")')
+
+
+def catalog_exists(cursor):
+    cursor.execute("select to_regclass('terminals') is not null")
+    return cursor.fetchone()[0]
+
+
+def prefix_bounds(prefix):
+    # Все строки с префиксом prefix лежат в [prefix, upper) при побайтовом сравнении.
+    if not prefix:
+        return '', TOP
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def record_terminals(cursor, rows):
+    # rows: (ID, добавлено сообщений, первый timestamp, последний timestamp) новых строк.
+    cursor.executemany("""
+        insert into terminals (terminal_id, first_seen, last_seen, messages) values (%s, %s, %s, %s)
+        on conflict (terminal_id) do update set
+            first_seen = least(terminals.first_seen, excluded.first_seen),
+            last_seen = greatest(terminals.last_seen, excluded.last_seen),
+            messages = terminals.messages + excluded.messages
+    """, [(terminal_id, first, last, count) for terminal_id, count, first, last in rows])
+
+
+def rebuild_catalog(cursor, terminals=None):
+    # Полный пересчёт по messages (после первичной загрузки или удаления секций).
+    if terminals is None:
+        cursor.execute("truncate terminals")
+        cursor.execute("""
+            insert into terminals (terminal_id, first_seen, last_seen, messages)
+            select terminal_id, min(timestamp), max(timestamp), count(*) from messages
+            where terminal_id is not null and timestamp is not null
+            group by terminal_id
+        """)
+    else:
+        cursor.execute("delete from terminals where terminal_id = any(%s)", (list(terminals),))
+        cursor.execute("""
+            insert into terminals (terminal_id, first_seen, last_seen, messages)
+            select terminal_id, min(timestamp), max(timestamp), count(*) from messages
+            where terminal_id = any(%s) and timestamp is not null
+            group by terminal_id
+        """, (list(terminals),))
+    cursor.execute("analyze terminals")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пересчёт справочника терминалов по таблице messages")
+    parser.add_argument('terminals', nargs='*', help="ID терминалов (по умолчанию все)")
+    args = parser.parse_args()
+    try:
+        conn = psycopg2.connect(database = Config.DATABASE,
+                                      user = Config.USER,
+                                      password = Config.PASSWORD,
+                                      host = Config.HOST)
+        cursor = conn.cursor()
+        ensure_catalog(cursor)
+        rebuild_catalog(cursor, args.terminals or None)
+        conn.commit()
+        cursor.execute("select count(*) from terminals")
+        print(f"Справочник терминалов обновлён: {cursor.fetchone()[0]} терминалов")
+        cursor.close()
+        conn.close()
+    except Exception as e:
+        print(f"Ошибка при работе с PostgreSQL: {e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,261 @@
+import argparse
+import json
+import os
+import shutil
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+import psycopg2
+from CONFIG import Config
+from calibration import load_calibration
+from catalog import catalog_exists
+from db import fetch_calibration, get_database, terminal_bounds
+
+# Колоночный кэш истории терминалов для офлайн-анализа: каждый закрытый месяц
+# лежит в cache/columnar/<ID>/<ГГГГ-ММ>/ отдельными файлами .npy на колонку
+# (timestamp, сырой LLS_0, литры по тарировке, скорость, зажигание) и meta.json.
+# Читатель открывает их через np.load(mmap_mode='r') и отдаёт срезы без
+# копирования, читаются только запрошенные колонки. Месяцы без файлов, в том
+# числе текущий, ещё открытый, читаются из messages.
+BASE_DIR = Path(__file__).resolve().parent
+COLUMNS = {'timestamp': np.int64, 'lls_0': np.float64, 'litres': np.float64,
+           'speed': np.float32, 'ignition': np.int8}
+# Пропуски: NaN для дробных колонок, -1 для зажигания.
+NO_IGNITION = -1
+SOURCE_QUERY = """
+    select timestamp, lls_0, speed, ignition from messages
+    where terminal_id = %s and timestamp >= %s and timestamp < %s and timestamp is not null
+    order by timestamp
+"""
+
+
+def cache_root():
+    return BASE_DIR / Config.COLUMNAR_DIR
+
+
+def month_start(moment):
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(moment):
+    return moment.replace(year=moment.year + moment.month // 12, month=moment.month % 12 + 1)
+
+
+def months(first, last):
+    # Месяцы (локальное время), захватывающие секунды эпохи [first, last].
+    month = month_start(datetime.fromtimestamp(first))
+    while month.timestamp() <= last:
+        yield month
+        month = next_month(month)
+
+
+def month_path(terminal_id, month):
+    return cache_root() / str(terminal_id) / f"{month:%Y-%m}"
+
+
+def read_meta(path):
+    try:
+        return json.loads((path / 'meta.json').read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def to_columns(rows, calibration=None):
+    # Строки (timestamp, lls_0, speed, ignition) в массивы колонок.
+    columns = {
+        'timestamp': np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows)),
+        'lls_0': np.array([row[1] for row in rows], dtype=np.float64),
+        'speed': np.array([row[2] for row in rows], dtype=np.float32),
+        'ignition': np.fromiter((NO_IGNITION if row[3] is None else row[3] for row in rows),
+                                dtype=np.int8, count=len(rows)),
+    }
+    columns['litres'] = calibration(columns['lls_0']) if calibration is not None else \
+        np.full(len(rows), np.nan)
+    return columns
+
+
+def export_month(conn, terminal_id, month, calibration, itersize=Config.STREAM_ITERSIZE):
+    # Выгружает месяц в каталог рядом и подменяет им старый, читатель видит
+    # либо прежние файлы, либо новые целиком. Возвращает число строк.
+    start, end = int(month.timestamp()), int(next_month(month).timestamp())
+    cursor = conn.cursor(name="columnar_rows")
+    cursor.itersize = itersize
+    cursor.execute(SOURCE_QUERY, (terminal_id, start, end))
+    parts = []
+    while True:
+        rows = cursor.fetchmany(itersize)
+        if not rows:
+            break
+        parts.append(to_columns(rows, calibration))
+    cursor.close()
+    conn.rollback()
+
+    path = month_path(terminal_id, month)
+    temporary = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    shutil.rmtree(temporary, ignore_errors=True)
+    temporary.mkdir(parents=True)
+    for column, dtype in COLUMNS.items():
+        values = np.concatenate([part[column] for part in parts]) if parts else np.empty(0, dtype=dtype)
+        np.save(temporary / f"{column}.npy", values.astype(dtype, copy=False))
+    rows = sum(len(part['timestamp']) for part in parts)
+    meta = {'rows': rows, 'start': start, 'end': end,
+            'calibration': calibration.digest if calibration is not None else None,
+            'exported': datetime.now().isoformat()}
+    (temporary / 'meta.json').write_text(json.dumps(meta))
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temporary, path)
+    return rows
+
+
+def export_terminal(conn, terminal_id):
+    # Выгружает закрытые месяцы, которых ещё нет в кэше или которые устарели
+    # (другое число строк или тарировка). Возвращает (выгружено месяцев, строк).
+    cursor = conn.cursor()
+    cursor.execute("select min(timestamp), max(timestamp) from messages where terminal_id = %s", (terminal_id,))
+    first, last = cursor.fetchone()
+    try:
+        calibration = load_calibration(cursor, terminal_id)
+    except ValueError:
+        calibration = None
+    digest = calibration.digest if calibration is not None else None
+    current = month_start(datetime.now())
+    exported = total = 0
+    if first is not None:
+        for month in months(first, last):
+            if month >= current:
+                break
+            start, end = int(month.timestamp()), int(next_month(month).timestamp())
+            cursor.execute("""
+                select count(*) from messages where terminal_id = %s and timestamp >= %s and timestamp < %s
+            """, (terminal_id, start, end))
+            count = cursor.fetchone()[0]
+            meta = read_meta(month_path(terminal_id, month))
+            if not count or meta is not None and meta['rows'] == count and meta['calibration'] == digest:
+                continue
+            total += export_month(conn, terminal_id, month, calibration)
+            exported += 1
+    conn.rollback()
+    cursor.close()
+    return exported, total
+
+
+def drop_months(terminal_id=None, since=None):
+    # Сбрасывает кэш терминала с месяца, в который попал timestamp since (или
+    # весь), когда в уже выгруженные месяцы дописаны строки.
+    root = cache_root() if terminal_id is None else cache_root() / str(terminal_id)
+    if not root.exists():
+        return
+    if terminal_id is None or since is None:
+        shutil.rmtree(root, ignore_errors=True)
+        return
+    first = f"{month_start(datetime.fromtimestamp(since)):%Y-%m}"
+    for path in root.iterdir():
+        if path.name[:7] >= first:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def drop_month(terminal_id, month):
+    # Сбрасывает один месяц ('YYYY-MM') кэша терминала.
+    root = cache_root() / str(terminal_id)
+    if not root.exists():
+        return
+    for path in root.iterdir():
+        if path.name[:7] == month:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def iter_columns(terminal_id, start_datetime=None, end_datetime=None, columns=tuple(COLUMNS),
+                 itersize=Config.STREAM_ITERSIZE):
+    # Куски {колонка: массив} по порядку времени за [начало, конец). Кэшированный
+    # месяц - один кусок из срезов отображённых в память файлов, остальное -
+    # куски по itersize строк из messages. Без границ - вся история терминала.
+    columns = tuple(columns)
+    if start_datetime is None or end_datetime is None:
+        first, last = terminal_bounds(terminal_id)
+        if first is None:
+            return
+        start = int(start_datetime.timestamp()) if start_datetime is not None else first
+        end = int(end_datetime.timestamp()) if end_datetime is not None else last + 1
+    else:
+        start, end = int(start_datetime.timestamp()), int(end_datetime.timestamp())
+    if start >= end:
+        return
+    calibration = fetch_calibration(terminal_id) if 'litres' in columns else None
+    current = month_start(datetime.now())
+
+    def from_database(lower, upper):
+        for rows in get_database().stream(SOURCE_QUERY, (terminal_id, lower, upper), itersize):
+            chunk = to_columns(rows, calibration)
+            yield {column: chunk[column] for column in columns}
+
+    pending = None
+    for month in months(start, end - 1):
+        lower = max(start, int(month.timestamp()))
+        upper = min(end, int(next_month(month).timestamp()))
+        path = month_path(terminal_id, month)
+        meta = read_meta(path) if month < current else None
+        if meta is None:
+            # Подряд идущие месяцы без кэша читаются одним запросом.
+            pending = (pending[0] if pending else lower, upper)
+            continue
+        if pending:
+            yield from from_database(*pending)
+            pending = None
+        timestamps = np.load(path / 'timestamp.npy', mmap_mode='r')
+        left, right = np.searchsorted(timestamps, [lower, upper])
+        if left == right:
+            continue
+        chunk = {}
+        for column in columns:
+            if column == 'litres' and meta['calibration'] != (calibration.digest if calibration else None):
+                # Тарировку сменили после выгрузки: литры пересчитываются из сырого LLS_0.
+                chunk[column] = calibration(np.load(path / 'lls_0.npy', mmap_mode='r')[left:right])
+            else:
+                chunk[column] = np.load(path / f"{column}.npy", mmap_mode='r')[left:right]
+        yield chunk
+    if pending:
+        yield from from_database(*pending)
+
+
+def load_columns(terminal_id, start_datetime=None, end_datetime=None, columns=tuple(COLUMNS)):
+    # Всё окно одним набором массивов. Окно внутри одного кэшированного месяца
+    # отдаётся срезами файлов без копирования.
+    chunks = list(iter_columns(terminal_id, start_datetime, end_datetime, columns))
+    if len(chunks) == 1:
+        return chunks[0]
+    return {column: np.concatenate([chunk[column] for chunk in chunks]) if chunks else
+            np.empty(0, dtype=COLUMNS[column]) for column in columns}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Выгрузка закрытых месяцев истории терминалов в колоночный кэш")
+    parser.add_argument('terminals', nargs='*', help="ID терминалов (по умолчанию все)")
+    args = parser.parse_args()
+    try:
+        conn = psycopg2.connect(database = Config.DATABASE,
+                                      user = Config.USER,
+                                      password = Config.PASSWORD,
+                                      host = Config.HOST)
+        cursor = conn.cursor()
+        terminals = args.terminals
+        if not terminals:
+            if catalog_exists(cursor):
+                cursor.execute('select terminal_id from terminals order by terminal_id collate "C"')
+            else:
+                cursor.execute("select distinct terminal_id from messages where terminal_id is not null")
+            terminals = [row[0] for row in cursor.fetchall()]
+        conn.rollback()
+        cursor.close()
+        for terminal_id in terminals:
+            exported, rows = export_terminal(conn, terminal_id)
+            if exported:
+                print(f"{terminal_id}: выгружено месяцев {exported}, строк {rows}")
+        size = sum(path.stat().st_size for path in cache_root().rglob('*.npy')) if cache_root().exists() else 0
+        print(f"Колоночный кэш: {size / 2 ** 20:.1f} МБ в {cache_root()}")
+        conn.close()
+    except Exception as e:
+        print(f"Ошибка при работе с PostgreSQL: {e}")
+
+
+if __name__ == '__main__':
+    main()
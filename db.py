@@ -0,0 +1,626 @@
+import threading
+import time
+from contextlib import contextmanager
+import itertools
+import queue
+import numpy as np
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import PoolError
+from CONFIG import Config
+from calibration import CalibrationSet, group_calibrating_rows, parse_calibrating_rows
+from calibration_cache import CalibrationCache
+from catalog import prefix_bounds
+from pushdown import BUCKETS, store_curve
+from metrics import stage
+from rollups import RESOLUTIONS, table_name
+
+# Постоянные запросы бота и GUI. На каждом соединении пула они один раз
+# готовятся через PREPARE и дальше выполняются через EXECUTE без повторного
+# разбора и планирования.
+STATEMENTS = {
+    'calibration': ("text", """
+        SELECT deviceid_port, calibrating_data FROM calibrating
+        WHERE deviceid_port LIKE $1 ORDER BY id
+    """),
+    'fuel_window': ("text, integer, integer", """
+        SELECT timestamp, lls_0 FROM messages
+        WHERE terminal_id = $1 AND timestamp BETWEEN $2 AND $3 AND lls_0 IS NOT NULL
+        ORDER BY timestamp
+    """),
+    'speed_window': ("text, integer, integer", """
+        SELECT timestamp, speed FROM messages
+        WHERE terminal_id = $1 AND timestamp BETWEEN $2 AND $3 AND speed IS NOT NULL
+        ORDER BY timestamp
+    """),
+    'fuel_count': ("text, integer, integer", """
+        SELECT count(*), coalesce(max(timestamp), 0) FROM messages
+        WHERE terminal_id = $1 AND timestamp BETWEEN $2 AND $3 AND lls_0 IS NOT NULL
+    """),
+    'speed_count': ("text, integer, integer", """
+        SELECT count(*), coalesce(max(timestamp), 0) FROM messages
+        WHERE terminal_id = $1 AND timestamp BETWEEN $2 AND $3 AND speed IS NOT NULL
+    """),
+    'all_calibrations': ("", "SELECT deviceid_port, calibrating_data FROM calibrating ORDER BY id"),
+    'calibration_fingerprint': ("", """
+        SELECT count(*), coalesce(sum(hashtext(deviceid_port || ':' || calibrating_data::text)::bigint), 0)
+        FROM calibrating
+    """),
+    'terminal_ids': ("", 'SELECT terminal_id FROM terminals ORDER BY terminal_id COLLATE "C"'),
+    'terminal_ids_scan': ("", "SELECT DISTINCT terminal_id FROM messages"),
+    'catalog_available': ("", "SELECT to_regclass('terminals') IS NOT NULL"),
+    'terminal_page': ("text, text, integer, integer", """
+        SELECT terminal_id, first_seen, last_seen, messages FROM terminals
+        WHERE terminal_id COLLATE "C" >= $1 AND terminal_id COLLATE "C" < $2
+        ORDER BY terminal_id COLLATE "C" LIMIT $3 OFFSET $4
+    """),
+    'terminal_count': ("text, text", """
+        SELECT count(*) FROM terminals WHERE terminal_id COLLATE "C" >= $1 AND terminal_id COLLATE "C" < $2
+    """),
+    'rollups_available': ("", "SELECT to_regclass('rollup_state') IS NOT NULL"),
+    'events_window': ("text, text, integer, integer", """
+        SELECT start_time, end_time, volume FROM events
+        WHERE terminal_id = $1 AND type = $2 AND start_time BETWEEN $3 AND $4
+        ORDER BY start_time
+    """),
+    'window_events': ("text, integer, integer", """
+        SELECT type, start_time, end_time, volume FROM events
+        WHERE terminal_id = $1 AND start_time BETWEEN $2 AND $3
+        ORDER BY start_time
+    """),
+    'event_watermark': ("text", "SELECT watermark FROM event_checkpoints WHERE terminal_id = $1"),
+    'events_available': ("", "SELECT to_regclass('event_checkpoints') IS NOT NULL"),
+    'terminal_bounds': ("text", "SELECT min(timestamp), max(timestamp) FROM messages WHERE terminal_id = $1"),
+    'pushdown_available': ("", "SELECT to_regclass('calibration_curves') IS NOT NULL"),
+    'curve_digest': ("text", "SELECT digest FROM calibration_curves WHERE terminal_id = $1"),
+    # Средние по корзинам в $4 секунд, тарировка - в базе (pushdown.py). OFFSET 0
+    # не даёт подзапросу раствориться, и calibrate_lls считается один раз на строку.
+    # Бесконечности и NaN тарировки в среднее не входят, как в агрегатах rollups.py.
+    'fuel_buckets': ("text, integer, integer, integer", """
+        SELECT bucket, avg(litres) FROM (
+            SELECT m.timestamp / $4 * $4 AS bucket, calibrate_lls(c.xs, c.ys, c.bounds, m.lls_0) AS litres
+            FROM messages m JOIN calibration_curves c ON c.terminal_id = m.terminal_id
+            WHERE m.terminal_id = $1 AND m.timestamp BETWEEN $2 AND $3 AND m.lls_0 IS NOT NULL
+            OFFSET 0
+        ) s
+        WHERE litres > '-Infinity' AND litres < 'Infinity'
+        GROUP BY bucket ORDER BY bucket
+    """),
+    'speed_buckets': ("text, integer, integer, integer", """
+        SELECT timestamp / $4 * $4 AS bucket, avg(speed) FROM messages
+        WHERE terminal_id = $1 AND timestamp BETWEEN $2 AND $3 AND speed IS NOT NULL
+        GROUP BY bucket ORDER BY bucket
+    """),
+}
+
+# Те же окна из поминутных/почасовых агрегатов (rollups.py): fuel_minute, speed_hour и т.д.
+for _resolution in RESOLUTIONS:
+    for _kind in ('fuel', 'speed'):
+        STATEMENTS[f'{_kind}_{_resolution}'] = ("text, integer, integer", f"""
+            SELECT bucket, {_kind}_mean FROM {table_name(_resolution)}
+            WHERE terminal_id = $1 AND bucket BETWEEN $2 AND $3 AND {_kind}_samples > 0
+            ORDER BY bucket
+        """)
+        STATEMENTS[f'{_kind}_{_resolution}_count'] = ("text, integer, integer", f"""
+            SELECT count(*), coalesce(max(bucket), 0), coalesce(sum({_kind}_samples), 0)
+            FROM {table_name(_resolution)}
+            WHERE terminal_id = $1 AND bucket BETWEEN $2 AND $3 AND {_kind}_samples > 0
+        """)
+
+# Отметка окна для ключа кэша графиков: первая и последняя строка окна берутся
+# из индекса (terminal_id, timestamp) с LIMIT 1, без прохода по окну, а счётчик
+# сообщений терминала из справочника растёт при любой загрузке, в том числе
+# задним числом. Для агрегатов к ним добавляется отметка rollup_state. Строки
+# без LLS_0 или скорости здесь не отсеиваются: пустой ряд покажет сам график.
+STATEMENTS['window_watermark'] = ("text, integer, integer", """
+    SELECT (SELECT timestamp FROM messages WHERE terminal_id = $1 AND timestamp BETWEEN $2 AND $3
+            ORDER BY timestamp LIMIT 1),
+           (SELECT timestamp FROM messages WHERE terminal_id = $1 AND timestamp BETWEEN $2 AND $3
+            ORDER BY timestamp DESC LIMIT 1),
+           (SELECT messages FROM terminals WHERE terminal_id = $1)
+""")
+for _resolution in RESOLUTIONS:
+    STATEMENTS[f'{_resolution}_watermark'] = ("text, integer, integer", f"""
+        SELECT (SELECT bucket FROM {table_name(_resolution)} WHERE terminal_id = $1 AND bucket BETWEEN $2 AND $3
+                ORDER BY bucket LIMIT 1),
+               (SELECT bucket FROM {table_name(_resolution)} WHERE terminal_id = $1 AND bucket BETWEEN $2 AND $3
+                ORDER BY bucket DESC LIMIT 1),
+               (SELECT messages FROM terminals WHERE terminal_id = $1),
+               (SELECT watermark FROM rollup_state WHERE terminal_id = $1)
+    """)
+
+WINDOW_STATEMENTS = {'fuel': 'fuel_window', 'speed': 'speed_window'}
+COUNT_STATEMENTS = {'fuel': 'fuel_count', 'speed': 'speed_count'}
+
+# DECLARE CURSOR не принимает EXECUTE, поэтому потоковые выборки идут обычным
+# SQL через именованный (серверный) курсор.
+STREAM_QUERIES = {
+    'fuel': """
+        SELECT timestamp, lls_0 FROM messages
+        WHERE terminal_id = %s AND timestamp BETWEEN %s AND %s AND lls_0 IS NOT NULL
+        ORDER BY timestamp
+    """,
+    'speed': """
+        SELECT timestamp, speed FROM messages
+        WHERE terminal_id = %s AND timestamp BETWEEN %s AND %s AND speed IS NOT NULL
+        ORDER BY timestamp
+    """,
+}
+# Типы колонок тех же выборок в двоичном COPY (сетевой порядок байт) и типы
+# массивов, в которые они разбираются.
+COPY_TYPES = {
+    'fuel': [('>i4', np.int64), ('>f8', np.float32)],
+    'speed': [('>i4', np.int64), ('>i4', np.float32)],
+}
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'
+COPY_TRAILER = b'\xff\xff'
+
+
+class BinaryCopyDecoder:
+    # Файловый объект для copy_expert(... TO STDOUT (FORMAT binary)). Строки с
+    # полями фиксированной длины без NULL разбираются сразу в массивы NumPy
+    # структурным dtype, без Python-объекта на строку, и отдаются в emit
+    # кортежами массивов по itersize строк.
+    def __init__(self, types, itersize, emit):
+        fields = [('count', '>i2')]
+        for index, (wire, _) in enumerate(types):
+            fields += [(f'length{index}', '>i4'), (f'value{index}', wire)]
+        self.dtype = np.dtype(fields)
+        self.types = types
+        self.itersize = itersize
+        self.emit = emit
+        # write() вызывается на каждую строку, поэтому он только копит байты, а
+        # разбор идёт в _flush() раз на itersize строк.
+        self._parts = []
+        self._size = 0
+        self._limit = itersize * self.dtype.itemsize
+        self._header = True
+
+    def write(self, data):
+        self._parts.append(data)
+        self._size += len(data)
+        if self._size >= self._limit + (19 if self._header else 0):
+            self._flush()
+
+    def _flush(self):
+        buffer = b''.join(self._parts)
+        if self._header:
+            # Подпись, флаги и длина расширения заголовка, затем само расширение.
+            if len(buffer) < 19:
+                return
+            if buffer[:11] != COPY_SIGNATURE:
+                raise ValueError("Неожиданный заголовок двоичного COPY")
+            start = 19 + int.from_bytes(buffer[15:19], 'big')
+            if len(buffer) < start:
+                return
+            self._header = False
+        else:
+            start = 0
+        count = (len(buffer) - start) // self.dtype.itemsize
+        end = start + count * self.dtype.itemsize
+        self._parts = [buffer[end:]]
+        self._size = len(buffer) - end
+        if not count:
+            return
+        rows = np.frombuffer(buffer, dtype=self.dtype, count=count, offset=start)
+        valid = rows['count'] == len(self.types)
+        for index, (wire, _) in enumerate(self.types):
+            valid &= rows[f'length{index}'] == np.dtype(wire).itemsize
+        if not valid.all():
+            raise ValueError("Двоичный COPY: NULL или поле неожиданной длины")
+        self.emit(tuple(rows[f'value{index}'].astype(target) for index, (_, target) in enumerate(self.types)))
+
+    def close(self):
+        self._flush()
+        if self._header or b''.join(self._parts) != COPY_TRAILER:
+            raise ValueError("Двоичный COPY оборван")
+
+
+class Database:
+    # Ограниченный потокобезопасный пул: соединения открываются по мере надобности,
+    # но не больше maxconn, и после запроса остаются открытыми вместе с
+    # подготовленными запросами. Если все заняты, запрос ждёт до timeout секунд.
+    def __init__(self, maxconn=Config.POOL_SIZE, timeout=30):
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._lock = threading.Lock()
+        self._idle = []
+        self._prepared = {}
+        self._in_use = 0
+        self._waiting = 0
+        self._peak = 0
+        self._acquired = 0
+        self._saturated = 0
+        self._wait_time = 0.0
+        self._cursor_ids = itertools.count()
+
+    def _connect(self):
+        with stage('connect'):
+            conn = psycopg2.connect(database = Config.DATABASE,
+                                    user = Config.USER,
+                                    password = Config.PASSWORD,
+                                    host = Config.HOST)
+        conn.autocommit = True
+        return conn
+
+    @contextmanager
+    def connection(self):
+        started = time.perf_counter()
+        with self._lock:
+            self._waiting += 1
+            if self._in_use >= self.maxconn:
+                self._saturated += 1
+        acquired = self._slots.acquire(timeout=self.timeout)
+        with self._lock:
+            self._waiting -= 1
+            self._wait_time += time.perf_counter() - started
+        if not acquired:
+            raise PoolError(f"Все {self.maxconn} соединений с базой заняты")
+        try:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._in_use += 1
+            self._acquired += 1
+            self._peak = max(self._peak, self._in_use)
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            self._release(conn, broken)
+
+    def _release(self, conn, broken):
+        if not broken and not conn.closed:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        with self._lock:
+            self._in_use -= 1
+            if broken or conn.closed:
+                self._prepared.pop(conn, None)
+            else:
+                self._idle.append(conn)
+        if broken and not conn.closed:
+            conn.close()
+        self._slots.release()
+
+    def execute(self, cursor, name, params=()):
+        with self._lock:
+            prepared = self._prepared.setdefault(cursor.connection, set())
+        if name not in prepared:
+            types, sql = STATEMENTS[name]
+            signature = f"({types})" if types else ""
+            cursor.execute(f"PREPARE {name}{signature} AS {sql}")
+            prepared.add(name)
+        if params:
+            cursor.execute(f"EXECUTE {name}({', '.join(['%s'] * len(params))})", params)
+        else:
+            cursor.execute(f"EXECUTE {name}")
+
+    def fetch(self, name, *params):
+        with self.connection() as conn:
+            with conn.cursor() as cursor:
+                self.execute(cursor, name, params)
+                return cursor.fetchall()
+
+    def stream(self, sql, params=(), itersize=Config.STREAM_ITERSIZE):
+        # Именованный курсор живёт только внутри транзакции, поэтому на время
+        # выборки autocommit выключается. Строки приходят с сервера пачками по
+        # itersize и отдаются списками той же длины.
+        with self.connection() as conn:
+            conn.autocommit = False
+            try:
+                with conn.cursor(name=f"stream_{next(self._cursor_ids)}") as cursor:
+                    cursor.itersize = itersize
+                    cursor.execute(sql, params)
+                    while True:
+                        rows = cursor.fetchmany(itersize)
+                        if not rows:
+                            break
+                        yield rows
+            finally:
+                if not conn.closed:
+                    conn.rollback()
+                    conn.autocommit = True
+
+    def copy_stream(self, sql, params=(), types=(), itersize=Config.STREAM_ITERSIZE):
+        # То же, что stream(), но через COPY (...) TO STDOUT (FORMAT binary): куски
+        # приходят кортежами массивов (см. BinaryCopyDecoder). COPY выполняется в
+        # отдельном потоке и отдаёт куски через очередь не больше чем на два
+        # вперёд; если генератор закрыт раньше конца, запрос отменяется на сервере.
+        with self.connection() as conn:
+            chunks = queue.Queue(maxsize=2)
+            stopped = threading.Event()
+            copying = threading.Event()
+
+            def emit(item):
+                while not stopped.is_set():
+                    try:
+                        chunks.put(item, timeout=0.1)
+                        return
+                    except queue.Full:
+                        pass
+
+            def run():
+                try:
+                    with conn.cursor() as cursor:
+                        query = cursor.mogrify(sql, params).decode()
+                        decoder = BinaryCopyDecoder(types, itersize, emit)
+                        copying.set()
+                        try:
+                            cursor.copy_expert(f"COPY ({query}) TO STDOUT (FORMAT binary)", decoder)
+                        finally:
+                            copying.clear()
+                        decoder.close()
+                except Exception as e:
+                    emit(e)
+                else:
+                    emit(None)
+
+            worker = threading.Thread(target=run, daemon=True)
+            worker.start()
+            try:
+                while True:
+                    item = chunks.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+            finally:
+                stopped.set()
+                if copying.is_set():
+                    conn.cancel()
+                worker.join()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'max': self.maxconn,
+                'in_use': self._in_use,
+                'waiting': self._waiting,
+                'peak': self._peak,
+                'acquired': self._acquired,
+                'saturated': self._saturated,
+                'wait_time': self._wait_time,
+            }
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._prepared.pop(conn, None)
+            conn.close()
+
+
+_database = None
+_database_lock = threading.Lock()
+_inherited = []
+
+
+def get_database():
+    global _database
+    with _database_lock:
+        if _database is None:
+            _database = Database()
+        return _database
+
+
+_calibrations = CalibrationCache()
+_curves = {}
+_catalog = False
+
+
+def forget_connections():
+    # Для дочернего процесса после fork. Соединения родителя здесь нельзя ни
+    # использовать, ни закрывать (закрытие оборвёт сессию и у родителя), поэтому
+    # они только забываются, а процесс при первом запросе откроет свои.
+    # Кэш тарировок, скопированный при fork, остаётся рабочим.
+    global _database, _database_lock
+    _inherited.append(_database)
+    _inherited.append(_calibrations.after_fork())
+    _database = None
+    _database_lock = threading.Lock()
+
+
+def _calibration_fingerprint():
+    return get_database().fetch('calibration_fingerprint')[0]
+
+
+def fetch_calibration(terminal_id):
+    _calibrations.validate(_calibration_fingerprint)
+    calibration = _calibrations.get(terminal_id)
+    if calibration is None:
+        generation = _calibrations.generation
+        with stage('calibration_query') as timer:
+            rows = get_database().fetch('calibration', f'{terminal_id}_%')
+            calibration = CalibrationSet(terminal_id, parse_calibrating_rows(rows))
+            timer.rows = len(calibration.merged)
+        _calibrations.put(terminal_id, calibration, generation)
+    return calibration
+
+
+def warm_calibrations():
+    # Одним запросом загружает в кэш тарировки всех терминалов (пока хватает лимита памяти).
+    _calibrations.validate(_calibration_fingerprint)
+    generation = _calibrations.generation
+    loaded = 0
+    for terminal_id, rows in group_calibrating_rows(get_database().fetch('all_calibrations')).items():
+        try:
+            calibration = CalibrationSet(terminal_id, parse_calibrating_rows(rows))
+        except ValueError:
+            continue
+        if _calibrations.put(terminal_id, calibration, generation):
+            loaded += 1
+    return loaded
+
+
+def calibration_cache_report():
+    stats = _calibrations.stats()
+    return (f"Кэш тарировок: {stats['items']} терминалов, {stats['bytes'] / 1024:.0f} КБ из "
+            f"{stats['max_bytes'] / 2 ** 20:.0f} МБ, попаданий {stats['hits']}, промахов {stats['misses']}, "
+            f"вытеснений {stats['evictions']}, сбросов {stats['invalidations']}")
+
+
+def fetch_window(kind, terminal_id, start_datetime, end_datetime):
+    return get_database().fetch(WINDOW_STATEMENTS[kind], terminal_id,
+                                int(start_datetime.timestamp()), int(end_datetime.timestamp()))
+
+
+def window_watermark(kind, terminal_id, start_datetime, end_datetime, resolution=None):
+    # Отметка данных окна - меняется, если в окно дописали данные. Первый элемент
+    # ложен, если окно пустое. Со справочником terminals это (первая строка окна,
+    # последняя строка, счётчик сообщений терминала[, отметка агрегатов]) и окно
+    # не читается; без справочника - (число строк, последний timestamp[, число
+    # исходных строк]) по всему окну. Корзины, считаемые в базе, строятся по тем
+    # же строкам messages, что и окно целиком.
+    bounds = _bounds(start_datetime, end_datetime, resolution)
+    if _catalog_ready():
+        name = 'window_watermark' if resolution in (None, BUCKETS) else f'{resolution}_watermark'
+        return tuple(get_database().fetch(name, terminal_id, *bounds)[0])
+    return _window_count(kind, terminal_id, bounds, resolution)
+
+
+def _window_count(kind, terminal_id, bounds, resolution):
+    name = COUNT_STATEMENTS[kind] if resolution in (None, BUCKETS) else f'{kind}_{resolution}_count'
+    return tuple(get_database().fetch(name, terminal_id, *bounds)[0])
+
+
+def _bounds(start_datetime, end_datetime, resolution=None):
+    # Границы окна в секундах; для агрегатов начало сдвигается к началу корзины.
+    start, end = int(start_datetime.timestamp()), int(end_datetime.timestamp())
+    if resolution in RESOLUTIONS:
+        start = start // RESOLUTIONS[resolution] * RESOLUTIONS[resolution]
+    return start, end
+
+
+def count_window(kind, terminal_id, start_datetime, end_datetime, resolution=None):
+    return _window_count(kind, terminal_id, _bounds(start_datetime, end_datetime, resolution), resolution)[0]
+
+
+def rollups_available():
+    return get_database().fetch('rollups_available')[0][0]
+
+
+def fetch_rollup(kind, resolution, terminal_id, start_datetime, end_datetime):
+    # Средние по корзинам агрегата: (середины корзин int64, значения float32).
+    width = RESOLUTIONS[resolution]
+    rows = get_database().fetch(f'{kind}_{resolution}', terminal_id, *_bounds(start_datetime, end_datetime, resolution))
+    timestamps = np.fromiter((row[0] + width // 2 for row in rows), dtype=np.int64, count=len(rows))
+    values = np.fromiter((row[1] for row in rows), dtype=np.float32, count=len(rows))
+    return timestamps, values
+
+
+def pushdown_available():
+    return get_database().fetch('pushdown_available')[0][0]
+
+
+def _sync_curve(terminal_id):
+    # Точки тарировки в calibration_curves сверяются с кэшем тарировок по
+    # отпечатку и при расхождении выгружаются заново.
+    calibration = fetch_calibration(terminal_id)
+    if _curves.get(terminal_id) == calibration.digest:
+        return
+    database = get_database()
+    stored = database.fetch('curve_digest', terminal_id)
+    if not stored or stored[0][0] != calibration.digest:
+        with database.connection() as conn:
+            with conn.cursor() as cursor:
+                store_curve(cursor, terminal_id, calibration)
+    _curves[terminal_id] = calibration.digest
+
+
+def fetch_buckets(kind, terminal_id, start_datetime, end_datetime, width):
+    # Средние по корзинам шириной width секунд, посчитанные в базе:
+    # (середины корзин int64, значения float32).
+    if kind == 'fuel':
+        _sync_curve(terminal_id)
+    rows = get_database().fetch(f'{kind}_buckets', terminal_id, int(start_datetime.timestamp()),
+                                int(end_datetime.timestamp()), width)
+    timestamps = np.fromiter((row[0] + width // 2 for row in rows), dtype=np.int64, count=len(rows))
+    values = np.fromiter((row[1] for row in rows), dtype=np.float32, count=len(rows))
+    return timestamps, values
+
+
+def stream_window(kind, terminal_id, start_datetime, end_datetime, itersize=Config.STREAM_ITERSIZE):
+    # Окно выборки кусками: (метки времени int64, значения float32) длиной до itersize.
+    params = (terminal_id, int(start_datetime.timestamp()), int(end_datetime.timestamp()))
+    if Config.BINARY_COPY:
+        # Двоичный COPY сразу в массивы, без кортежа и Python-чисел на строку.
+        yield from get_database().copy_stream(STREAM_QUERIES[kind], params, COPY_TYPES[kind], itersize)
+        return
+    for rows in get_database().stream(STREAM_QUERIES[kind], params, itersize):
+        timestamps = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        values = np.fromiter((row[1] for row in rows), dtype=np.float32, count=len(rows))
+        yield timestamps, values
+
+
+def fetch_events(event_type, terminal_id, start_datetime, end_datetime):
+    # Сохранённые события (events.py) за окно: [(начало, конец, объём)] в секундах
+    # эпохи (event_type None - все типы, [(тип, начало, конец, объём)]) и
+    # отметка, до которой события терминала рассчитаны (None - ещё не считались).
+    database = get_database()
+    bounds = int(start_datetime.timestamp()), int(end_datetime.timestamp())
+    if event_type is None:
+        rows = database.fetch('window_events', terminal_id, *bounds)
+    else:
+        rows = database.fetch('events_window', terminal_id, event_type, *bounds)
+    return rows, event_watermark(terminal_id)
+
+
+def event_watermark(terminal_id):
+    watermark = get_database().fetch('event_watermark', terminal_id)
+    return watermark[0][0] if watermark else None
+
+
+def events_available():
+    return get_database().fetch('events_available')[0][0]
+
+
+def terminal_bounds(terminal_id):
+    # Первое и последнее сообщение терминала в секундах эпохи, (None, None) - сообщений нет.
+    return get_database().fetch('terminal_bounds', terminal_id)[0]
+
+
+def _catalog_ready():
+    # Справочник terminals (catalog.py); на базе без него ID ищутся по messages.
+    global _catalog
+    if not _catalog:
+        _catalog = get_database().fetch('catalog_available')[0][0]
+    return _catalog
+
+
+def fetch_terminal_ids():
+    name = 'terminal_ids' if _catalog_ready() else 'terminal_ids_scan'
+    return [row[0] for row in get_database().fetch(name)]
+
+
+def search_terminals(prefix='', limit=50, offset=0):
+    # Страница справочника по префиксу ID: [(ID, первое, последнее сообщение, число сообщений)]
+    # и общее число подходящих ID. Без справочника - фильтр по полному списку.
+    prefix = prefix.strip()
+    if not _catalog_ready():
+        ids = sorted(terminal_id for terminal_id in fetch_terminal_ids() if terminal_id.startswith(prefix))
+        return [(terminal_id, None, None, None) for terminal_id in ids[offset:offset + limit]], len(ids)
+    lower, upper = prefix_bounds(prefix)
+    database = get_database()
+    rows = database.fetch('terminal_page', lower, upper, limit, offset)
+    return rows, database.fetch('terminal_count', lower, upper)[0][0]
+
+
+def pool_report():
+    stats = get_database().stats()
+    return (f"Пул соединений: занято {stats['in_use']}/{stats['max']}, ждут {stats['waiting']}, "
+            f"пик {stats['peak']}, насыщений {stats['saturated']} из {stats['acquired']}, "
+            f"ожидание {stats['wait_time']:.2f} с")
@@ -0,0 +1,289 @@
+from datetime import timedelta
+import numpy as np
+
+REFUEL = "Заправка"
+DRAIN = "Слив"
+
+THRESHOLD = 10
+RAPID_CHANGE_DURATION = timedelta(minutes=10)
+# Заправка - выход из полосы вверх не позже чем через MAX_EVENT_DURATION после
+# старта. Старт, который дольше этого не вышел из полосы, события уже не
+# начнёт, и на ровном ряду (стоянка) буфер детектора не растёт без предела.
+MAX_EVENT_DURATION = timedelta(days=1)
+
+
+def first_exits(values, threshold, starts):
+    # Для каждой стартовой точки i ищет первое j > i, где |values[j] - values[i]| > threshold.
+    # Поиск идёт по дереву максимумов/минимумов выровненных блоков сразу для всех стартов:
+    # подъём по уровням до блока, в котором есть выход из полосы, затем спуск к листу.
+    # Возвращает индексы выхода (-1, если выхода нет) и признак выхода вверх.
+    values = np.asarray(values, dtype=float)
+    starts = np.asarray(starts, dtype=np.int64)
+    exits = np.full(len(starts), -1, dtype=np.int64)
+    rises = np.zeros(len(starts), dtype=bool)
+    if len(values) < 2 or not len(starts):
+        return exits, rises
+
+    maxima, minima = [values], [values]
+    while len(maxima[-1]) > 1:
+        upper, lower = maxima[-1], minima[-1]
+        if len(upper) % 2:
+            upper = np.append(upper, -np.inf)
+            lower = np.append(lower, np.inf)
+        # fmax/fmin: NaN из полосы не выходит и не должен скрывать выход соседей по блоку.
+        maxima.append(np.fmax(upper[0::2], upper[1::2]))
+        minima.append(np.fmin(lower[0::2], lower[1::2]))
+    sizes = np.array([len(level) for level in maxima], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(sizes)[:-1]))
+    flat_max = np.concatenate(maxima)
+    flat_min = np.concatenate(minima)
+    top = len(maxima) - 1
+
+    # Подъём: от позиции i + 1 проверяются выровненные блоки растущего размера
+    # (блок уровня k берётся, когда в позиции установлен бит k), слева направо.
+    low = bounds_low = values[starts] - threshold
+    high = bounds_high = values[starts] + threshold
+    hit_level = np.full(len(starts), -1, dtype=np.int64)
+    hit_block = np.zeros(len(starts), dtype=np.int64)
+    active = np.arange(len(starts))
+    position = starts + 1
+    for level in range(top + 1):
+        if not len(active):
+            break
+        block = position >> level
+        inside = block < sizes[level]
+        where = offsets[level] + np.minimum(block, sizes[level] - 1)
+        check = inside & (block & 1).astype(bool)
+        hit = check & ((flat_max[where] > high) | (flat_min[where] < low))
+        hit_level[active[hit]] = level
+        hit_block[active[hit]] = block[hit]
+        keep = inside & ~hit
+        active, low, high = active[keep], low[keep], high[keep]
+        position = position[keep] + (check[keep].astype(np.int64) << level)
+
+    # Спуск: в найденном блоке выход есть; берём левого потомка, если выход есть в нём.
+    # Старты упорядочены по уровню, поэтому на каждом шаге спускается префикс массива.
+    found = np.flatnonzero(hit_level >= 0)
+    if not len(found):
+        return exits, rises
+    found = found[np.argsort(-hit_level[found], kind='stable')]
+    depths = -hit_level[found]
+    block = hit_block[found]
+    found_low = bounds_low[found]
+    found_high = bounds_high[found]
+    for level in range(int(-depths[0]), 0, -1):
+        count = np.searchsorted(depths, -level, side='right')
+        child = offsets[level - 1] + block[:count] * 2
+        left = (flat_max[child] > found_high[:count]) | (flat_min[child] < found_low[:count])
+        block[:count] = block[:count] * 2 + (~left)
+    exits[found] = block
+    rises[found] = values[block] > found_high
+    return exits, rises
+
+
+class EventDetector:
+    # Потоковая версия вложенного цикла while i / while j из algdetect.py с теми же
+    # событиями. Для каждого старта i цикл искал первый выход уровня из полосы
+    # smoothed[i] ± threshold, а после заправки/быстрого слива - конец монотонного
+    # участка. Выходы считаются векторно (first_exits), Python-цикл идёт только по событиям.
+    # Отсчёты с начала ещё не закрытого события хранятся до следующих feed().
+    # Старты без выхода (открытые) ждут в группах, отсортированных по значению:
+    # всё, что пришло после них, уже внутри их полосы, поэтому выход ищется
+    # только в новом куске и зависит лишь от значения старта. Вверх из полосы
+    # выходят группы с начала (значение < max куска - threshold), вниз - с конца,
+    # поэтому кусок стоит O(длина куска + вышедшие старты), а не O(весь буфер).
+    # state()/restore() - состояние массивами numpy, чтобы продолжить в другом процессе.
+    def __init__(self, threshold=THRESHOLD, rapid_change_duration=RAPID_CHANGE_DURATION,
+                 max_duration=MAX_EVENT_DURATION):
+        self.threshold = threshold
+        self.rapid_change_duration = rapid_change_duration
+        self.max_duration = max_duration
+        self._offset = 0
+        self._times = None
+        self._values = np.empty(0)
+        self._exits = np.empty(0, dtype=np.int64)
+        self._rises = np.empty(0, dtype=bool)
+        self._open = []
+
+    def feed(self, timestamps, values):
+        times = np.asarray(timestamps)
+        values = np.asarray(values, dtype=float)
+        if self._times is None:
+            self._times = times[:0]
+        base = len(self._values)
+        self._times = np.concatenate((self._times, times))
+        self._values = np.concatenate((self._values, values))
+        exits, rises = first_exits(values, self.threshold, np.arange(len(values)))
+        found = exits >= 0
+        self._exits = np.concatenate((self._exits, np.where(found, exits + base, -1)))
+        self._rises = np.concatenate((self._rises, rises))
+        if len(values):
+            self._resolve(values, base)
+        # Старты с NaN из полосы не выходят никогда, в группы они не попадают.
+        opened = np.flatnonzero(~found & ~np.isnan(values))
+        if len(opened):
+            order = np.argsort(values[opened], kind='stable')
+            self._open.append((values[opened][order], opened[order] + base + self._offset))
+        return self._scan(final=False)
+
+    def _resolve(self, values, base):
+        # Выходы открытых стартов в новом куске values (позиции буфера с base).
+        # Первый выход вверх - первая позиция, где максимум куска с начала
+        # превысил значение + threshold, вниз - где минимум опустился ниже.
+        threshold = self.threshold
+        upper = np.fmax.accumulate(np.where(np.isnan(values), -np.inf, values))
+        lower = np.fmin.accumulate(np.where(np.isnan(values), np.inf, values))
+        top, bottom = upper[-1], lower[-1]
+        groups = []
+        for group_values, positions in self._open:
+            n = len(group_values)
+            up = int(np.searchsorted(group_values, top - threshold, side='left'))
+            while up < n and group_values[up] + threshold < top:
+                up += 1
+            while up > 0 and not group_values[up - 1] + threshold < top:
+                up -= 1
+            down = int(np.searchsorted(group_values, bottom + threshold, side='right'))
+            while down > 0 and group_values[down - 1] - threshold > bottom:
+                down -= 1
+            while down < n and not group_values[down] - threshold > bottom:
+                down += 1
+            if up < down:
+                resolved = np.concatenate((np.arange(up), np.arange(down, n)))
+                groups.append((group_values[up:down], positions[up:down]))
+            else:
+                resolved = np.arange(n)
+            if not len(resolved):
+                continue
+            starts = group_values[resolved]
+            rise_at = np.full(len(resolved), len(values), dtype=np.int64)
+            fall_at = np.full(len(resolved), len(values), dtype=np.int64)
+            rising = resolved < up
+            falling = resolved >= down
+            rise_at[rising] = np.searchsorted(upper, starts[rising] + threshold, side='right')
+            fall_at[falling] = np.searchsorted(-lower, threshold - starts[falling], side='right')
+            index = positions[resolved] - self._offset
+            self._exits[index] = base + np.minimum(rise_at, fall_at)
+            self._rises[index] = rise_at < fall_at
+        self._open = groups
+
+    def finish(self):
+        return self._scan(final=True)
+
+    def state(self):
+        groups = self._open
+        return {
+            'offset': np.int64(self._offset),
+            'fed': np.bool_(self._times is not None),
+            'times': self._times if self._times is not None else np.empty(0, dtype=np.int64),
+            'values': self._values,
+            'exits': self._exits,
+            'rises': self._rises,
+            'open_values': np.concatenate([group[0] for group in groups]) if groups else np.empty(0),
+            'open_positions': np.concatenate([group[1] for group in groups]) if groups else
+            np.empty(0, dtype=np.int64),
+            'open_sizes': np.array([len(group[0]) for group in groups], dtype=np.int64),
+        }
+
+    def restore(self, state):
+        self._offset = int(state['offset'])
+        self._times = np.asarray(state['times']) if state['fed'] else None
+        self._values = np.asarray(state['values'], dtype=float)
+        self._exits = np.asarray(state['exits'], dtype=np.int64)
+        self._rises = np.asarray(state['rises'], dtype=bool)
+        bounds = np.cumsum(state['open_sizes'])[:-1]
+        self._open = list(zip(np.split(np.asarray(state['open_values'], dtype=float), bounds),
+                              np.split(np.asarray(state['open_positions'], dtype=np.int64), bounds))) \
+            if len(state['open_sizes']) else []
+
+    def _rapid(self, durations, limit=None):
+        limit = self.rapid_change_duration if limit is None else limit
+        if isinstance(limit, timedelta):
+            if durations.dtype.kind == 'm':
+                limit = np.timedelta64(limit)
+            elif durations.dtype.kind != 'O':
+                limit = limit.total_seconds()
+        return durations <= limit
+
+    def _scan(self, final):
+        events = []
+        if self._times is None or not len(self._values):
+            return events
+        # Открытый старт старше max_duration от последней точки уже ничего не начнёт.
+        expired = ~self._rapid(self._times[-1] - self._times, self.max_duration)
+        if not final and self._exits[0] < 0 and not expired[0]:
+            # Первый старт ещё открыт - дальше него разбор не продвинется.
+            return events
+        count = len(self._values)
+        exits = self._exits
+        has_exit = exits >= 0
+        timely = np.zeros(count, dtype=bool)
+        candidates = np.flatnonzero(has_exit)
+        durations = self._times[exits[candidates]] - self._times[candidates]
+        timely[candidates] = self._rapid(durations, self.max_duration)
+        rapid = np.zeros(count, dtype=bool)
+        rapid[candidates] = self._rapid(durations)
+        success = has_exit & ((self._rises & timely) | (~self._rises & rapid))
+
+        steps = np.diff(self._values)
+        falls = np.flatnonzero(steps < 0) + 1
+        rises = np.flatnonzero(steps > 0) + 1
+        ends = np.full(count, -1, dtype=np.int64)
+        for mask, turns in ((success & self._rises, falls), (success & ~self._rises, rises)):
+            starts = np.flatnonzero(mask)
+            position = np.searchsorted(turns, exits[starts], side='right')
+            closed = position < len(turns)
+            ends[starts[closed]] = turns[position[closed]]
+
+        emit = success & (ends >= 0)
+        stop = emit if final else emit | (~has_exit & ~expired) | (success & (ends < 0))
+        stops = np.flatnonzero(stop)
+
+        cursor = 0
+        while True:
+            position = np.searchsorted(stops, cursor)
+            if position == len(stops):
+                cursor = count
+                break
+            start = stops[position]
+            if not emit[start]:
+                cursor = start
+                break
+            end = ends[start] - 1
+            volume_change = abs(self._values[end] - self._values[start])
+            if volume_change >= self.threshold:
+                events.append({
+                    'type': REFUEL if self._rises[start] else DRAIN,
+                    'start_time': self._times[start],
+                    'end_time': self._times[end],
+                    'volume_change': volume_change,
+                    'start_index': self._offset + start,
+                    'end_index': self._offset + end,
+                })
+            cursor = ends[start]
+
+        self._offset += cursor
+        self._times = self._times[cursor:]
+        self._values = self._values[cursor:]
+        self._exits = np.where(exits[cursor:] >= 0, exits[cursor:] - cursor, -1)
+        self._rises = self._rises[cursor:]
+        if cursor:
+            # Открытые старты, через которые перешагнуло событие, больше не нужны.
+            groups = []
+            for group_values, positions in self._open:
+                keep = positions >= self._offset
+                if keep.any():
+                    groups.append((group_values[keep], positions[keep]))
+            self._open = groups
+        return events
+
+
+def detect_events(timestamps, values, threshold=THRESHOLD, rapid_change_duration=RAPID_CHANGE_DURATION,
+                  max_duration=MAX_EVENT_DURATION):
+    detector = EventDetector(threshold, rapid_change_duration, max_duration)
+    return detector.feed(timestamps, values) + detector.finish()
+
+
+def event_point(event):
+    if event['type'] == REFUEL:
+        return event['start_time'], event['start_index']
+    return event['end_time'], event['end_index']
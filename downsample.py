@@ -0,0 +1,98 @@
+import numpy as np
+from CONFIG import Config
+
+
+def _numeric(times):
+    times = np.asarray(times)
+    if times.dtype.kind == 'M':
+        return times.astype('datetime64[ms]').astype(np.int64).astype(float)
+    return times.astype(float)
+
+
+def minmax_indices(times, values, points):
+    # M4: в каждом из points // 4 равных по времени интервалов (примерно столбец
+    # пикселей) остаются первая, последняя, минимальная и максимальная точки.
+    # Линия, нарисованная по ним, попиксельно совпадает с линией по всем точкам,
+    # пики и фронты заправок/сливов не срезаются.
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    buckets = max(points // 4, 1)
+    if n <= points:
+        return np.arange(n)
+    seconds = _numeric(times)
+    span = seconds[-1] - seconds[0]
+    if span <= 0:
+        bucket = np.arange(n) * buckets // n
+    else:
+        bucket = np.minimum(((seconds - seconds[0]) / span * buckets).astype(np.int64), buckets - 1)
+    starts = np.flatnonzero(np.r_[True, bucket[1:] != bucket[:-1]])
+    ends = np.r_[starts[1:], n] - 1
+    lengths = ends - starts + 1
+    finite = np.where(np.isfinite(values), values, np.nan)
+    selected = [starts, ends]
+    for reduce in (np.fmin, np.fmax):
+        extreme = np.repeat(reduce.reduceat(finite, starts), lengths)
+        hits = np.flatnonzero(finite == extreme)
+        _, first = np.unique(np.repeat(np.arange(len(starts)), lengths)[hits], return_index=True)
+        selected.append(hits[first])
+    return np.unique(np.concatenate(selected))
+
+
+def lttb_indices(times, values, points):
+    # Largest-Triangle-Three-Buckets: из каждой корзины берётся точка, дающая
+    # наибольший треугольник с уже выбранной точкой и средним следующей корзины.
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    if n <= points or points < 3:
+        return np.arange(n)
+    x = _numeric(times)
+    y = np.where(np.isfinite(values), values, 0.0)
+    edges = np.linspace(1, n - 1, points - 1).astype(np.int64)
+    selected = np.empty(points, dtype=np.int64)
+    selected[0], selected[-1] = 0, n - 1
+    previous = 0
+    for bucket in range(points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_start, next_end = end, edges[bucket + 2] if bucket + 2 < len(edges) else n
+        mean_x = x[next_start:next_end].mean()
+        mean_y = y[next_start:next_end].mean()
+        area = np.abs((x[previous] - mean_x) * (y[start:end] - y[previous])
+                      - (x[previous] - x[start:end]) * (mean_y - y[previous]))
+        previous = start + int(np.argmax(area))
+        selected[bucket + 1] = previous
+    return np.unique(selected)
+
+
+DOWNSAMPLERS = {
+    'minmax': minmax_indices,
+    'lttb': lttb_indices,
+}
+
+
+def downsample(times, values, points=None, method=None, keep=()):
+    # Прореживание ряда перед отрисовкой до бюджета points точек (Config.PLOT_POINTS).
+    # Индексы keep (точки событий) сохраняются всегда. Возвращает (время, значения, индексы).
+    points = Config.PLOT_POINTS if points is None else points
+    method = method or Config.DOWNSAMPLING
+    if method not in DOWNSAMPLERS:
+        raise ValueError(f"Неизвестный метод прореживания: {method}")
+    times = np.asarray(times)
+    values = np.asarray(values)
+    if not points or len(values) <= points:
+        indices = np.arange(len(values))
+    else:
+        indices = DOWNSAMPLERS[method](times, values, points)
+        if len(keep):
+            indices = np.union1d(indices, np.asarray(keep, dtype=np.int64))
+    return times[indices], values[indices], indices
+
+
+def downsample_events(times, values, events, points=None, method=None):
+    # То же для графика топлива: индексы событий переводятся в индексы
+    # прореженного ряда, точки начала и конца событий остаются на своих местах.
+    keep = [event[key] for event in events for key in ('start_index', 'end_index')]
+    times, values, indices = downsample(times, values, points, method, keep)
+    for event in events:
+        for key in ('start_index', 'end_index'):
+            event[key] = int(np.searchsorted(indices, event[key]))
+    return times, values, events
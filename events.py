@@ -0,0 +1,184 @@
+import io
+import json
+from datetime import datetime
+import numpy as np
+import psycopg2
+from CONFIG import Config
+from calibration import load_calibration
+from detection import MAX_EVENT_DURATION, RAPID_CHANGE_DURATION, THRESHOLD, EventDetector
+from smoothing import ROBUST_ITERATIONS, TIME_WINDOW, VERSION, StreamingSmoother
+
+# Заправки и сливы, найденные один раз и сохранённые в таблице events. Для
+# каждого терминала в event_checkpoints хранится отметка watermark (до какого
+# timestamp строки уже обработаны) и состояние сглаживателя и детектора на
+# ней: хвост ряда, ещё не сглаженный окончательно, и начало незакрытого
+# события - массивами numpy в формате .npz, без pickle. Следующий проход читает только строки от отметки и продолжает с
+# того же места, события совпадают с проходом по всему ряду сразу.
+# origin - откуда терминал обрабатывается с первого прохода. Смена тарировки
+# или параметров сглаживания/поиска пересчитывает терминал от origin, сброс
+# отметки (reset_checkpoints) - с указанного момента в rescan; события раньше
+# места, с которого идёт пересчёт, не удаляются.
+START = -2 ** 31
+END = 2 ** 31 - 1
+
+
+def detection_method():
+    # lowess окна не имеет и сглаживает ряд только целиком, для непрерывного потока берётся windowed.
+    return 'windowed' if Config.SMOOTHING == 'lowess' else Config.SMOOTHING
+
+
+def detection_params():
+    return {'method': detection_method(), 'window': Config.SCAN_WINDOW, 'it': ROBUST_ITERATIONS,
+            'time_window': TIME_WINDOW.total_seconds(), 'threshold': THRESHOLD,
+            'rapid_change_duration': RAPID_CHANGE_DURATION.total_seconds(),
+            'max_event_duration': MAX_EVENT_DURATION.total_seconds(), 'smoothing': VERSION}
+
+
+def ensure_event_tables(cursor):
+    cursor.execute("""
+        create table if not exists events (
+            terminal_id text not null,
+            type text not null,
+            start_time integer not null,
+            end_time integer not null,
+            volume double precision not null,
+            primary key (terminal_id, start_time, type)
+        )
+    """)
+    cursor.execute("""
+        create table if not exists event_checkpoints (
+            terminal_id text primary key,
+            watermark integer not null,
+            params text not null,
+            calibration text not null,
+            state bytea not null,
+            updated timestamp without time zone not null,
+            origin integer not null default -2147483648,
+            rescan integer
+        )
+    """)
+    # Отметки, сохранённые до появления origin, пересчитываются с начала истории.
+    cursor.execute("alter table event_checkpoints add column if not exists origin integer not null default -2147483648")
+    cursor.execute("alter table event_checkpoints add column if not exists rescan integer")
+
+
+def new_smoother():
+    # Число строк терминала растёт с каждой загрузкой, а окно продолжаемого
+    # сглаживания меняться не может: оно задано явно, SCAN_WINDOW точек.
+    return StreamingSmoother(detection_method(), window=Config.SCAN_WINDOW)
+
+
+def dump_state(smoother, detector):
+    buffer = io.BytesIO()
+    np.savez(buffer, **{f'smoother_{key}': value for key, value in smoother.state().items()},
+             **{f'detector_{key}': value for key, value in detector.state().items()})
+    return buffer.getvalue()
+
+
+def load_state(blob):
+    # allow_pickle=False: из таблицы читаются только числовые массивы, не объекты.
+    smoother, detector = new_smoother(), EventDetector()
+    with np.load(io.BytesIO(blob), allow_pickle=False) as data:
+        for prefix, target in (('smoother_', smoother), ('detector_', detector)):
+            target.restore({key[len(prefix):]: data[key] for key in data.files if key.startswith(prefix)})
+    return smoother, detector
+
+
+def checkpoints_exist(cursor):
+    cursor.execute("select to_regclass('event_checkpoints') is not null")
+    return cursor.fetchone()[0]
+
+
+def reset_checkpoints(cursor, terminal_id=None, since=None):
+    # Дозагруженные строки старше отметки: терминал будет пересчитан с since
+    # (без since - от origin). Без terminal_id - все терминалы от их origin.
+    since = START if since is None else since
+    if terminal_id is None:
+        cursor.execute("update event_checkpoints set rescan = origin")
+    else:
+        cursor.execute("""
+            update event_checkpoints set rescan = least(coalesce(rescan, watermark), greatest(%s, origin))
+            where terminal_id = %s and watermark > %s
+        """, (since, terminal_id, since))
+
+
+def update_terminal(conn, terminal_id, until=None, since=None, itersize=Config.STREAM_ITERSIZE):
+    # Обрабатывает строки терминала от отметки до until (datetime, по умолчанию
+    # до конца данных) и сохраняет новые события и состояние в одной транзакции.
+    # Терминал без отметки обрабатывается с since (datetime, по умолчанию с
+    # начала истории). Возвращает (обработано строк, новых событий).
+    cursor = conn.cursor()
+    calibration = load_calibration(cursor, terminal_id)
+    params = json.dumps(detection_params(), sort_keys=True)
+    # Отметка не уходит дальше последней строки терминала: строки, которые
+    # ещё придут в окно до until, будут обработаны следующим проходом.
+    cursor.execute("select max(timestamp) from messages where terminal_id = %s", (terminal_id,))
+    last = cursor.fetchone()[0]
+    until = min(END if until is None else int(until.timestamp()), END if last is None else last + 1)
+    cursor.execute("""
+        select watermark, params, calibration, state, origin, rescan from event_checkpoints
+        where terminal_id = %s for update
+    """, (terminal_id,))
+    checkpoint = cursor.fetchone()
+    if checkpoint is None:
+        origin = watermark = START if since is None else int(since.timestamp())
+    elif checkpoint[1] != params or checkpoint[2] != calibration.digest:
+        origin = watermark = checkpoint[4]
+    else:
+        origin, watermark = checkpoint[4], checkpoint[5]
+    if checkpoint is not None and watermark is None:
+        watermark = checkpoint[0]
+        smoother, detector = load_state(checkpoint[3])
+    else:
+        # Пересчёт с watermark: событие, которое идёт через это место, пересчитывается
+        # целиком, события до него остаются.
+        cursor.execute("select min(start_time) from events where terminal_id = %s and end_time >= %s",
+                       (terminal_id, watermark))
+        first = cursor.fetchone()[0]
+        if first is not None and first < watermark:
+            watermark = first
+        origin = min(origin, watermark)
+        smoother, detector = new_smoother(), EventDetector()
+        cursor.execute("delete from events where terminal_id = %s and start_time >= %s", (terminal_id, watermark))
+    if until <= watermark:
+        conn.rollback()
+        cursor.close()
+        return 0, 0
+
+    rows_cursor = conn.cursor(name="event_rows")
+    rows_cursor.itersize = itersize
+    rows_cursor.execute("""
+        select timestamp, lls_0 from messages
+        where terminal_id = %s and timestamp >= %s and timestamp < %s and lls_0 is not null
+        order by timestamp
+    """, (terminal_id, watermark, until))
+    events = []
+    total = 0
+    while True:
+        rows = rows_cursor.fetchmany(itersize)
+        if not rows:
+            break
+        timestamps = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        raw = np.fromiter((row[1] for row in rows), dtype=float, count=len(rows))
+        times, values = smoother.feed(timestamps, calibration(raw))
+        if len(times):
+            events.extend(detector.feed(times, values))
+        total += len(rows)
+    rows_cursor.close()
+
+    cursor.executemany("""
+        insert into events (terminal_id, type, start_time, end_time, volume) values (%s, %s, %s, %s, %s)
+        on conflict (terminal_id, start_time, type) do update set end_time = excluded.end_time, volume = excluded.volume
+    """, [(terminal_id, event['type'], int(event['start_time']), int(event['end_time']),
+           float(event['volume_change'])) for event in events])
+    cursor.execute("""
+        insert into event_checkpoints (terminal_id, watermark, params, calibration, state, updated, origin)
+        values (%s, %s, %s, %s, %s, %s, %s)
+        on conflict (terminal_id) do update set watermark = excluded.watermark, params = excluded.params,
+            calibration = excluded.calibration, state = excluded.state, updated = excluded.updated,
+            origin = excluded.origin, rescan = null
+    """, (terminal_id, until, params, calibration.digest, psycopg2.Binary(dump_state(smoother, detector)),
+          datetime.now(), origin))
+    conn.commit()
+    cursor.close()
+    return total, len(events)
@@ -0,0 +1,222 @@
+import argparse
+import gzip
+import os
+from datetime import datetime
+from pathlib import Path
+import psycopg2
+from CONFIG import Config
+from catalog import ensure_catalog, record_terminals
+from partitions import ensure_partitions, is_partitioned
+from events import checkpoints_exist, reset_checkpoints
+from rollups import refresh_rollups, rollups_exist
+from columnar import drop_months
+
+# Инкрементальная загрузка выгрузок messages (CSV или CSV.gz). Для каждого файла
+# в ingest_state хранится, до какого байта он уже загружен, поэтому повторный
+# запуск на дописанном файле читает только новые строки. Новые строки идут COPY
+# во временную таблицу и переносятся в messages без дубликатов по message_id -
+# всё в одной транзакции на файл.
+PATTERNS = ('*.csv', '*.csv.gz')
+BLOCK = 2 ** 20
+
+
+def ensure_ingest_tables(cursor):
+    cursor.execute("""
+        create table if not exists ingest_state (
+            source text primary key,
+            header text not null,
+            position bigint not null,
+            rows bigint not null,
+            max_message_id numeric,
+            max_timestamp integer,
+            loaded timestamp without time zone not null
+        )
+    """)
+
+
+def open_source(path):
+    with open(path, 'rb') as f:
+        compressed = f.read(2) == b'\x1f\x8b'
+    return gzip.open(path, 'rb') if compressed else open(path, 'rb')
+
+
+def complete_end(f, size):
+    # Конец последней полной строки: хвост дописываемого файла может быть оборван.
+    end = size
+    while end > 0:
+        start = max(end - BLOCK, 0)
+        f.seek(start)
+        newline = f.read(end - start).rfind(b'\n')
+        if newline >= 0:
+            return start + newline + 1
+        end = start
+    return 0
+
+
+class SourceSlice:
+    # Файловый объект для copy_expert: отдаёт байты источника от текущей позиции
+    # до limit (None - до конца) и считает прочитанное.
+    def __init__(self, f, limit=None):
+        self.f = f
+        self.limit = limit
+        self.position = f.tell()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = BLOCK
+        if self.limit is not None:
+            size = min(size, self.limit - self.position)
+            if size <= 0:
+                return b''
+        data = self.f.read(size)
+        self.position += len(data)
+        return data
+
+
+def message_columns(cursor):
+    cursor.execute("""
+        select column_name from information_schema.columns
+        where table_schema = current_schema() and table_name = 'messages' and is_generated = 'NEVER'
+    """)
+    return {row[0] for row in cursor.fetchall()}
+
+
+def ingest_file(conn, path):
+    # Загружает новые строки одного файла. Возвращает (прочитано, добавлено, байт).
+    path = Path(path)
+    source = str(path.resolve())
+    cursor = conn.cursor()
+    with open_source(path) as f:
+        compressed = isinstance(f, gzip.GzipFile)
+        header = f.readline().decode().strip()
+        columns = [column.strip().strip('"') for column in header.split(',')]
+        unknown = set(columns) - message_columns(cursor)
+        if unknown:
+            raise ValueError(f"{path.name}: неизвестные колонки {', '.join(sorted(unknown))}")
+
+        cursor.execute("select header, position from ingest_state where source = %s for update", (source,))
+        state = cursor.fetchone()
+        start = f.tell()
+        if state is not None and state[0] == header:
+            # Файл, ставший короче загруженной части, подменили - он читается заново.
+            if compressed or state[1] <= os.path.getsize(path):
+                start = max(state[1], start)
+        if compressed:
+            # gzip не умеет переходить к позиции, уже загруженное просто пропускается.
+            skip = start - f.tell()
+            while skip > 0:
+                skip -= len(f.read(min(skip, BLOCK)))
+            limit = None
+        else:
+            limit = complete_end(f, os.path.getsize(path))
+            f.seek(start)
+        if limit is not None and start >= limit:
+            conn.rollback()
+            cursor.close()
+            return 0, 0, 0
+
+        cursor.execute("create temporary table ingest_staging (like messages) on commit drop")
+        data = SourceSlice(f, limit)
+        cursor.copy_expert(f"copy ingest_staging ({', '.join(columns)}) from stdin with (format csv)", data)
+        position = data.position
+
+    cursor.execute("select count(*), min(timestamp), max(timestamp), max(message_id) from ingest_staging")
+    read, first_timestamp, last_timestamp, max_message_id = cursor.fetchone()
+    inserted = 0
+    affected = []
+    if read:
+        if Config.PARTITIONED and is_partitioned(cursor):
+            ensure_partitions(cursor, first_timestamp, last_timestamp)
+        cursor.execute("analyze ingest_staging")
+        # Дубликат - строка с той же message_id у того же терминала в тот же момент:
+        # такая проверка идёт по индексу (terminal_id, timestamp) из preparation6.py.
+        # Строки без message_id сравниваются так же: NULL совпадает с NULL.
+        cursor.execute(f"""
+            with inserted as (
+                insert into messages ({', '.join(columns)})
+                select distinct on (s.terminal_id, s.timestamp, s.message_id)
+                    {', '.join('s.' + column for column in columns)}
+                from ingest_staging s
+                where not exists (
+                    select 1 from messages m
+                    where m.terminal_id = s.terminal_id and m.timestamp = s.timestamp
+                      and m.message_id is not distinct from s.message_id
+                )
+                order by s.terminal_id, s.timestamp, s.message_id
+                returning terminal_id, timestamp
+            )
+            select terminal_id, count(*), min(timestamp), max(timestamp) from inserted group by terminal_id
+        """)
+        affected = cursor.fetchall()
+        inserted = sum(row[1] for row in affected)
+        record_terminals(cursor, affected)
+        if affected and rollups_exist(cursor):
+            # Строки старше отметки агрегатов: пересчёт пойдёт с их часа.
+            for terminal_id, _, first, _ in affected:
+                cursor.execute("update rollup_state set watermark = least(watermark, %s) where terminal_id = %s",
+                               (first, terminal_id))
+        if affected and checkpoints_exist(cursor):
+            for terminal_id, _, first, _ in affected:
+                reset_checkpoints(cursor, terminal_id, first)
+        # Колоночный кэш закрытых месяцев, в которые легли новые строки, выгрузится заново.
+        for terminal_id, _, first, _ in affected:
+            drop_months(terminal_id, first)
+
+    cursor.execute("""
+        insert into ingest_state (source, header, position, rows, max_message_id, max_timestamp, loaded)
+        values (%s, %s, %s, %s, %s, %s, %s)
+        on conflict (source) do update set
+            header = excluded.header,
+            position = excluded.position,
+            rows = ingest_state.rows + excluded.rows,
+            max_message_id = greatest(ingest_state.max_message_id, excluded.max_message_id),
+            max_timestamp = greatest(ingest_state.max_timestamp, excluded.max_timestamp),
+            loaded = excluded.loaded
+    """, (source, header, position, inserted, max_message_id, last_timestamp, datetime.now()))
+    conn.commit()
+    if affected and rollups_exist(cursor):
+        refresh_rollups(conn, [row[0] for row in affected])
+    cursor.close()
+    return read, inserted, position - start
+
+
+def source_files(paths):
+    files = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            files.extend(sorted(file for pattern in PATTERNS for file in path.glob(pattern)))
+        else:
+            files.append(path)
+    return files
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Инкрементальная загрузка выгрузок messages (CSV, CSV.gz)")
+    parser.add_argument('paths', nargs='+', help="файлы или каталоги с файлами *.csv, *.csv.gz")
+    args = parser.parse_args()
+    try:
+        conn = psycopg2.connect(database = Config.DATABASE,
+                                      user = Config.USER,
+                                      password = Config.PASSWORD,
+                                      host = Config.HOST)
+        cursor = conn.cursor()
+        ensure_ingest_tables(cursor)
+        ensure_catalog(cursor)
+        conn.commit()
+        cursor.close()
+        for path in source_files(args.paths):
+            try:
+                read, inserted, size = ingest_file(conn, path)
+            except (OSError, EOFError, ValueError, psycopg2.Error) as e:
+                conn.rollback()
+                print(f"Ошибка загрузки {path}: {e}")
+                continue
+            print(f"{path.name}: прочитано строк {read}, добавлено {inserted}, "
+                  f"дубликатов {read - inserted}, {size / 2 ** 20:.1f} МБ")
+        conn.close()
+    except Exception as e:
+        print(f"Ошибка при работе с PostgreSQL: {e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+import contextvars
+import cProfile
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from CONFIG import Config
+
+# Замер этапов запросов бота и GUI. Запрос - трасса (Trace) со списком этапов:
+# имя, секунды, строки. Этапы внутри выборки и расчёта (pipeline.py, db.py)
+# пишутся в текущую трассу потока без передачи её по аргументам. Законченная
+# трасса уходит строкой JSON в METRICS_LOG и в гистограммы в формате
+# Prometheus (METRICS_FILE, при METRICS_PORT - ещё и /metrics по HTTP).
+# Медленные запросы сохраняются целиком в SLOW_TRACE_DIR для разбора.
+# Бот, GUI и algdetect.py пишут каждый свой файл метрик (metrics.<программа>.prom)
+# с меткой program, чтобы не затирать гистограммы друг друга.
+BASE_DIR = Path(__file__).resolve().parent
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+PREFIX = 'datavis'
+PROGRAM = Path(sys.argv[0]).stem.lstrip('-') or 'python'
+
+_current = contextvars.ContextVar('trace', default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f'{name}_sum{{{labels}}} {self.sum:.6f}'
+        yield f'{name}_count{{{labels}}} {self.count}'
+
+
+class Registry:
+    # Гистограммы длительности этапов и запросов и счётчики строк и запросов.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stage_seconds = {}
+        self.stage_rows = {}
+        self.request_seconds = {}
+        self.requests = {}
+
+    def observe_stage(self, name, seconds, rows=None):
+        with self._lock:
+            self.stage_seconds.setdefault(name, Histogram()).observe(seconds)
+            if rows is not None:
+                self.stage_rows[name] = self.stage_rows.get(name, 0) + rows
+
+    def observe_request(self, name, seconds, status):
+        with self._lock:
+            self.request_seconds.setdefault(name, Histogram()).observe(seconds)
+            self.requests[name, status] = self.requests.get((name, status), 0) + 1
+
+    def render(self):
+        program = f'program="{PROGRAM}",'
+        with self._lock:
+            lines = [f'# HELP {PREFIX}_stage_seconds Длительность этапа запроса',
+                     f'# TYPE {PREFIX}_stage_seconds histogram']
+            for name, histogram in sorted(self.stage_seconds.items()):
+                lines.extend(histogram.lines(f'{PREFIX}_stage_seconds', f'{program}stage="{name}"'))
+            lines += [f'# HELP {PREFIX}_stage_rows_total Строк обработано этапом',
+                      f'# TYPE {PREFIX}_stage_rows_total counter']
+            lines.extend(f'{PREFIX}_stage_rows_total{{{program}stage="{name}"}} {rows}'
+                         for name, rows in sorted(self.stage_rows.items()))
+            lines += [f'# HELP {PREFIX}_request_seconds Длительность запроса целиком',
+                      f'# TYPE {PREFIX}_request_seconds histogram']
+            for name, histogram in sorted(self.request_seconds.items()):
+                lines.extend(histogram.lines(f'{PREFIX}_request_seconds', f'{program}request="{name}"'))
+            lines += [f'# HELP {PREFIX}_requests_total Запросов по итогу',
+                      f'# TYPE {PREFIX}_requests_total counter']
+            lines.extend(f'{PREFIX}_requests_total{{{program}request="{name}",status="{status}"}} {count}'
+                         for (name, status), count in sorted(self.requests.items()))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+_log = None
+_log_lock = threading.Lock()
+
+
+def _logger():
+    global _log
+    with _log_lock:
+        if _log is None:
+            path = BASE_DIR / Config.METRICS_LOG
+            path.parent.mkdir(parents=True, exist_ok=True)
+            _log = logging.getLogger('datavis.metrics')
+            _log.setLevel(logging.INFO)
+            _log.propagate = False
+            handler = logging.FileHandler(path, encoding='utf-8')
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            _log.addHandler(handler)
+        return _log
+
+
+class Stage:
+    # Замер этапа. Этап, который выполняется кусками, можно входить в with
+    # много раз: время и строки суммируются, а записывается он один раз в close().
+    def __init__(self, name, rows=None, trace=None):
+        self.name = name
+        self.rows = rows
+        self.seconds = 0.0
+        self.trace = trace if trace is not None else _current.get()
+        self._started = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.seconds += time.perf_counter() - self._started
+        return False
+
+    def add(self, rows):
+        self.rows = (self.rows or 0) + rows
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.add(self.name, self.seconds, self.rows)
+        else:
+            registry.observe_stage(self.name, self.seconds, self.rows)
+
+
+@contextmanager
+def stage(name, rows=None, trace=None):
+    timer = Stage(name, rows, trace)
+    try:
+        with timer:
+            yield timer
+    finally:
+        timer.close()
+
+
+def timed(name, chunks):
+    # Время, проведённое внутри генератора кусков (выборка из базы), отдельно
+    # от обработки кусков потребителем. Строки - по длине первого массива куска.
+    timer = Stage(name)
+    iterator = iter(chunks)
+    try:
+        while True:
+            with timer:
+                chunk = next(iterator, None)
+            if chunk is None:
+                return
+            timer.add(len(chunk[0]))
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        timer.close()
+
+
+class Trace:
+    def __init__(self, request, **fields):
+        self.id = uuid.uuid4().hex[:12]
+        self.request = request
+        self.fields = fields
+        self.stages = []
+        self.started = time.time()
+        self._clock = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def stage(self, name, rows=None):
+        return stage(name, rows, self)
+
+    def add(self, name, seconds, rows=None):
+        with self._lock:
+            self.stages.append({'stage': name, 'seconds': round(seconds, 6), 'rows': rows})
+
+    def extend(self, stages):
+        with self._lock:
+            self.stages.extend(stages)
+
+    def to_dict(self, seconds, status, error=None):
+        record = {'time': datetime.fromtimestamp(self.started).isoformat(timespec='milliseconds'),
+                  'id': self.id, 'request': self.request, 'status': status, 'seconds': round(seconds, 6)}
+        record.update({key: str(value) if isinstance(value, datetime) else value for key, value in self.fields.items()})
+        if error is not None:
+            record['error'] = str(error)
+        record['stages'] = list(self.stages)
+        return record
+
+    def finish(self, status='ok', error=None):
+        # Итог запроса: гистограммы, строка в журнале, файл метрик, медленная трасса.
+        seconds = time.perf_counter() - self._clock
+        with self._lock:
+            for entry in self.stages:
+                registry.observe_stage(entry['stage'], entry['seconds'], entry['rows'])
+        registry.observe_request(self.request, seconds, status)
+        record = self.to_dict(seconds, status, error)
+        try:
+            _logger().info(json.dumps(record, ensure_ascii=False, default=str))
+            if seconds >= Config.SLOW_REQUEST_SECONDS and random.random() < Config.SLOW_TRACE_SAMPLE:
+                directory = BASE_DIR / Config.SLOW_TRACE_DIR
+                directory.mkdir(parents=True, exist_ok=True)
+                (directory / f"{self.id}.json").write_text(json.dumps(record, ensure_ascii=False, indent=2,
+                                                                      default=str))
+            write_metrics()
+        except OSError as e:
+            print(f"Ошибка записи метрик: {e}")
+        return seconds
+
+
+@contextmanager
+def activate(trace):
+    # Делает trace текущей трассой для stage()/timed() в этом потоке.
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def profiled(trace_id):
+    # Доля PROFILE_SAMPLE запросов выполняется под cProfile, профиль сохраняется
+    # в SLOW_TRACE_DIR/<id трассы>.prof, только если запрос оказался медленным.
+    if random.random() >= Config.PROFILE_SAMPLE:
+        yield
+        return
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        if time.perf_counter() - started >= Config.SLOW_REQUEST_SECONDS:
+            directory = BASE_DIR / Config.SLOW_TRACE_DIR
+            directory.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(str(directory / f"{trace_id}.prof"))
+
+
+def metrics_path(program=PROGRAM):
+    # METRICS_FILE с именем программы перед расширением: logs/metrics.tgbotfinal.prom.
+    path = BASE_DIR / Config.METRICS_FILE
+    return path.with_name(f"{path.stem}.{program}{path.suffix}")
+
+
+def write_metrics(path=None):
+    # Файл в формате Prometheus (textfile collector node_exporter), подменяется целиком.
+    path = Path(path or metrics_path())
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temporary = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    temporary.write_text(registry.render())
+    os.replace(temporary, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_metrics(port=None):
+    # HTTP /metrics в фоновом потоке. Возвращает сервер или None, если порт не задан.
+    port = Config.METRICS_PORT if port is None else port
+    if not port:
+        return None
+    server = ThreadingHTTPServer(('', port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
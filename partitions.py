@@ -0,0 +1,130 @@
+import argparse
+import csv
+from datetime import datetime, timezone
+import psycopg2
+from CONFIG import Config
+from catalog import catalog_exists, rebuild_catalog
+
+
+def month_start(moment):
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+
+def next_month(start):
+    return datetime(start.year + start.month // 12, start.month % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+def partition_name(start):
+    return f"messages_{start:%Y_%m}"
+
+
+def parse_month(text):
+    return datetime.strptime(text, '%Y-%m').replace(tzinfo=timezone.utc)
+
+
+def is_partitioned(cursor):
+    cursor.execute("select relkind from pg_class where oid = to_regclass('messages')")
+    row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+
+def ensure_partitions(cursor, first_timestamp, last_timestamp):
+    # Месячные секции messages_YYYY_MM по UTC, покрывающие [first_timestamp, last_timestamp].
+    start = month_start(datetime.fromtimestamp(first_timestamp, timezone.utc))
+    last = datetime.fromtimestamp(last_timestamp, timezone.utc)
+    created = []
+    while start <= last:
+        end = next_month(start)
+        name = partition_name(start)
+        cursor.execute(f"""
+            create table if not exists {name} partition of messages
+            for values from ({int(start.timestamp())}) to ({int(end.timestamp())})
+        """)
+        created.append(name)
+        start = end
+    return created
+
+
+def list_partitions(cursor):
+    cursor.execute("""
+        select child.relname
+        from pg_inherits
+        join pg_class parent on parent.oid = pg_inherits.inhparent
+        join pg_class child on child.oid = pg_inherits.inhrelid
+        where parent.relname = 'messages'
+        order by child.relname
+    """)
+    return [row[0] for row in cursor.fetchall()]
+
+
+def detach_partitions(cursor, before, drop=False):
+    # Отцепляет (и при drop=True удаляет) все месячные секции, целиком лежащие раньше before.
+    detached = []
+    for name in list_partitions(cursor):
+        try:
+            start = datetime.strptime(name, 'messages_%Y_%m').replace(tzinfo=timezone.utc)
+        except ValueError:
+            continue
+        if next_month(start) <= before:
+            cursor.execute(f'alter table messages detach partition {name}')
+            if drop:
+                cursor.execute(f'drop table {name}')
+            detached.append(name)
+    return detached
+
+
+def csv_timestamp_range(csv_path):
+    first = last = None
+    with open(csv_path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        column = next(reader).index('timestamp')
+        for row in reader:
+            if len(row) <= column or not row[column]:
+                continue
+            timestamp = int(float(row[column]))
+            if first is None or timestamp < first:
+                first = timestamp
+            if last is None or timestamp > last:
+                last = timestamp
+    return first, last
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Управление месячными секциями таблицы messages")
+    commands = parser.add_subparsers(dest='command', required=True)
+    create = commands.add_parser('create', help="создать секции за диапазон месяцев")
+    create.add_argument('first', type=parse_month, help="YYYY-MM")
+    create.add_argument('last', type=parse_month, help="YYYY-MM")
+    detach = commands.add_parser('detach', help="отцепить секции старше месяца")
+    detach.add_argument('before', type=parse_month, help="YYYY-MM, первый сохраняемый месяц")
+    detach.add_argument('--drop', action='store_true', help="удалить отцепленные секции")
+    commands.add_parser('list', help="список секций")
+    args = parser.parse_args()
+
+    try:
+        conn = psycopg2.connect(database = Config.DATABASE,
+                                      user = Config.USER,
+                                      password = Config.PASSWORD,
+                                      host = Config.HOST)
+        cursor = conn.cursor()
+        if not is_partitioned(cursor):
+            print("Таблица messages не секционирована")
+        elif args.command == 'create':
+            names = ensure_partitions(cursor, args.first.timestamp(), args.last.timestamp())
+            print(f"Секции: {', '.join(names)}")
+        elif args.command == 'detach':
+            names = detach_partitions(cursor, args.before, args.drop)
+            print(f"Отцеплено секций: {len(names)} {', '.join(names)}")
+            if names and catalog_exists(cursor):
+                rebuild_catalog(cursor)
+        else:
+            print("\n".join(list_partitions(cursor)))
+        conn.commit()
+        cursor.close()
+        conn.close()
+    except Exception as e:
+        print(f"Ошибка при работе с PostgreSQL: {e}")
+
+
+if __name__ == '__main__':
+    main()
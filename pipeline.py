@@ -0,0 +1,260 @@
+from datetime import datetime
+import numpy as np
+from CONFIG import Config
+from db import (count_window, event_watermark, events_available, fetch_buckets, fetch_calibration, fetch_events,
+                fetch_rollup, pushdown_available, rollups_available, stream_window, window_watermark)
+from smoothing import FRAC, MAX_WINDOW, ROBUST_ITERATIONS, TIME_WINDOW, VERSION, StreamingSmoother
+from detection import MAX_EVENT_DURATION, RAPID_CHANGE_DURATION, THRESHOLD, EventDetector
+from plot_cache import plot_key
+from downsample import downsample, downsample_events
+from rollups import choose_resolution
+from pushdown import BUCKETS, bucket_width
+from metrics import Stage, stage, timed
+
+AUTO = 'auto'
+_rollups_ready = False
+_pushdown_ready = False
+_events_ready = False
+
+
+class Cancelled(Exception):
+    # Бросается из колбэка progress, чтобы прервать выборку между кусками.
+    pass
+
+
+def local_times(epochs):
+    # Секунды эпохи в локальное время datetime64[s], как datetime.fromtimestamp,
+    # но без Python-объекта на каждую точку. Смещение считается поэлементно,
+    # только если окно захватывает переход на летнее/зимнее время.
+    epochs = np.asarray(epochs, dtype=np.int64)
+    if not len(epochs):
+        return epochs.astype('datetime64[s]')
+    first, last = int(epochs[0]), int(epochs[-1])
+    offset = datetime.fromtimestamp(first).astimezone().utcoffset()
+    if offset == datetime.fromtimestamp(last).astimezone().utcoffset() and last - first < 86400 * 90:
+        offsets = int(offset.total_seconds())
+    else:
+        offsets = np.fromiter((datetime.fromtimestamp(int(t)).astimezone().utcoffset().total_seconds()
+                               for t in epochs), dtype=np.int64, count=len(epochs))
+    return (epochs + offsets).astype('datetime64[s]')
+
+
+def _collect(chunks, method, count, detector=None):
+    # Потребитель кусков: сглаживание с перекрытием, поиск событий и накопление
+    # ряда для графика в компактных массивах int64/float32.
+    smoother = StreamingSmoother(method, count=count)
+    smoothing, detection = Stage('smoothing'), Stage('detection')
+    times, values, events = [], [], []
+
+    def consume(chunk_times, chunk_values):
+        if not len(chunk_times):
+            return
+        if detector is not None:
+            with detection:
+                events.extend(detector.feed(chunk_times, chunk_values))
+            detection.add(len(chunk_times))
+        times.append(chunk_times)
+        values.append(chunk_values.astype(np.float32))
+
+    for chunk_times, chunk_values in chunks:
+        with smoothing:
+            smoothed = smoother.feed(chunk_times, chunk_values)
+        smoothing.add(len(chunk_times))
+        consume(*smoothed)
+    with smoothing:
+        smoothed = smoother.finish()
+    consume(*smoothed)
+    smoothing.close()
+    if detector is not None:
+        with detection:
+            events.extend(detector.finish())
+        detection.close()
+    for event in events:
+        event['start_time'] = datetime.fromtimestamp(int(event['start_time']))
+        event['end_time'] = datetime.fromtimestamp(int(event['end_time']))
+    if not times:
+        return local_times([]), np.empty(0, dtype=np.float32), events
+    return local_times(np.concatenate(times)), np.concatenate(values), events
+
+
+def _tracked(chunks, count, progress):
+    # Сообщает progress(прочитано строк, всего строк) после каждого куска.
+    # При Cancelled выборка закрывается сразу, и соединение возвращается в пул.
+    done = 0
+    try:
+        for chunk in chunks:
+            done += len(chunk[0])
+            progress(done, count)
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+def _calibrated(chunks, calibration):
+    # Тарировка кусков сырого LLS_0 в литры, замеряется отдельным этапом.
+    timer = Stage('calibration')
+    try:
+        for timestamps, raw in chunks:
+            with timer:
+                litres = calibration(raw)
+            timer.add(len(raw))
+            yield timestamps, litres
+    finally:
+        chunks.close()
+        timer.close()
+
+
+def _fetched(fetch, *args):
+    # Выборка одним запросом (агрегаты, корзины) как единственный кусок.
+    with stage('fetch') as timer:
+        chunk = fetch(*args)
+        timer.rows = len(chunk[0])
+    return [chunk]
+
+
+def window_resolution(start_datetime, end_datetime):
+    # None - читать messages, 'minute'/'hour' - агрегаты, если они уже построены,
+    # 'buckets' - средние по корзинам, посчитанные в базе (Config.PUSHDOWN, pushdown.py).
+    global _rollups_ready, _pushdown_ready
+    resolution = choose_resolution(start_datetime, end_datetime)
+    if resolution is not None:
+        if not _rollups_ready:
+            _rollups_ready = rollups_available()
+        if _rollups_ready:
+            return resolution
+    if Config.PUSHDOWN:
+        if not _pushdown_ready:
+            _pushdown_ready = pushdown_available()
+        if _pushdown_ready:
+            return BUCKETS
+    return None
+
+
+def detects_events(resolution):
+    # По исходным строкам события ищутся на лету. У агрегатов между точками
+    # минута или час, у корзин - от 10 минут на окнах длиннее двух недель, а
+    # слив должен уложиться в RAPID_CHANGE_DURATION, поэтому по ним события не
+    # ищутся, а берутся из таблицы events (scan.py).
+    return resolution is None
+
+
+def _event_watermark(terminal_id):
+    global _events_ready
+    if not _events_ready:
+        _events_ready = events_available()
+    return event_watermark(terminal_id) if _events_ready else None
+
+
+def stored_events(terminal_id, start_datetime, end_datetime, times):
+    # События окна из таблицы events в формате EventDetector, индексы - точки
+    # ряда times (локальное время datetime64), ближайшие к началу и концу события.
+    if not len(times) or _event_watermark(terminal_id) is None:
+        return []
+    with stage('events_query') as timer:
+        rows, _ = fetch_events(None, terminal_id, start_datetime, end_datetime)
+        timer.rows = len(rows)
+    bounds = local_times(np.array([row[1:3] for row in rows], dtype=np.int64).ravel())
+    starts = np.minimum(np.searchsorted(times, bounds[0::2]), len(times) - 1)
+    ends = np.maximum(np.searchsorted(times, bounds[1::2], side='right') - 1, 0)
+    return [{'type': event_type, 'start_time': datetime.fromtimestamp(start), 'end_time': datetime.fromtimestamp(end),
+             'volume_change': volume, 'start_index': int(start_index), 'end_index': int(end_index)}
+            for (event_type, start, end, volume), start_index, end_index in zip(rows, starts, ends)]
+
+
+def events_note(terminal_id, end_datetime, resolution):
+    # Подпись к графику топлива, если события взяты из таблицы events и
+    # рассчитаны не на всё окно. None - подпись не нужна.
+    if detects_events(resolution):
+        return None
+    watermark = _event_watermark(terminal_id)
+    if watermark is None:
+        return "События не рассчитаны (scan.py)"
+    if watermark <= end_datetime.timestamp():
+        return f"События рассчитаны по {datetime.fromtimestamp(watermark):%d.%m.%Y %H:%M}"
+    return None
+
+
+def _resolve(resolution, start_datetime, end_datetime):
+    return window_resolution(start_datetime, end_datetime) if resolution == AUTO else resolution
+
+
+def series_params(kind, method=None):
+    # Всё, от чего зависит результат, кроме самих данных: метод и параметры сглаживания и поиска событий.
+    params = {'method': method or Config.SMOOTHING, 'frac': FRAC, 'max_window': MAX_WINDOW,
+              'it': ROBUST_ITERATIONS, 'time_window': TIME_WINDOW.total_seconds(),
+              'points': Config.PLOT_POINTS, 'downsampling': Config.DOWNSAMPLING, 'smoothing': VERSION}
+    if kind == 'fuel':
+        params.update(threshold=THRESHOLD, rapid_change_duration=RAPID_CHANGE_DURATION.total_seconds(),
+                      max_event_duration=MAX_EVENT_DURATION.total_seconds())
+    return params
+
+
+def series_key(kind, terminal_id, start_datetime, end_datetime, method=None, resolution=AUTO):
+    # Ключ кэша графика, есть ли в окне данные и выбранное разрешение. Для топлива
+    # в ключ входит и отпечаток тарировки терминала (берётся из кэша тарировок).
+    # Строки окна не считаются: число строк нужно только при построении графика.
+    resolution = _resolve(resolution, start_datetime, end_datetime)
+    watermark = window_watermark(kind, terminal_id, start_datetime, end_datetime, resolution)
+    present = bool(watermark[0])
+    if kind == 'fuel' and present:
+        watermark += (fetch_calibration(terminal_id).digest,)
+        if not detects_events(resolution):
+            watermark += (_event_watermark(terminal_id),)
+    params = dict(series_params(kind, method), resolution=resolution)
+    if resolution == BUCKETS:
+        params['buckets'] = Config.PUSHDOWN_BUCKETS
+    key = plot_key(kind, terminal_id, start_datetime, end_datetime, params, watermark)
+    return key, present, resolution
+
+
+def fuel_series(terminal_id, start_datetime, end_datetime, method=None, count=None, points=None, resolution=AUTO,
+                progress=None):
+    # Калибровка, сглаживание и события по окну, прочитанному кусками по
+    # Config.STREAM_ITERSIZE строк. Возвращает (время, литры, события), ряд
+    # прорежен до points точек (Config.PLOT_POINTS, 0 - без прореживания).
+    # Для длинных окон берутся средние литры из агрегатов или корзин, посчитанных
+    # в базе (см. window_resolution), а события для них - из таблицы events.
+    # progress(прочитано, всего) вызывается после каждого куска и может бросить Cancelled.
+    resolution = _resolve(resolution, start_datetime, end_datetime)
+    if count is None:
+        count = count_window('fuel', terminal_id, start_datetime, end_datetime, resolution)
+    if resolution == BUCKETS:
+        chunks = _fetched(fetch_buckets, 'fuel', terminal_id, start_datetime, end_datetime,
+                          bucket_width(start_datetime, end_datetime))
+        count = len(chunks[0][0])
+    elif resolution is not None:
+        chunks = _fetched(fetch_rollup, 'fuel', resolution, terminal_id, start_datetime, end_datetime)
+    else:
+        calibration = fetch_calibration(terminal_id)
+        chunks = _calibrated(timed('fetch', stream_window('fuel', terminal_id, start_datetime, end_datetime)),
+                             calibration)
+    if progress is not None:
+        chunks = _tracked(chunks, count, progress)
+    detector = EventDetector() if detects_events(resolution) else None
+    series = _collect(chunks, method or Config.SMOOTHING, count, detector)
+    if detector is None:
+        series = series[:2] + (stored_events(terminal_id, start_datetime, end_datetime, series[0]),)
+    with stage('downsample'):
+        return downsample_events(*series, points)
+
+
+def speed_series(terminal_id, start_datetime, end_datetime, method=None, count=None, points=None, resolution=AUTO,
+                 progress=None):
+    resolution = _resolve(resolution, start_datetime, end_datetime)
+    if count is None:
+        count = count_window('speed', terminal_id, start_datetime, end_datetime, resolution)
+    if resolution == BUCKETS:
+        chunks = _fetched(fetch_buckets, 'speed', terminal_id, start_datetime, end_datetime,
+                          bucket_width(start_datetime, end_datetime))
+        count = len(chunks[0][0])
+    elif resolution is not None:
+        chunks = _fetched(fetch_rollup, 'speed', resolution, terminal_id, start_datetime, end_datetime)
+    else:
+        chunks = timed('fetch', stream_window('speed', terminal_id, start_datetime, end_datetime))
+    if progress is not None:
+        chunks = _tracked(chunks, count, progress)
+    times, values, _ = _collect(chunks, method or Config.SMOOTHING, count)
+    with stage('downsample'):
+        times, values, _ = downsample(times, values, points)
+    return times, values
@@ -0,0 +1,124 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from CONFIG import Config
+
+BASE_DIR = Path(__file__).resolve().parent
+
+
+def plot_key(kind, terminal_id, start_datetime, end_datetime, params, watermark):
+    # Ключ готового графика: вид, терминал, окно, параметры сглаживания/поиска
+    # событий и отметка данных окна (см. db.window_watermark).
+    # Новые строки в окне меняют отметку, и старый график больше не находится.
+    payload = json.dumps([kind, str(terminal_id), start_datetime.isoformat(), end_datetime.isoformat(),
+                          params, [str(part) for part in watermark]], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def _encode_event(event):
+    return {key: value.isoformat() if isinstance(value, datetime) else
+            value.item() if hasattr(value, 'item') else value
+            for key, value in event.items()}
+
+
+def _decode_event(event):
+    for key in ('start_time', 'end_time'):
+        if key in event:
+            event[key] = datetime.fromisoformat(event[key])
+    return event
+
+
+class PlotCache:
+    # Дисковый кэш графиков бота: PNG и найденные события в каталоге directory,
+    # переживает перезапуск. Записи старше ttl секунд не отдаются, при
+    # превышении max_bytes удаляются давно не читавшиеся (по mtime).
+    def __init__(self, directory=None, max_bytes=Config.PLOT_CACHE_MB * 2 ** 20, ttl=Config.PLOT_CACHE_TTL):
+        self.directory = Path(directory or BASE_DIR / Config.PLOT_CACHE_DIR)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _paths(self, key):
+        return self.directory / f"{key}.png", self.directory / f"{key}.json"
+
+    def get(self, key):
+        image_path, meta_path = self._paths(key)
+        try:
+            meta = json.loads(meta_path.read_text())
+            image = image_path.read_bytes()
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        if time.time() - meta.get('created', 0) > self.ttl:
+            self._remove(key)
+            self.misses += 1
+            return None
+        now = time.time()
+        for path in (image_path, meta_path):
+            try:
+                os.utime(path, (now, now))
+            except OSError:
+                pass
+        self.hits += 1
+        return image, [_decode_event(event) for event in meta['events']]
+
+    def put(self, key, image, events=()):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        image_path, meta_path = self._paths(key)
+        meta = {'created': time.time(), 'events': [_encode_event(event) for event in events]}
+        for path, data in ((image_path, image), (meta_path, json.dumps(meta, ensure_ascii=False).encode())):
+            temporary = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+            temporary.write_bytes(data)
+            os.replace(temporary, path)
+        self.prune()
+
+    def _remove(self, key):
+        for path in self._paths(key):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+
+    def prune(self):
+        # Удаляет записи, которые не читались дольше ttl (они точно просрочены),
+        # и, пока каталог больше max_bytes, самые давно читавшиеся.
+        with self._lock:
+            entries = {}
+            for path in self.directory.glob('*.*'):
+                try:
+                    stat = path.stat()
+                except OSError:
+                    continue
+                key = path.name.split('.')[0]
+                size, used = entries.get(key, (0, 0))
+                entries[key] = (size + stat.st_size, max(used, stat.st_mtime))
+            now = time.time()
+            total = 0
+            for key, (size, used) in list(entries.items()):
+                if now - used > self.ttl:
+                    self._remove(key)
+                    del entries[key]
+                else:
+                    total += size
+            for key, (size, _) in sorted(entries.items(), key=lambda item: item[1][1]):
+                if total <= self.max_bytes:
+                    break
+                self._remove(key)
+                total -= size
+
+    def clear(self):
+        with self._lock:
+            for path in self.directory.glob('*.*'):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+
+    def report(self):
+        return f"Кэш графиков: попаданий {self.hits}, промахов {self.misses}"
@@ -1,12 +1,18 @@
 import psycopg2
 from CONFIG import Config
+
+COLUMNS = 'message_id numeric, track_id numeric, terminal_id text, lat double precision, lon double precision, timestamp integer, speed integer, course integer, voltage real, motion integer, alt real, source text, ignition integer, odometer integer, satellites integer, gsmlevel integer, sensors jsonb, externals jsonb, outputs jsonb, can_data jsonb, temperature jsonb, created timestamp without time zone'
+
 try:
     conn = psycopg2.connect(database = Config.DATABASE,
                                   user = Config.USER,
                                   password = Config.PASSWORD,
                                   host = Config.HOST)
     cursor = conn.cursor()
-    sql = 'create table messages(message_id numeric, track_id numeric, terminal_id text, lat double precision, lon double precision, timestamp integer, speed integer, course integer, voltage real, motion integer, alt real, source text, ignition integer, odometer integer, satellites integer, gsmlevel integer, sensors json, externals json, outputs json, can_data json, temperature json, created timestamp without time zone);'
+    if Config.PARTITIONED:
+        sql = f'create table messages({COLUMNS}) partition by range (timestamp);'
+    else:
+        sql = f'create table messages({COLUMNS});'
     cursor.execute(sql)
     conn.commit()
 except Exception as e:
@@ -1,20 +1,10 @@
-import psycopg2
 from pathlib import Path
-from CONFIG import Config
+from bulk_load import load
 
 BASE_DIR = Path(__file__).resolve().parent
 csv_path = BASE_DIR / "data" / "test.csv" 
 try:
-    conn = psycopg2.connect(database = Config.DATABASE,
-                                  user = Config.USER,
-                                  password = Config.PASSWORD,
-                                  host = Config.HOST)
-    cursor = conn.cursor()
-    with open(csv_path, 'r') as f:
-        cursor.copy_expert(f'''copy messages from STDIN delimiter ',' csv header''', f)
-    conn.commit()
+    # Параллельная загрузка с отказами вместо ошибки на весь файл, см. bulk_load.py.
+    load([csv_path])
 except Exception as e:
-    print(f"Ошибка при работе с PostgreSQL: {e}")
-
-cursor.close()
-conn.close()
\ No newline at end of file
+    print(f"Ошибка при работе с PostgreSQL: {e}")
\ No newline at end of file
@@ -6,7 +6,7 @@ try:
                                   password = Config.PASSWORD,
                                   host = Config.HOST)
     cursor = conn.cursor()
-    sql = 'create table calibrating(id integer not null, deviceid_port text, calibrating_data json);'
+    sql = 'create table calibrating(id integer not null, deviceid_port text, calibrating_data jsonb);'
     cursor.execute(sql)
     conn.commit()
 except Exception as e:
@@ -1,6 +1,8 @@
 import psycopg2
 from pathlib import Path
 from CONFIG import Config
+from events import checkpoints_exist, reset_checkpoints
+from rollups import refresh_rollups, rollups_exist
 
 BASE_DIR = Path(__file__).resolve().parent
 csv_path = BASE_DIR / "data" / "calib2.csv" 
@@ -12,7 +14,12 @@ try:
     cursor = conn.cursor()
     with open(csv_path, 'r') as f:
         cursor.copy_expert(f'''copy calibrating from STDIN delimiter ',' csv header''', f)
+    cursor.execute('notify calibrating_changed')
+    if checkpoints_exist(cursor):
+        reset_checkpoints(cursor)
     conn.commit()
+    if rollups_exist(cursor):
+        print(f"Агрегаты обновлены, обработано строк: {refresh_rollups(conn)}")
 except Exception as e:
     print(f"Ошибка при работе с PostgreSQL: {e}")
 
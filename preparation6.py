@@ -0,0 +1,58 @@
+import psycopg2
+from CONFIG import Config
+
+JSON_COLUMNS = {
+    'messages': ['sensors', 'externals', 'outputs', 'can_data', 'temperature'],
+    'calibrating': ['calibrating_data'],
+}
+# Порядок не длиннее трёх цифр: проверка диапазона через numeric ниже не переполнится.
+NUMBER_PATTERN = r'^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]{1,3})?\s*$'
+
+try:
+    conn = psycopg2.connect(database = Config.DATABASE,
+                                  user = Config.USER,
+                                  password = Config.PASSWORD,
+                                  host = Config.HOST)
+    cursor = conn.cursor()
+    for table, columns in JSON_COLUMNS.items():
+        cursor.execute("""
+            select column_name from information_schema.columns
+            where table_schema = current_schema() and table_name = %s and data_type = 'json'
+        """, (table,))
+        json_columns = [row[0] for row in cursor.fetchall() if row[0] in columns]
+        if json_columns:
+            alters = ', '.join(f'alter column {column} type jsonb using {column}::jsonb' for column in json_columns)
+            cursor.execute(f'alter table {table} {alters}')
+            print(f"Таблица {table}: {', '.join(json_columns)} переведены в jsonb")
+
+    # Строка, похожая на число, может не поместиться в double precision (1e999):
+    # такое значение даёт NULL, а не ошибку всего ALTER. Диапазон проверяется
+    # регуляркой, длиной и сравнением в numeric, без блока exception: он открывал
+    # подтранзакцию на каждую строку. Функция на sql без strict встраивается в
+    # выражение столбца, число без порядка до 64 знаков всегда в диапазоне.
+    cursor.execute("""
+        create or replace function lls_number(value text)
+        returns double precision language sql immutable parallel safe as $$
+            select case
+                when length(value) > 64 or value !~ %s then null
+                when strpos(value, 'e') = 0 and strpos(value, 'E') = 0 then value::double precision
+                when abs(value::numeric) > 1.7976931348623157e308 then null
+                when value::numeric <> 0 and abs(value::numeric) < 2.2250738585072014e-308 then null
+                else value::double precision
+            end
+        $$
+    """, (NUMBER_PATTERN,))
+    cursor.execute("""
+        alter table messages add column if not exists lls_0 double precision
+        generated always as (lls_number(can_data->>'LLS_0')) stored
+    """)
+    cursor.execute('create index if not exists messages_terminal_id_timestamp_idx on messages (terminal_id, timestamp)')
+    conn.commit()
+    cursor.execute('analyze messages')
+    conn.commit()
+    print("Миграция таблицы messages выполнена")
+except Exception as e:
+    print(f"Ошибка при работе с PostgreSQL: {e}")
+
+cursor.close()
+conn.close()
@@ -0,0 +1,108 @@
+import argparse
+import numpy as np
+import psycopg2
+from CONFIG import Config
+from calibration import CalibrationSet, group_calibrating_rows, parse_calibrating_rows
+
+# Тарировка и усреднение по корзинам на стороне PostgreSQL. Функция
+# calibrate_lls повторяет Calibration.__call__ (кусочно-линейная интерполяция
+# с экстраполяцией крайними отрезками) по точкам терминала из таблицы
+# calibration_curves, а окно графика возвращается средними по корзинам в
+# N секунд - по сети идут несколько тысяч строк вместо всех сообщений.
+# Точки в calibration_curves - объединённая тарировка CalibrationSet, уже
+# отсортированная, поэтому результат совпадает с расчётом в Python.
+BUCKETS = 'buckets'
+
+
+def ensure_pushdown(cursor):
+    cursor.execute("""
+        create table if not exists calibration_curves (
+            terminal_id text primary key,
+            xs double precision[] not null,
+            ys double precision[] not null,
+            bounds double precision[] not null,
+            digest text not null
+        )
+    """)
+    # bounds - точки с обратным знаком в обратном порядке: width_bucket(-raw, bounds)
+    # считает точки >= raw, то есть даёт тот же отрезок, что np.searchsorted(xs, raw).
+    # Совпадающие x дают, как в NumPy, бесконечность или NaN, а не ошибку деления на ноль.
+    cursor.execute("""
+        create or replace function calibrate_lls(xs double precision[], ys double precision[],
+                                                 bounds double precision[], raw double precision)
+        returns double precision language plpgsql immutable strict parallel safe as $$
+        declare
+            n integer := array_length(xs, 1);
+            i integer := greatest(least(n - width_bucket(-raw, bounds) + 1, n), 2);
+        begin
+            if xs[i] = xs[i - 1] then
+                if ys[i] = ys[i - 1] or raw = xs[i - 1] then
+                    return 'NaN';
+                end if;
+                return 'Infinity'::double precision * sign(ys[i] - ys[i - 1]) * sign(raw - xs[i - 1]);
+            end if;
+            return (ys[i] - ys[i - 1]) / (xs[i] - xs[i - 1]) * (raw - xs[i - 1]) + ys[i - 1];
+        end
+        $$
+    """)
+
+
+def pushdown_exists(cursor):
+    cursor.execute("select to_regclass('calibration_curves') is not null")
+    return cursor.fetchone()[0]
+
+
+def store_curve(cursor, terminal_id, calibration):
+    curve = calibration.merged
+    cursor.execute("""
+        insert into calibration_curves (terminal_id, xs, ys, bounds, digest) values (%s, %s, %s, %s, %s)
+        on conflict (terminal_id) do update set xs = excluded.xs, ys = excluded.ys, bounds = excluded.bounds,
+            digest = excluded.digest
+    """, (terminal_id, curve.x.tolist(), curve.y.tolist(), (-curve.x[::-1]).tolist(), calibration.digest))
+
+
+def bucket_width(start_datetime, end_datetime, buckets=None):
+    # Ширина корзины в секундах, чтобы окно уложилось в buckets корзин.
+    buckets = buckets or Config.PUSHDOWN_BUCKETS
+    return max(int(np.ceil((end_datetime - start_datetime).total_seconds() / buckets)), 1)
+
+
+def store_all_curves(cursor):
+    # Выгружает тарировки всех терминалов из calibrating. Возвращает (выгружено, пропущено).
+    cursor.execute("select deviceid_port, calibrating_data from calibrating order by id")
+    stored = skipped = 0
+    for terminal_id, rows in group_calibrating_rows(cursor.fetchall()).items():
+        try:
+            calibration = CalibrationSet(terminal_id, parse_calibrating_rows(rows))
+        except ValueError:
+            skipped += 1
+            continue
+        store_curve(cursor, terminal_id, calibration)
+        stored += 1
+    cursor.execute("""
+        delete from calibration_curves c where not exists (
+            select 1 from calibrating where deviceid_port like c.terminal_id || '_%%')
+    """)
+    return stored, skipped
+
+
+def main():
+    argparse.ArgumentParser(description="Установка функции calibrate_lls и выгрузка точек тарировки в базу").parse_args()
+    try:
+        conn = psycopg2.connect(database = Config.DATABASE,
+                                      user = Config.USER,
+                                      password = Config.PASSWORD,
+                                      host = Config.HOST)
+        cursor = conn.cursor()
+        ensure_pushdown(cursor)
+        stored, skipped = store_all_curves(cursor)
+        conn.commit()
+        print(f"Функция calibrate_lls установлена, тарировок выгружено: {stored}, без тарировки: {skipped}")
+        cursor.close()
+        conn.close()
+    except Exception as e:
+        print(f"Ошибка при работе с PostgreSQL: {e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+import io
+import threading
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from detection import REFUEL, event_point
+
+FIGSIZE = (10, 6)
+DPI = 100
+
+TEMPLATES = {
+    'fuel': {
+        'label': "Остаток топлива в баке",
+        'ylabel': "Остаток топлива (л)",
+        'title': "Остаток топлива для ID: {terminal_id}",
+    },
+    'speed': {
+        'label': "Скорость",
+        'ylabel': "Скорость (км/ч)",
+        'title': "Скорость для ID: {terminal_id}",
+    },
+}
+
+EVENT_COLORS = {REFUEL: "green"}
+DEFAULT_EVENT_COLOR = "red"
+
+
+def annotation_style(event_type):
+    color = EVENT_COLORS.get(event_type, DEFAULT_EVENT_COLOR)
+    return {
+        'bbox': dict(boxstyle="round,pad=0.3", edgecolor=color, facecolor="white"),
+        'arrowprops': dict(arrowstyle="->", color=color),
+        'fontsize': 10,
+    }
+
+
+class FigureTemplate:
+    # Заготовка графика одного вида: Figure с холстом Agg и осями, без pyplot и
+    # его глобального состояния. Между запросами фигура не пересоздаётся, а
+    # только очищается, поэтому память и время отрисовки не растут под нагрузкой.
+    # Одна заготовка используется одним потоком (см. template()).
+    def __init__(self, kind, figsize=FIGSIZE, dpi=DPI):
+        self.kind = kind
+        self.settings = TEMPLATES[kind]
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.axes = self.figure.add_subplot()
+
+    def prepare(self, terminal_id):
+        self.axes.clear()
+        self.axes.set_xlabel("Время")
+        self.axes.set_ylabel(self.settings['ylabel'])
+        self.axes.set_title(self.settings['title'].format(terminal_id=terminal_id))
+        return self.axes
+
+    def render(self):
+        self.axes.legend()
+        self.axes.grid()
+        buffer = io.BytesIO()
+        self.figure.savefig(buffer, format='png')
+        return buffer.getvalue()
+
+
+_local = threading.local()
+
+
+def template(kind):
+    templates = getattr(_local, 'templates', None)
+    if templates is None:
+        templates = _local.templates = {}
+    if kind not in templates:
+        templates[kind] = FigureTemplate(kind)
+    return templates[kind]
+
+
+def render_fuel(terminal_id, timestamps, values, events=(), note=None):
+    plot = template('fuel')
+    axes = plot.prepare(terminal_id)
+    axes.plot(timestamps, values, label=plot.settings['label'])
+    if note:
+        axes.text(0.01, 0.01, note, transform=axes.transAxes, fontsize=8, color='gray')
+    for event in events:
+        event_time, event_index = event_point(event)
+        event_volume = values[event_index]
+        axes.annotate(
+            f"{event['type']}: {event['volume_change']:.0f} л",
+            xy=(event_time, event_volume),
+            xytext=(event_time, event_volume + 20),
+            **annotation_style(event['type'])
+        )
+    return plot.render()
+
+
+def render_speed(terminal_id, timestamps, values):
+    plot = template('speed')
+    axes = plot.prepare(terminal_id)
+    axes.plot(timestamps, values, label=plot.settings['label'])
+    return plot.render()
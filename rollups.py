@@ -0,0 +1,207 @@
+import argparse
+import io
+from datetime import timedelta
+import numpy as np
+import psycopg2
+from CONFIG import Config
+from calibration import load_calibration
+from catalog import catalog_exists
+
+# Агрегаты по терминалу за минуту и за час: литры (min/max/среднее по
+# тарированному LLS_0), скорость (среднее/максимум) и число строк.
+RESOLUTIONS = {'minute': 60, 'hour': 3600}
+COLUMNS = ['terminal_id', 'bucket', 'samples', 'fuel_samples', 'fuel_min', 'fuel_max', 'fuel_mean',
+           'speed_samples', 'speed_mean', 'speed_max']
+
+
+def table_name(resolution):
+    return f"rollup_{resolution}"
+
+
+def choose_resolution(start_datetime, end_datetime):
+    # Длинные окна читаются из агрегатов: от ROLLUP_MINUTE_AFTER_DAYS дней -
+    # поминутных, от ROLLUP_HOUR_AFTER_DAYS - почасовых. Короткие - из messages.
+    window = end_datetime - start_datetime
+    if window >= timedelta(days=Config.ROLLUP_HOUR_AFTER_DAYS):
+        return 'hour'
+    if window >= timedelta(days=Config.ROLLUP_MINUTE_AFTER_DAYS):
+        return 'minute'
+    return None
+
+
+def ensure_rollup_tables(cursor):
+    for resolution in RESOLUTIONS:
+        cursor.execute(f"""
+            create table if not exists {table_name(resolution)} (
+                terminal_id text not null,
+                bucket integer not null,
+                samples integer not null,
+                fuel_samples integer not null,
+                fuel_min double precision,
+                fuel_max double precision,
+                fuel_mean double precision,
+                speed_samples integer not null,
+                speed_mean double precision,
+                speed_max double precision,
+                primary key (terminal_id, bucket)
+            )
+        """)
+    cursor.execute("""
+        create table if not exists rollup_state (
+            terminal_id text primary key,
+            watermark integer not null,
+            calibration text
+        )
+    """)
+
+
+def rollups_exist(cursor):
+    cursor.execute("select to_regclass('rollup_state') is not null")
+    return cursor.fetchone()[0]
+
+
+def aggregate(timestamps, fuel, speed, width):
+    # Агрегаты по корзинам шириной width секунд для отсортированных по времени строк.
+    # fuel и speed - float-массивы, пропуски - NaN.
+    buckets = timestamps // width * width
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    rows = {'bucket': buckets[starts], 'samples': np.diff(np.r_[starts, len(buckets)])}
+    for name, values in (('fuel', fuel), ('speed', speed)):
+        present = np.isfinite(values)
+        counts = np.add.reduceat(present.astype(np.int64), starts)
+        sums = np.add.reduceat(np.where(present, values, 0.0), starts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            rows[f'{name}_samples'] = counts
+            rows[f'{name}_mean'] = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+            rows[f'{name}_max'] = np.fmax.reduceat(np.where(present, values, np.nan), starts)
+            if name == 'fuel':
+                rows['fuel_min'] = np.fmin.reduceat(np.where(present, values, np.nan), starts)
+    return rows
+
+
+def _copy_rows(cursor, resolution, terminal_id, rows):
+    buffer = io.StringIO()
+    for i in range(len(rows['bucket'])):
+        line = []
+        for column in COLUMNS:
+            if column == 'terminal_id':
+                line.append(terminal_id)
+                continue
+            value = rows[column][i]
+            if column in ('bucket', 'samples', 'fuel_samples', 'speed_samples'):
+                line.append(str(int(value)))
+            else:
+                line.append(repr(float(value)) if np.isfinite(value) else '\\N')
+        buffer.write('\t'.join(line) + '\n')
+    buffer.seek(0)
+    cursor.copy_expert(f"copy {table_name(resolution)} ({', '.join(COLUMNS)}) from stdin", buffer)
+
+
+def refresh_terminal(conn, terminal_id, full=False, itersize=Config.STREAM_ITERSIZE):
+    # Пересчитывает агрегаты терминала начиная с часа, в который попала последняя
+    # учтённая строка (он мог быть неполным), до конца данных. При смене
+    # тарировки терминала или full=True пересчёт идёт с начала. Одна транзакция.
+    cursor = conn.cursor()
+    try:
+        calibration = load_calibration(cursor, terminal_id)
+        digest = calibration.digest
+    except ValueError:
+        calibration, digest = None, None
+    cursor.execute("select watermark, calibration from rollup_state where terminal_id = %s", (terminal_id,))
+    state = cursor.fetchone()
+    if full or state is None or state[1] != digest:
+        start = None
+    else:
+        start = state[0] // RESOLUTIONS['hour'] * RESOLUTIONS['hour']
+    for resolution in RESOLUTIONS:
+        if start is None:
+            cursor.execute(f"delete from {table_name(resolution)} where terminal_id = %s", (terminal_id,))
+        else:
+            cursor.execute(f"delete from {table_name(resolution)} where terminal_id = %s and bucket >= %s",
+                           (terminal_id, start))
+
+    rows_cursor = conn.cursor(name="rollup_rows")
+    rows_cursor.itersize = itersize
+    rows_cursor.execute("""
+        select timestamp, lls_0, speed from messages
+        where terminal_id = %s and timestamp >= %s
+        order by timestamp
+    """, (terminal_id, start if start is not None else -2 ** 31))
+
+    carry = None
+    last = None
+    total = 0
+    while True:
+        batch = rows_cursor.fetchmany(itersize)
+        if batch:
+            timestamps = np.fromiter((row[0] for row in batch), dtype=np.int64, count=len(batch))
+            raw = np.fromiter((np.nan if row[1] is None else row[1] for row in batch), dtype=float, count=len(batch))
+            speed = np.fromiter((np.nan if row[2] is None else row[2] for row in batch), dtype=float, count=len(batch))
+            fuel = calibration(raw) if calibration is not None else np.full(len(batch), np.nan)
+            chunk = (timestamps, fuel, speed)
+            if carry is not None:
+                chunk = tuple(np.concatenate(pair) for pair in zip(carry, chunk))
+            # Последний час может продолжиться в следующей пачке - он переносится.
+            cut = np.searchsorted(chunk[0], chunk[0][-1] // RESOLUTIONS['hour'] * RESOLUTIONS['hour'])
+            carry = tuple(column[cut:] for column in chunk)
+            chunk = tuple(column[:cut] for column in chunk)
+            last = int(timestamps[-1])
+            total += len(batch)
+        else:
+            chunk, carry = carry, None
+        if chunk is not None and len(chunk[0]):
+            for resolution, width in RESOLUTIONS.items():
+                _copy_rows(cursor, resolution, terminal_id, aggregate(*chunk, width))
+        if not batch:
+            break
+    rows_cursor.close()
+
+    cursor.execute("""
+        insert into rollup_state (terminal_id, watermark, calibration) values (%s, %s, %s)
+        on conflict (terminal_id) do update set watermark = excluded.watermark, calibration = excluded.calibration
+    """, (terminal_id, last if last is not None else 0, digest))
+    conn.commit()
+    cursor.close()
+    return total
+
+
+def refresh_rollups(conn, terminals=None, full=False):
+    # Обновляет агрегаты всех (или указанных) терминалов. Возвращает число прочитанных строк.
+    cursor = conn.cursor()
+    ensure_rollup_tables(cursor)
+    if terminals is None:
+        cursor.execute("select terminal_id from terminals" if catalog_exists(cursor) else
+                       "select distinct terminal_id from messages")
+        terminals = [row[0] for row in cursor.fetchall()]
+    conn.commit()
+    cursor.close()
+    total = 0
+    for terminal_id in terminals:
+        total += refresh_terminal(conn, terminal_id, full)
+    cursor = conn.cursor()
+    for resolution in RESOLUTIONS:
+        cursor.execute(f"analyze {table_name(resolution)}")
+    conn.commit()
+    cursor.close()
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Поминутные и почасовые агрегаты таблицы messages")
+    parser.add_argument('terminals', nargs='*', help="ID терминалов (по умолчанию все)")
+    parser.add_argument('--full', action='store_true', help="пересчитать с начала")
+    args = parser.parse_args()
+    try:
+        conn = psycopg2.connect(database = Config.DATABASE,
+                                      user = Config.USER,
+                                      password = Config.PASSWORD,
+                                      host = Config.HOST)
+        total = refresh_rollups(conn, args.terminals or None, args.full)
+        print(f"Агрегаты обновлены, обработано строк: {total}")
+        conn.close()
+    except Exception as e:
+        print(f"Ошибка при работе с PostgreSQL: {e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import argparse
+import json
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import psycopg2
+from CONFIG import Config
+from db import fetch_terminal_ids, forget_connections
+from detection import DRAIN
+from events import detection_params, ensure_event_tables, reset_checkpoints, update_terminal
+
+# Пакетный поиск заправок и сливов по всему парку: для каждого терминала
+# события доводятся до конца периода инкрементально от его отметки в
+# event_checkpoints (см. events.py), терминал без отметки - от начала периода.
+# Терминалы обрабатываются параллельно в SCAN_WORKERS процессах. Каждый
+# терминал сохраняется своей транзакцией, поэтому прерванный запуск можно
+# повторить: готовые терминалы пропускаются, а терминалы с ошибкой
+# обрабатываются заново.
+
+_conn = None
+
+
+def _connect():
+    return psycopg2.connect(database = Config.DATABASE,
+                            user = Config.USER,
+                            password = Config.PASSWORD,
+                            host = Config.HOST)
+
+
+def _worker_init():
+    global _conn
+    forget_connections()
+    _conn = _connect()
+
+
+def scan_terminal(terminal_id, start_datetime, end_datetime):
+    # Выполняется в процессе пула. Терминал без отметки обрабатывается с
+    # start_datetime. Возвращает (ID, строк, новых событий, ошибка, секунды).
+    started = time.perf_counter()
+    try:
+        rows, count = update_terminal(_conn, terminal_id, end_datetime, start_datetime)
+        error = None
+    except (ValueError, psycopg2.Error) as e:
+        _conn.rollback()
+        rows, count, error = 0, 0, str(e).strip() or type(e).__name__
+    return terminal_id, rows, count, error, time.perf_counter() - started
+
+
+def pending_terminals(cursor, terminals, end_datetime):
+    # Терминалы, чья отметка ещё не дошла до конца периода или до их последней строки.
+    cursor.execute("""
+        select c.terminal_id from event_checkpoints c
+        where c.params = %s and c.rescan is null and (c.watermark >= %s or c.watermark > (
+            select max(timestamp) from messages m where m.terminal_id = c.terminal_id))
+    """, (json.dumps(detection_params(), sort_keys=True), int(end_datetime.timestamp())))
+    done = {row[0] for row in cursor.fetchall()}
+    return [terminal_id for terminal_id in terminals if terminal_id not in done]
+
+
+def drain_report(cursor, range_start, range_end, top=10):
+    cursor.execute("""
+        select type, count(*), coalesce(sum(volume), 0) from events
+        where start_time >= %s and start_time < %s group by type order by type
+    """, (range_start, range_end))
+    lines = [f"{event_type}: {count} событий, {volume:.0f} л" for event_type, count, volume in cursor.fetchall()]
+    cursor.execute("""
+        select terminal_id, count(*), sum(volume) from events
+        where type = %s and start_time >= %s and start_time < %s
+        group by terminal_id order by sum(volume) desc limit %s
+    """, (DRAIN, range_start, range_end, top))
+    rows = cursor.fetchall()
+    if rows:
+        lines.append("Больше всего слито:")
+        lines.extend(f"  {terminal_id}: {count} сливов, {volume:.0f} л" for terminal_id, count, volume in rows)
+    return "\n".join(lines)
+
+
+def scan(start_datetime, end_datetime, terminals=None, workers=None, restart=False):
+    workers = workers or Config.SCAN_WORKERS
+    range_start, range_end = int(start_datetime.timestamp()), int(end_datetime.timestamp())
+    conn = _connect()
+    cursor = conn.cursor()
+    ensure_event_tables(cursor)
+    conn.commit()
+    terminals = terminals or fetch_terminal_ids()
+    if restart:
+        for terminal_id in terminals:
+            reset_checkpoints(cursor, terminal_id)
+        conn.commit()
+    pending = pending_terminals(cursor, terminals, end_datetime)
+    print(f"Период {start_datetime:%d.%m.%Y %H:%M} - {end_datetime:%d.%m.%Y %H:%M}: терминалов {len(terminals)}, "
+          f"осталось обработать {len(pending)}")
+
+    started = time.perf_counter()
+    failed = 0
+    if pending:
+        # fork: процессы получают уже импортированные модули, соединения родителя
+        # в них сбрасывает forget_connections().
+        with ProcessPoolExecutor(min(workers, len(pending)), mp_context=multiprocessing.get_context('fork'),
+                                 initializer=_worker_init) as executor:
+            futures = [executor.submit(scan_terminal, terminal_id, start_datetime, end_datetime) for terminal_id in pending]
+            for done, future in enumerate(as_completed(futures), 1):
+                terminal_id, rows, count, error, seconds = future.result()
+                if error:
+                    failed += 1
+                    print(f"  [{done}/{len(pending)}] {terminal_id}: ошибка: {error}")
+                else:
+                    print(f"  [{done}/{len(pending)}] {terminal_id}: строк {rows}, новых событий {count}, "
+                          f"{seconds:.1f} с")
+    print(f"Обработано за {time.perf_counter() - started:.1f} с, с ошибкой: {failed}")
+    print(drain_report(cursor, range_start, range_end))
+    cursor.close()
+    conn.close()
+
+
+def parse_moment(text):
+    return datetime.fromisoformat(text)
+
+
+def main():
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    parser = argparse.ArgumentParser(description="Поиск заправок и сливов по всем терминалам за период")
+    parser.add_argument('start', nargs='?', type=parse_moment, default=today - timedelta(days=1),
+                        help="начало, YYYY-MM-DD[ HH:MM] (по умолчанию вчера)")
+    parser.add_argument('end', nargs='?', type=parse_moment, default=None,
+                        help="конец (по умолчанию через сутки после начала)")
+    parser.add_argument('--terminals', nargs='+', help="только эти ID")
+    parser.add_argument('--workers', type=int, help=f"число процессов (по умолчанию {Config.SCAN_WORKERS})")
+    parser.add_argument('--restart', action='store_true', help="пересчитать события терминалов с первого запуска")
+    args = parser.parse_args()
+    end = args.end or args.start + timedelta(days=1)
+    try:
+        scan(args.start, end, args.terminals, args.workers, args.restart)
+    except Exception as e:
+        print(f"Ошибка при работе с PostgreSQL: {e}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,309 @@
+from datetime import timedelta
+from functools import lru_cache
+import numpy as np
+from scipy.ndimage import median_filter
+from scipy.signal import oaconvolve, savgol_filter
+import statsmodels.api as sm
+
+FRAC = 0.05
+MAX_WINDOW = 2001
+ROBUST_ITERATIONS = 3
+TIME_WINDOW = timedelta(minutes=30)
+# Меняется вместе с результатом сглаживания: входит в ключи кэша графиков и
+# отметок сканирования, чтобы старые результаты пересчитались.
+VERSION = 4
+
+
+def _window(n, frac, max_window):
+    window = min(max(int(np.ceil(frac * n)), 3), max_window, n)
+    return window if window % 2 else window - 1
+
+
+def _span(n, frac, max_window):
+    # Число соседей в регрессии, как в statsmodels: int(frac * n), не меньше 2 и
+    # не больше n, и окно не длиннее max_window точек.
+    return min(max(int(frac * n + 1e-10), 2), n, max_window + 1)
+
+
+def _lowess_window(n, frac, max_window):
+    # Окно windowed LOWESS с ненулевыми весами: соседи на расстоянии span // 2
+    # получают нулевой трикубический вес.
+    return max(_span(n, frac, max_window) // 2 * 2 - 1, 1)
+
+
+@lru_cache(maxsize=4)
+def _edge_kernel(span):
+    # Трикубические веса точек 0..span-1 для первых span // 2 точек ряда: радиус
+    # окрестности - расстояние до дальнего из span соседей, как в statsmodels.
+    edge = np.arange(span // 2)[:, None]
+    points = np.arange(span)
+    return (1 - (np.abs(points - edge) / np.maximum(edge, span - 1 - edge)) ** 3) ** 3
+
+
+def _edge_sums(kernel, robust, values):
+    # Взвешенные суммы для краевых точек: s0, s1, s2 по смещениям j - i и t0, t1
+    # по значениям. Одно матричное умножение на столбцы w·x^p и w·y·x^p,
+    # x отсчитывается от середины окрестности.
+    radius, span = kernel.shape
+    points = np.arange(span) - (span - 1) / 2
+    edge = np.arange(radius) - (span - 1) / 2
+    weighted = robust * values
+    a0, a1, a2, b0, b1 = (kernel @ np.column_stack((robust, robust * points, robust * points ** 2,
+                                                    weighted, weighted * points))).T
+    return a0, a1 - edge * a0, a2 - 2 * edge * a1 + edge ** 2 * a0, b0, b1 - edge * b0
+
+
+def _seconds(timestamps):
+    times = np.asarray(timestamps)
+    if times.dtype.kind == 'O':
+        return np.array([t.timestamp() for t in times], dtype=float)
+    if times.dtype.kind == 'M':
+        return times.astype('datetime64[ms]').astype(np.int64) / 1000.0
+    return times.astype(float)
+
+
+def lowess(values, timestamps=None, frac=FRAC):
+    values = np.asarray(values, dtype=float)
+    return sm.nonparametric.lowess(values, np.arange(len(values)), frac=frac)[:, 1]
+
+
+def windowed_lowess(values, timestamps=None, frac=FRAC, max_window=MAX_WINDOW, it=ROBUST_ITERATIONS, window=None,
+                    edges=(True, True)):
+    # Та же локально-линейная регрессия с трикубическими весами и робастными
+    # итерациями, что и в statsmodels, но окрестность - фиксированное окно
+    # не длиннее max_window точек. Внутри ряда взвешенные суммы считаются
+    # свёртками, поэтому время растёт линейно с длиной ряда, а не как n² · frac.
+    # У краёв окрестность, как в statsmodels, не симметрична: первые и
+    # последние span точек, где span = window + 1 - число соседей. Пока окно
+    # не упирается в max_window, результат совпадает со statsmodels, в том числе
+    # на коротких рядах с выбросами: как и там, точка, у окрестности которой
+    # меньше двух соседей с ненулевым весом, остаётся как есть, а дисперсия
+    # смещений в регрессии не меньше 1e-12. Исключение - больше половины остатков
+    # нулевые (ступенчатые показания): statsmodels тогда оставляет вес только
+    # точкам с остатком ровно 0 и зависит от ошибок округления, здесь нулём
+    # считается остаток меньше 1e-9 от значения.
+    # edges - (левый, правый): края куска, которые не края ряда, несимметричной
+    # окрестности не получают (их точки StreamingSmoother всё равно отбрасывает).
+    values = np.asarray(values, dtype=float)
+    n = len(values)
+    if n < 3:
+        return values.copy()
+    span = min(window + 1 if window else _span(n, frac, max_window), n)
+    radius = span // 2
+    offsets = np.arange(1 - radius, radius, dtype=float)
+    kernel = (1 - np.abs(offsets / radius) ** 3) ** 3
+    kernels = [k[::-1] for k in (kernel, kernel * offsets, kernel * offsets ** 2)]
+    edge_kernel = _edge_kernel(span)
+
+    # Остаток меньше 1e-9 от значения - ошибка округления, он считается нулевым.
+    tolerance = 1e-9 * np.abs(values)
+    # Ненулевые (больше 1e-12, как в statsmodels) веса ядра - смещения до inner.
+    inner = int(np.count_nonzero(kernel > 1e-12)) // 2
+    index = np.arange(n)
+
+    robust = np.ones(n)
+    for iteration in range(it + 1):
+        s0, s1, s2 = (oaconvolve(robust, k, mode='same') for k in kernels)
+        t0, t1 = (oaconvolve(robust * values, k, mode='same') for k in kernels[:2])
+        # Соседей с ненулевым весом (как в statsmodels, больше 1e-12) - считаются,
+        # только если робастные веса кого-то обнулили.
+        weighted = robust > 1e-12
+        support = None
+        if not weighted.all():
+            prefix = np.concatenate(([0], np.cumsum(weighted)))
+            support = (prefix[np.minimum(index + inner + 1, n)] - prefix[np.maximum(index - inner, 0)]).astype(float)
+        if edges[0]:
+            s0[:radius], s1[:radius], s2[:radius], t0[:radius], t1[:radius] = \
+                _edge_sums(edge_kernel, robust[:span], values[:span])
+            if support is not None:
+                support[:radius] = (edge_kernel > 1e-12) @ weighted[:span].astype(float)
+        if edges[1]:
+            # Правый край - зеркальное отражение левого, смещения меняют знак.
+            a0, a1, a2, b0, b1 = _edge_sums(edge_kernel, robust[::-1][:span], values[::-1][:span])
+            s0[n - radius:], s1[n - radius:], s2[n - radius:] = a0[::-1], -a1[::-1], a2[::-1]
+            t0[n - radius:], t1[n - radius:] = b0[::-1], -b1[::-1]
+            if support is not None:
+                support[n - radius:] = ((edge_kernel > 1e-12) @ weighted[::-1][:span].astype(float))[::-1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_x, mean_y = s1 / s0, t0 / s0
+            variance = np.maximum(s2 / s0 - mean_x ** 2, 1e-12)
+            fitted = mean_y - mean_x * (t1 / s0 - mean_x * mean_y) / variance
+        valid = np.isfinite(fitted) if support is None else np.isfinite(fitted) & (support > 1.5)
+        fitted = np.where(valid, fitted, values)
+        if iteration == it:
+            break
+        residuals = np.abs(values - fitted)
+        residuals[residuals <= tolerance] = 0
+        scale = np.median(residuals)
+        if scale == 0:
+            robust = (residuals == 0).astype(float)
+        else:
+            robust = np.clip(1 - (residuals / (6 * scale)) ** 2, 0, None) ** 2
+    return fitted
+
+
+def savgol(values, timestamps=None, frac=FRAC, max_window=MAX_WINDOW, polyorder=2, window=None):
+    values = np.asarray(values, dtype=float)
+    if len(values) < 3:
+        return values.copy()
+    window = min(window or _window(len(values), frac, max_window), len(values) - 1 + len(values) % 2)
+    return savgol_filter(values, window, min(polyorder, window - 1))
+
+
+def median(values, timestamps=None, frac=FRAC, max_window=MAX_WINDOW, window=None):
+    # scipy.signal.medfilt дополняет края нулями и тянет уровень топлива вниз,
+    # median_filter с mode='nearest' даёт ту же медиану без этого эффекта.
+    values = np.asarray(values, dtype=float)
+    if len(values) < 3:
+        return values.copy()
+    return median_filter(values, size=window or _window(len(values), frac, max_window), mode='nearest')
+
+
+def time_window(values, timestamps, window=TIME_WINDOW):
+    # Локально-линейная регрессия по всем точкам в пределах ±window/2 по времени,
+    # а не по числу точек: разреженные и плотные участки сглаживаются одинаково.
+    values = np.asarray(values, dtype=float)
+    if timestamps is None:
+        raise ValueError("Для сглаживания по времени нужны метки времени")
+    if isinstance(window, timedelta):
+        window = window.total_seconds()
+    seconds = _seconds(timestamps)
+    if len(values) < 3:
+        return values.copy()
+    hours = (seconds - seconds[0]) / 3600.0
+    left = np.searchsorted(seconds, seconds - window / 2, side='left')
+    right = np.searchsorted(seconds, seconds + window / 2, side='right')
+
+    def window_sum(column):
+        prefix = np.concatenate(([0.0], np.cumsum(column)))
+        return prefix[right] - prefix[left]
+
+    count = (right - left).astype(float)
+    mean_t = window_sum(hours) / count
+    mean_y = window_sum(values) / count
+    var_t = window_sum(hours * hours) / count - mean_t ** 2
+    cov_ty = window_sum(hours * values) / count - mean_t * mean_y
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(var_t > 1e-12, cov_ty / var_t, 0.0)
+    return mean_y + slope * (hours - mean_t)
+
+
+SMOOTHERS = {
+    'lowess': lowess,
+    'windowed': windowed_lowess,
+    'savgol': savgol,
+    'median': median,
+    'time': time_window,
+}
+
+
+def smooth(values, timestamps=None, method='windowed', **params):
+    if method not in SMOOTHERS:
+        raise ValueError(f"Неизвестный метод сглаживания: {method}")
+    return SMOOTHERS[method](values, timestamps, **params)
+
+
+class StreamingSmoother:
+    # Сглаживание ряда, поступающего кусками. Каждый кусок сглаживается тем же
+    # методом вместе с запасом соседних точек (контекстом) слева и справа, и
+    # наружу отдаются только точки, у которых контекст уже полный, поэтому
+    # результат совпадает со сглаживанием всего ряда сразу. Исключение -
+    # масштаб робастных весов windowed LOWESS, он считается по куску.
+    # Размер окна задаётся явно или по ожидаемому числу точек count, как в smooth().
+    # Метод lowess окна не имеет и отдаёт весь ряд только в finish().
+    # state()/restore() - состояние массивами numpy, чтобы продолжить в другом процессе.
+    def __init__(self, method='windowed', count=None, window=None, frac=FRAC, max_window=MAX_WINDOW, **params):
+        if method not in SMOOTHERS:
+            raise ValueError(f"Неизвестный метод сглаживания: {method}")
+        self.method = method
+        self.params = params
+        if method == 'time':
+            reach = params.get('window', TIME_WINDOW)
+            self.reach = reach.total_seconds() / 2 if isinstance(reach, timedelta) else reach / 2
+        elif method == 'lowess':
+            self.params['frac'] = frac
+            self.reach = None
+        else:
+            if window is None:
+                window = (_lowess_window if method == 'windowed' else _window)(count or max_window, frac, max_window)
+            self.params['window'] = window
+            if method == 'windowed':
+                # Краевые точки куска считаются по несимметричной окрестности -
+                # на одну точку шире половины окна.
+                self.reach = (window // 2 + 1) * (params.get('it', ROBUST_ITERATIONS) + 1)
+            else:
+                self.reach = window // 2
+        self._times = np.empty(0, dtype=np.int64)
+        self._values = np.empty(0)
+        self._emitted = 0
+        # Буфер начинается с первой точки ряда, пока его ни разу не обрезали.
+        self._head = True
+
+    def feed(self, timestamps, values):
+        self._times = np.concatenate((self._times, np.asarray(timestamps)))
+        self._values = np.concatenate((self._values, np.asarray(values, dtype=float)))
+        if self.reach is None:
+            return self._times[:0], self._values[:0]
+        if self.method == 'time':
+            ready = np.searchsorted(self._times, self._times[-1] - self.reach, side='left') if len(self._times) else 0
+        else:
+            ready = len(self._values) - self.reach
+            if self.method == 'windowed' and len(self._values) <= self.params['window']:
+                # Окрестность левого края ряда - первые window + 1 точек, их ещё нет.
+                ready = 0
+            elif self.method == 'savgol' and len(self._values) < self.params['window']:
+                # Края ряда savgol_filter считает полиномом по первым и последним
+                # window точкам: на куске короче окна оно бы сузилось.
+                ready = 0
+        return self._emit(ready)
+
+    def finish(self):
+        return self._emit(len(self._values), final=True)
+
+    def state(self):
+        # Хвост ряда и позиция выдачи; метод и окно задаются при создании.
+        return {'times': self._times, 'values': self._values, 'emitted': np.int64(self._emitted),
+                'head': np.bool_(self._head)}
+
+    def restore(self, state):
+        self._times = np.asarray(state['times'])
+        self._values = np.asarray(state['values'], dtype=float)
+        self._emitted = int(state['emitted'])
+        self._head = bool(state['head'])
+
+    def _emit(self, ready, final=False):
+        if ready <= self._emitted:
+            return self._times[:0], self._values[:0]
+        if self.method == 'time':
+            start = np.searchsorted(self._times, self._times[self._emitted] - self.reach, side='left')
+            end = len(self._values) if ready == len(self._values) else \
+                np.searchsorted(self._times, self._times[ready - 1] + self.reach, side='right')
+        elif self.reach is None:
+            start, end = 0, len(self._values)
+        else:
+            start = max(self._emitted - self.reach, 0)
+            end = min(ready + self.reach, len(self._values))
+            if self.method == 'savgol':
+                start = max(min(start, end - self.params['window']), 0)
+        params = self.params
+        if self.method == 'windowed':
+            params = dict(params, edges=(start == 0 and self._head, final))
+        smoothed = SMOOTHERS[self.method](self._values[start:end], self._times[start:end], **params)
+        times = self._times[self._emitted:ready]
+        values = smoothed[self._emitted - start:ready - start]
+
+        if self.method == 'time':
+            keep = np.searchsorted(self._times, self._times[ready - 1] - self.reach, side='left')
+        elif self.reach is None:
+            keep = ready
+        else:
+            keep = ready - self.reach
+            if self.method == 'savgol':
+                # Для конца ряда в буфере остаются последние window точек, а не window - 1.
+                keep = min(keep, len(self._values) - self.params['window'])
+        keep = max(min(keep, ready), 0)
+        self._head = self._head and not keep
+        self._times = self._times[keep:]
+        self._values = self._values[keep:]
+        self._emitted = ready - keep
+        return times, values
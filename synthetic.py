@@ -0,0 +1,238 @@
+import argparse
+import csv
+import gzip
+import json
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+from detection import DRAIN, REFUEL
+
+# Синтетические выгрузки для бенчмарков и проверки без приватного test.csv.
+# Пишет messages.csv (колонки preparation2.py, как в test.csv) и calibrating.csv
+# (как calib2.csv, тарировка порта 0 - бак горизонтальный цилиндр), плюс
+# events.json с настоящими заправками и сливами и synthetic.json с параметрами.
+# Движение - получасовыми блоками днём, расход пропорционален скорости,
+# заправки и сливы - на стоянке, за несколько минут: уровень меняется линейно
+# со скоростью из REFUEL_RATE/DRAIN_RATE литров в минуту, как у пистолета
+# колонки или шланга. Бак не опускается ниже LOW_LEVEL: на этом уровне
+# добавляется заправка. При том же seed файлы совпадают байт в байт.
+HEADER = ['message_id', 'track_id', 'terminal_id', 'lat', 'lon', 'timestamp', 'speed', 'course', 'voltage',
+          'motion', 'alt', 'source', 'ignition', 'odometer', 'satellites', 'gsmlevel', 'sensors', 'externals',
+          'outputs', 'can_data', 'temperature', 'created']
+FIRST_TERMINAL = 990000000000000
+RAW_MAX = 4000
+CURVE_POINTS = 11
+BLOCK = 1800
+LOW_LEVEL = 0.15
+LITRES_PER_KM = 0.25
+REFUEL_RATE = (30, 50)
+DRAIN_RATE = (10, 20)
+
+
+def terminal_ids(count):
+    return [str(FIRST_TERMINAL + i) for i in range(count)]
+
+
+def tank_curve(capacity):
+    # Тарировка горизонтального цилиндра: объём по доле высоты h -
+    # capacity * (h - sin(2 pi h) / (2 pi)), монотонно растёт.
+    height = np.linspace(0, 1, CURVE_POINTS)
+    litres = capacity * (height - np.sin(2 * np.pi * height) / (2 * np.pi))
+    return height * RAW_MAX, np.round(litres, 3)
+
+
+def _movement(rng, timestamps, start):
+    # Получасовые блоки движения: днём чаще, ночью редко.
+    blocks = (timestamps - start) // BLOCK
+    hours = np.array([datetime.fromtimestamp(start + block * BLOCK).hour for block in range(blocks[-1] + 1)])
+    moving = rng.random(len(hours)) < np.where((hours >= 7) & (hours < 20), 0.55, 0.05)
+    return moving[blocks]
+
+
+def _plan_events(rng, parked, days, refuels, drains):
+    # Индексы точек стоянки для заправок и сливов, по порядку.
+    candidates = np.flatnonzero(parked[1:]) + 1
+    planned = []
+    for kind, per_day in ((REFUEL, refuels), (DRAIN, drains)):
+        count = min(rng.poisson(per_day * days), len(candidates))
+        planned.extend((int(index), kind) for index in rng.choice(candidates, count, replace=False))
+    return sorted(planned)
+
+
+def _fuel_level(rng, consumed, planned, capacity):
+    # Уровень по накопленному расходу с заправками и сливами. Возвращает
+    # (литры на каждую точку, [(индекс, тип, объём)]). Событие в точке index -
+    # ступенька между index - 1 и index.
+    n = len(consumed)
+    level = np.empty(n)
+    events = []
+    current = capacity * rng.uniform(0.5, 0.9)
+    position = 0
+    for index, kind in planned + [(n, None)]:
+        # current - уровень в точке position.
+        while position < index:
+            segment = current - (consumed[position:index] - consumed[position])
+            low = np.flatnonzero(segment < capacity * LOW_LEVEL)
+            if not len(low):
+                level[position:index] = segment
+                break
+            stop = position + low[0]
+            level[position:stop] = segment[:low[0]]
+            volume = capacity * rng.uniform(0.6, 0.8)
+            events.append((stop, REFUEL, volume))
+            current = segment[low[0]] + volume
+            position = stop
+        if kind is None:
+            break
+        current -= consumed[index] - consumed[position]
+        position = index
+        if kind == REFUEL:
+            volume = min(capacity * rng.uniform(0.3, 0.6), capacity * 0.95 - current)
+        else:
+            volume = -min(capacity * rng.uniform(0.05, 0.2), current - capacity * 0.05)
+        if abs(volume) >= capacity * 0.05:
+            current += volume
+            events.append((index, kind, abs(volume)))
+    return level, events
+
+
+def _ramp(rng, level, timestamps, events):
+    # Ступеньки событий в level - в линейный подъём или спуск от момента события
+    # длиной объём / скорость. Возвращает длительности в секундах.
+    durations = []
+    for index, kind, volume in events:
+        rate = rng.uniform(*(REFUEL_RATE if kind == REFUEL else DRAIN_RATE))
+        duration = int(round(volume / rate * 60))
+        end = np.searchsorted(timestamps, timestamps[index] + duration)
+        remaining = 1 - (timestamps[index:end] - timestamps[index]) / duration
+        level[index:end] -= (volume if kind == REFUEL else -volume) * remaining
+        durations.append(duration)
+    return durations
+
+
+def generate_terminal(rng, terminal_id, start, days, interval, refuels, drains, capacity):
+    n = days * 86400 // interval
+    timestamps = start + np.arange(n, dtype=np.int64) * interval + rng.integers(0, max(interval // 2, 1), n)
+    moving = _movement(rng, timestamps, start)
+    speed = np.where(moving, np.clip(rng.normal(55, 18, n), 5, 130), 0).astype(np.int64)
+    seconds = np.diff(timestamps, prepend=timestamps[0])
+    distance = speed * seconds / 3600
+    idle = rng.random(n) < 0.1
+    consumed = np.cumsum(distance * LITRES_PER_KM + np.where(~moving & idle, seconds / 3600 * 1.2, 0))
+    planned = _plan_events(rng, ~moving, days, refuels, drains)
+    litres, events = _fuel_level(rng, consumed, planned, capacity)
+    durations = _ramp(rng, litres, timestamps, events)
+
+    # Показание ДУТ: литры через обратную тарировку, шум (в движении - плеск
+    # топлива), редкие выбросы и пропуски LLS_0.
+    raw_points, litres_points = tank_curve(capacity)
+    raw = np.interp(litres, litres_points, raw_points)
+    raw += rng.normal(0, np.where(moving, 12, 3))
+    spikes = rng.random(n) < 0.002
+    raw[spikes] += rng.normal(0, 400, spikes.sum())
+    raw = np.clip(raw, 0, RAW_MAX)
+    missing = rng.random(n) < 0.01
+
+    ignition = (moving | idle).astype(np.int64)
+    heading = rng.uniform(0, 2 * np.pi, n)
+    lat = 55.75 + np.cumsum(distance * np.cos(heading) / 111)
+    lon = 37.62 + np.cumsum(distance * np.sin(heading) / 63)
+    course = (np.degrees(heading) % 360).astype(np.int64)
+    odometer = np.cumsum(distance).astype(np.int64)
+    track = np.cumsum(np.diff(moving.astype(np.int64), prepend=0) == 1)
+    voltage = np.where(ignition == 1, 13.9, 12.4) + rng.normal(0, 0.1, n)
+    columns = {
+        'timestamp': timestamps, 'speed': speed, 'ignition': ignition, 'lat': lat, 'lon': lon,
+        'course': course, 'odometer': odometer, 'track_id': track, 'voltage': voltage,
+        'raw': raw, 'missing': missing,
+    }
+    truth = [{'terminal_id': terminal_id, 'type': kind, 'timestamp': int(timestamps[index]),
+              'duration': duration, 'volume': round(float(volume), 1)}
+             for (index, kind, volume), duration in zip(events, durations)]
+    return columns, truth
+
+
+def _rows(terminal_id, columns, first_message_id):
+    for i, (timestamp, speed, ignition, lat, lon, course, odometer, track, voltage, raw, missing) in enumerate(zip(
+            columns['timestamp'].tolist(), columns['speed'].tolist(), columns['ignition'].tolist(),
+            columns['lat'].tolist(), columns['lon'].tolist(), columns['course'].tolist(),
+            columns['odometer'].tolist(), columns['track_id'].tolist(), columns['voltage'].tolist(),
+            columns['raw'].tolist(), columns['missing'].tolist())):
+        can_data = '{}' if missing else f'{{"LLS_0": "{raw:.1f}"}}'
+        yield (first_message_id + i, track, terminal_id, f'{lat:.6f}', f'{lon:.6f}', timestamp, speed, course,
+               f'{voltage:.2f}', int(speed > 0), 150, 'gps', ignition, odometer, 12, 25, '{}', '{}', '{}',
+               can_data, '{}', datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S'))
+
+
+def generate(directory, terminals=3, days=14, interval=60, refuels=0.3, drains=0.05, capacity=400.0,
+             start=datetime(2023, 1, 1), seed=0, compress=False):
+    # Пишет выгрузки в directory. Возвращает сводку (она же synthetic.json).
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    first = int(start.timestamp())
+    messages_path = directory / ('messages.csv.gz' if compress else 'messages.csv')
+    opener = gzip.open if compress else open
+    rows = 0
+    events = []
+    with opener(messages_path, 'wt', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        for terminal_id in terminal_ids(terminals):
+            columns, truth = generate_terminal(rng, terminal_id, first, days, interval, refuels, drains, capacity)
+            writer.writerows(_rows(terminal_id, columns, rows + 1))
+            rows += len(columns['timestamp'])
+            events.extend(truth)
+
+    calibrating_path = directory / 'calibrating.csv'
+    raw_points, litres_points = tank_curve(capacity)
+    with open(calibrating_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['id', 'deviceid_port', 'calibrating_data'])
+        for i, terminal_id in enumerate(terminal_ids(terminals), 1):
+            points = [{'input_value': float(x), 'output_value': float(y)} for x, y in zip(raw_points, litres_points)]
+            writer.writerow([i, f'{terminal_id}_0', json.dumps(points)])
+
+    with open(directory / 'events.json', 'w') as f:
+        json.dump(events, f, ensure_ascii=False, indent=1)
+    summary = {'terminals': terminals, 'days': days, 'interval': interval, 'refuels': refuels, 'drains': drains,
+               'capacity': capacity, 'start': start.isoformat(), 'seed': seed, 'rows': rows,
+               'refuel_events': sum(1 for event in events if event['type'] == REFUEL),
+               'drain_events': sum(1 for event in events if event['type'] == DRAIN),
+               'messages': str(messages_path), 'calibrating': str(calibrating_path)}
+    with open(directory / 'synthetic.json', 'w') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=1)
+    return summary
+
+
+def add_arguments(parser):
+    parser.add_argument('--terminals', type=int, default=3, help="число терминалов")
+    parser.add_argument('--days', type=int, default=14, help="длина истории в днях")
+    parser.add_argument('--interval', type=int, default=60, help="период сообщений, с")
+    parser.add_argument('--refuels', type=float, default=0.3, help="заправок в день на терминал (в среднем)")
+    parser.add_argument('--drains', type=float, default=0.05, help="сливов в день на терминал (в среднем)")
+    parser.add_argument('--capacity', type=float, default=400.0, help="объём бака, л")
+    parser.add_argument('--start', default="2023-01-01", help="начало истории, YYYY-MM-DD")
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def generator_params(args):
+    return {'terminals': args.terminals, 'days': args.days, 'interval': args.interval, 'refuels': args.refuels,
+            'drains': args.drains, 'capacity': args.capacity, 'seed': args.seed,
+            'start': datetime.strptime(args.start, '%Y-%m-%d')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Синтетические выгрузки messages и calibrating")
+    parser.add_argument('directory', nargs='?', default='data/synthetic', help="каталог для файлов")
+    add_arguments(parser)
+    parser.add_argument('--gzip', action='store_true', help="messages.csv.gz вместо messages.csv")
+    args = parser.parse_args()
+    summary = generate(args.directory, compress=args.gzip, **generator_params(args))
+    print(f"{summary['messages']}: {summary['rows']} строк, {summary['terminals']} терминалов, "
+          f"заправок {summary['refuel_events']}, сливов {summary['drain_events']}")
+    print(f"{summary['calibrating']}: тарировки порта 0")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+import gzip
+import os
+import psycopg2
+import pytest
+from CONFIG import Config
+import bulk_load
+from rollups import ensure_rollup_tables
+
+# Загрузка идёт в отдельную схему с копией таблицы messages, общая база не меняется.
+SCHEMA = f'bulk_load_test_{os.getpid()}'
+TERMINAL = 'bulk-load-test'
+HEADER = 'message_id,terminal_id,timestamp,speed\n'
+
+
+@pytest.fixture
+def connect(monkeypatch, tmp_path):
+    real = psycopg2.connect
+
+    def connect(*args, **kwargs):
+        return real(database = Config.DATABASE, user = Config.USER, password = Config.PASSWORD,
+                    host = Config.HOST, options=f'-c search_path={SCHEMA}')
+
+    try:
+        conn = connect()
+    except psycopg2.Error as e:
+        pytest.skip(f"база недоступна: {e}")
+    cursor = conn.cursor()
+    cursor.execute(f"create schema {SCHEMA}")
+    cursor.execute("create table messages (like public.messages including all)")
+    conn.commit()
+    # Процессы пула создаются fork и получают те же подмены.
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+    monkeypatch.setattr(Config, 'COLUMNAR_DIR', str(tmp_path / 'columnar'))
+    monkeypatch.setattr(Config, 'LOAD_REJECT_DIR', str(tmp_path / 'rejects'))
+    monkeypatch.setattr(Config, 'LOAD_BATCH_ROWS', 100)
+    yield connect
+    conn.rollback()
+    cursor.execute(f"drop schema {SCHEMA} cascade")
+    conn.commit()
+    conn.close()
+
+
+def _query(connect, sql):
+    with connect() as conn, conn.cursor() as cursor:
+        cursor.execute(sql)
+        rows = cursor.fetchall()
+    conn.close()
+    return rows
+
+
+def test_interrupted_load_resumes_without_duplicates(connect, tmp_path, monkeypatch):
+    path = tmp_path / 'messages.csv'
+    path.write_text(HEADER + ''.join(f'{i},{TERMINAL},{i},1\n' for i in range(1000)))
+    copy = bulk_load._copy
+    calls = []
+
+    def failing_copy(cursor, columns, lines):
+        calls.append(len(lines))
+        if len(calls) == 4:
+            raise psycopg2.OperationalError("обрыв соединения")
+        copy(cursor, columns, lines)
+
+    monkeypatch.setattr(bulk_load, '_copy', failing_copy)
+    with pytest.raises(psycopg2.OperationalError):
+        bulk_load.load([path], workers=1, chunk_mb=0.004)
+    loaded = _query(connect, "select count(*) from messages")[0][0]
+    assert 0 < loaded < 1000
+    assert _query(connect, "select sum(rows) from bulk_load_chunks") == [(loaded,)]
+    assert _query(connect, "select count(*) from ingest_state") == [(0,)]
+    # Снятые индексы достроены и после сбоя.
+    assert _query(connect, "select count(*) from pg_indexes where schemaname = current_schema() "
+                           "and tablename = 'messages'") != [(0,)]
+
+    monkeypatch.setattr(bulk_load, '_copy', copy)
+    bulk_load.load([path], workers=2, chunk_mb=0.004)
+    assert _query(connect, "select count(*), count(distinct message_id) from messages") == [(1000, 1000)]
+    assert _query(connect, "select rows, position from ingest_state") == [(1000, os.path.getsize(path))]
+    assert _query(connect, "select count(*) from bulk_load_chunks") == [(0,)]
+    # Загруженный файл повторно не грузится.
+    bulk_load.load([path], workers=2)
+    assert _query(connect, "select count(*) from messages") == [(1000,)]
+
+
+def test_constraint_violations_are_rejected(connect, tmp_path):
+    # Строка вне всех секций даёт такую же ошибку ограничения (CheckViolation).
+    with connect() as conn, conn.cursor() as cursor:
+        cursor.execute("alter table messages add constraint speed_range check (speed >= 0)")
+    conn.close()
+    path = tmp_path / 'messages.csv.gz'
+    path.write_bytes(gzip.compress((HEADER + ''.join(f'{i},{TERMINAL},{i},{-1 if i in (7, 300) else 1}\n'
+                                                     for i in range(500))).encode()))
+    bulk_load.load([path], workers=1)
+    assert _query(connect, "select count(*) from messages") == [(498,)]
+    rejects = (tmp_path / 'rejects' / 'messages.csv.gz.rejects.csv').read_text().splitlines()
+    assert rejects == [HEADER.strip(), f'7,{TERMINAL},7,-1', f'300,{TERMINAL},300,-1']
+
+
+def test_rejects_survive_resumed_load(connect, tmp_path, monkeypatch):
+    with connect() as conn, conn.cursor() as cursor:
+        cursor.execute("alter table messages add constraint speed_range check (speed >= 0)")
+    conn.close()
+    path = tmp_path / 'messages.csv'
+    path.write_text(HEADER + ''.join(f'{i},{TERMINAL},{i},{-1 if i in (7, 900) else 1}\n' for i in range(1000)))
+    copy = bulk_load._copy
+
+    def failing_copy(cursor, columns, lines):
+        if lines[0].startswith(b'500,'):
+            raise psycopg2.OperationalError("обрыв соединения")
+        copy(cursor, columns, lines)
+
+    monkeypatch.setattr(bulk_load, '_copy', failing_copy)
+    with pytest.raises(psycopg2.OperationalError):
+        bulk_load.load([path], workers=1)
+    # Отказ первого запуска зафиксирован вместе со своей пачкой.
+    assert _query(connect, "select count(*) from bulk_load_rejects") == [(1,)]
+    monkeypatch.setattr(bulk_load, '_copy', copy)
+    bulk_load.load([path], workers=1)
+    assert _query(connect, "select count(*) from messages") == [(998,)]
+    rejects = (tmp_path / 'rejects' / 'messages.csv.rejects.csv').read_text().splitlines()
+    assert rejects == [HEADER.strip(), f'7,{TERMINAL},7,-1', f'900,{TERMINAL},900,-1']
+    assert _query(connect, "select count(*) from bulk_load_rejects") == [(0,)]
+
+
+def test_only_touched_terminals_are_refreshed(connect, tmp_path, monkeypatch):
+    with connect() as conn, conn.cursor() as cursor:
+        ensure_rollup_tables(cursor)
+        cursor.executemany("insert into rollup_state values (%s, 2000000, null)", [(TERMINAL,), ('other',)])
+    conn.close()
+    cached = [tmp_path / 'columnar' / TERMINAL / '1970-01', tmp_path / 'columnar' / TERMINAL / '1970-02',
+              tmp_path / 'columnar' / 'other' / '1970-01']
+    for path in cached:
+        path.mkdir(parents=True)
+    refreshed = []
+    monkeypatch.setattr(bulk_load, 'refresh_rollups', lambda conn, terminals: refreshed.append(terminals) or 0)
+    path = tmp_path / 'messages.csv'
+    path.write_text(HEADER + ''.join(f'{i},{TERMINAL},{1300000 + i},1\n' for i in range(500)))
+    bulk_load.load([path], workers=1)
+    assert refreshed == [[TERMINAL]]
+    assert _query(connect, "select terminal_id, watermark from rollup_state order by terminal_id") == [
+        (TERMINAL, 1300000), ('other', 2000000)]
+    assert _query(connect, "select count(*) from bulk_load_touched") == [(0,)]
+    # Из колоночного кэша сброшен только месяц, в который легли строки.
+    assert [path.exists() for path in cached] == [False, True, True]
@@ -0,0 +1,79 @@
+import io
+import time
+import numpy as np
+from detection import EventDetector, detect_events
+
+
+def _key(events):
+    return [(event['type'], int(event['start_index']), int(event['end_index']), int(event['start_time']),
+             int(event['end_time']), round(float(event['volume_change']), 6)) for event in events]
+
+
+def _chunked(timestamps, values, sizes):
+    detector = EventDetector()
+    events = []
+    position = 0
+    for size in sizes:
+        events += detector.feed(timestamps[position:position + size], values[position:position + size])
+        position += size
+    events += detector.feed(timestamps[position:], values[position:])
+    return events + detector.finish()
+
+
+def test_chunked_matches_one_shot():
+    for seed in range(200):
+        rng = np.random.default_rng(seed)
+        n = int(rng.integers(1, 3000))
+        timestamps = np.cumsum(rng.integers(1, 400, n)).astype(np.int64)
+        values = np.cumsum(rng.normal(0, rng.choice([0.5, 2, 6]), n)) + rng.normal(0, 1, n)
+        if seed % 3 == 0:
+            values[rng.integers(0, n, max(n // 50, 1))] = np.nan
+        sizes = rng.integers(0, 200, n // 50 + 1)
+        assert _key(_chunked(timestamps, values, sizes)) == _key(detect_events(timestamps, values)), seed
+
+
+def test_chunked_flat_series_is_linear():
+    # Ровный ряд: открытые старты не закрываются до MAX_EVENT_DURATION.
+    n = 1_000_000
+    rng = np.random.default_rng(0)
+    timestamps = 1672531200 + np.arange(n, dtype=np.int64)
+    values = 300 + rng.normal(0, 0.01, n)
+    values[n // 2:] += 40
+
+    started = time.perf_counter()
+    expected = detect_events(timestamps, values)
+    one_shot = time.perf_counter() - started
+    started = time.perf_counter()
+    events = _chunked(timestamps, values, [50000] * (n // 50000))
+    chunked = time.perf_counter() - started
+
+    assert _key(events) == _key(expected)
+    assert chunked < 3 * one_shot + 0.5
+
+
+def test_state_round_trip_and_bounded_buffer():
+    # Состояние через .npz между кусками, как в event_checkpoints; ровный ряд
+    # на 10 дней держит в буфере не больше суток.
+    n = 10 * 86400 // 30
+    rng = np.random.default_rng(1)
+    timestamps = 1672531200 + np.arange(n, dtype=np.int64) * 30
+    values = 300 + rng.normal(0, 0.5, n)
+    values[n // 3:] += 40
+    values[2 * n // 3:] -= 30
+    events = []
+    state = None
+    longest = 0
+    for position in range(0, n, 1000):
+        detector = EventDetector()
+        if state is not None:
+            with np.load(io.BytesIO(state), allow_pickle=False) as data:
+                detector.restore({key: data[key] for key in data.files})
+        events += detector.feed(timestamps[position:position + 1000], values[position:position + 1000])
+        longest = max(longest, len(detector.state()['values']))
+        buffer = io.BytesIO()
+        np.savez(buffer, **detector.state())
+        state = buffer.getvalue()
+    events += detector.finish()
+    assert _key(events) == _key(detect_events(timestamps, values))
+    assert len(events) == 2
+    assert longest <= 86400 // 30 + 1000
@@ -0,0 +1,89 @@
+import os
+from datetime import datetime
+import psycopg2
+import pytest
+from CONFIG import Config
+from events import ensure_event_tables, reset_checkpoints, update_terminal
+
+# Расчёт идёт в отдельной схеме с копией строк одного терминала, общая база не меняется.
+SCHEMA = f'events_test_{os.getpid()}'
+TERMINAL = '433427026902051'
+
+
+@pytest.fixture
+def conn():
+    try:
+        conn = psycopg2.connect(database = Config.DATABASE, user = Config.USER, password = Config.PASSWORD,
+                                host = Config.HOST, options=f'-c search_path={SCHEMA},public')
+    except psycopg2.Error as e:
+        pytest.skip(f"база недоступна: {e}")
+    cursor = conn.cursor()
+    cursor.execute(f"create schema {SCHEMA}")
+    cursor.execute(f"create table {SCHEMA}.messages as select * from public.messages where terminal_id = %s",
+                   (TERMINAL,))
+    cursor.execute("select count(*) from messages where lls_0 is not null")
+    if not cursor.fetchone()[0]:
+        conn.rollback()
+        pytest.skip(f"нет строк терминала {TERMINAL}")
+    ensure_event_tables(cursor)
+    conn.commit()
+    yield conn
+    conn.rollback()
+    cursor.execute(f"drop schema {SCHEMA} cascade")
+    conn.commit()
+    conn.close()
+
+
+def _events(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("select type, start_time, end_time, volume from events order by start_time")
+        return cursor.fetchall()
+
+
+def test_reset_keeps_events_before_rescan(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("select min(timestamp), max(timestamp) from messages")
+        first, last = cursor.fetchone()
+    middle = (first + last) // 2
+    update_terminal(conn, TERMINAL, since=datetime.fromtimestamp(first))
+    full = _events(conn)
+    assert any(event[2] < middle for event in full)
+
+    # Поздние строки с середины истории: события до неё остаются как были.
+    with conn.cursor() as cursor:
+        reset_checkpoints(cursor, TERMINAL, middle)
+    conn.commit()
+    update_terminal(conn, TERMINAL, since=datetime.fromtimestamp(last))
+    assert [event for event in _events(conn) if event[2] < middle] == \
+        [event for event in full if event[2] < middle]
+
+    # Сброс всех терминалов (новая тарировка) пересчитывает с первого прохода, а не с since.
+    with conn.cursor() as cursor:
+        reset_checkpoints(cursor)
+    conn.commit()
+    update_terminal(conn, TERMINAL, since=datetime.fromtimestamp(last))
+    assert _events(conn) == full
+    with conn.cursor() as cursor:
+        cursor.execute("select origin, rescan from event_checkpoints")
+        assert cursor.fetchone() == (first, None)
+
+
+def test_incremental_scan_matches_single_pass(conn):
+    with conn.cursor() as cursor:
+        cursor.execute("select min(timestamp), max(timestamp) from messages")
+        first, last = cursor.fetchone()
+    since = datetime.fromtimestamp(first)
+    update_terminal(conn, TERMINAL, since=since)
+    single = _events(conn)
+    with conn.cursor() as cursor:
+        cursor.execute("delete from events")
+        cursor.execute("delete from event_checkpoints")
+    conn.commit()
+    for step in range(1, 5):
+        update_terminal(conn, TERMINAL, datetime.fromtimestamp(first + (last - first) * step // 4), since)
+        with conn.cursor() as cursor:
+            # Состояние - архив .npz (zip), а не pickle.
+            cursor.execute("select substr(state, 1, 2) from event_checkpoints")
+            assert bytes(cursor.fetchone()[0]) == b'PK'
+    update_terminal(conn, TERMINAL, since=since)
+    assert _events(conn) == single
@@ -0,0 +1,86 @@
+import gzip
+import os
+import psycopg2
+import pytest
+from CONFIG import Config
+from catalog import ensure_catalog
+import ingest
+
+# Загрузка идёт в отдельную схему с копией таблицы messages, общая база не меняется.
+SCHEMA = f'ingest_test_{os.getpid()}'
+TERMINAL = 'ingest-test'
+HEADER = 'message_id,terminal_id,timestamp,speed\n'
+
+
+@pytest.fixture
+def connect(monkeypatch):
+    real = psycopg2.connect
+
+    def connect(*args, **kwargs):
+        return real(database = Config.DATABASE, user = Config.USER, password = Config.PASSWORD,
+                    host = Config.HOST, options=f'-c search_path={SCHEMA}')
+
+    try:
+        conn = connect()
+    except psycopg2.Error as e:
+        pytest.skip(f"база недоступна: {e}")
+    cursor = conn.cursor()
+    cursor.execute(f"create schema {SCHEMA}")
+    cursor.execute("create table messages (like public.messages including all)")
+    ingest.ensure_ingest_tables(cursor)
+    ensure_catalog(cursor)
+    conn.commit()
+    monkeypatch.setattr(psycopg2, 'connect', connect)
+    yield connect
+    conn.rollback()
+    cursor.execute(f"drop schema {SCHEMA} cascade")
+    conn.commit()
+    conn.close()
+
+
+def _rows(connect):
+    with connect() as conn, conn.cursor() as cursor:
+        cursor.execute("select terminal_id, timestamp, message_id from messages order by 1, 2, 3")
+        rows = cursor.fetchall()
+    conn.close()
+    return rows
+
+
+def test_rows_without_message_id_are_not_duplicated(connect, tmp_path):
+    path = tmp_path / 'messages.csv'
+    path.write_text(HEADER + f',{TERMINAL},100,1\n,{TERMINAL},101,2\n,{TERMINAL},101,2\n'
+                    f'7,{TERMINAL},102,3\n7,{TERMINAL}-2,102,3\n')
+    conn = connect()
+    assert ingest.ingest_file(conn, path)[:2] == (5, 4)
+    # Повторная загрузка того же файла с начала ничего не добавляет.
+    with conn.cursor() as cursor:
+        cursor.execute("delete from ingest_state")
+    conn.commit()
+    assert ingest.ingest_file(conn, path)[:2] == (5, 0)
+    conn.close()
+    assert [row[:2] for row in _rows(connect)] == [(TERMINAL, 100), (TERMINAL, 101), (TERMINAL, 102),
+                                                   (f'{TERMINAL}-2', 102)]
+
+
+def test_truncated_gzip_is_reported(connect, tmp_path, monkeypatch, capsys):
+    # Обрыв в заголовке даёт EOFError из gzip, обрыв внутри данных - ошибку COPY.
+    paths = []
+    for name, rows in (('short', 2), ('long', 20000)):
+        data = gzip.compress((HEADER + ''.join(f'{i},{TERMINAL},{i},1\n' for i in range(rows))).encode())
+        path = tmp_path / f'{name}.csv.gz'
+        path.write_bytes(data[:len(data) // 2])
+        paths.append(path)
+    conn = connect()
+    with pytest.raises(EOFError):
+        ingest.ingest_file(conn, paths[0])
+    conn.rollback()
+    conn.close()
+
+    complete = tmp_path / 'complete.csv'
+    complete.write_text(HEADER + f'1,{TERMINAL},1,1\n')
+    monkeypatch.setattr('sys.argv', ['ingest.py'] + [str(path) for path in paths + [complete]])
+    ingest.main()
+    out = capsys.readouterr().out
+    assert out.count("Ошибка загрузки") == 2
+    assert "complete.csv: прочитано строк 1, добавлено 1" in out
+    assert _rows(connect) == [(TERMINAL, 1, 1)]
@@ -0,0 +1,73 @@
+import re
+from datetime import datetime, timedelta
+import numpy as np
+import psycopg2
+import pytest
+import db
+from pipeline import fuel_series, series_key
+
+# Нужна база из CONFIG.py со справочником terminals, иначе тесты пропускаются.
+WATERMARKS = {'window_watermark', 'minute_watermark', 'hour_watermark', 'calibration_fingerprint', 'calibration',
+              'catalog_available', 'rollups_available', 'pushdown_available', 'events_available', 'event_watermark'}
+
+
+@pytest.fixture(scope='module')
+def terminal():
+    try:
+        if not db.get_database().fetch('catalog_available')[0][0]:
+            pytest.skip("нет справочника terminals")
+        terminal_id = db.fetch_terminal_ids()[0]
+    except (psycopg2.Error, IndexError) as e:
+        pytest.skip(f"база недоступна или пуста: {e}")
+    first, last = db.terminal_bounds(terminal_id)
+    return terminal_id, datetime.fromtimestamp(first), datetime.fromtimestamp(last)
+
+
+@pytest.fixture
+def statements(monkeypatch):
+    names = []
+    execute = db.Database.execute
+
+    def recorded(self, cursor, name, params=()):
+        names.append(name)
+        return execute(self, cursor, name, params)
+
+    monkeypatch.setattr(db.Database, 'execute', recorded)
+    return names
+
+
+@pytest.mark.parametrize('kind', ['fuel', 'speed'])
+@pytest.mark.parametrize('days', [1, 10, 400])
+def test_repeated_key_reads_no_rows(terminal, statements, kind, days):
+    terminal_id, first, last = terminal
+    start = max(first, last - timedelta(days=days))
+    key, present, resolution = series_key(kind, terminal_id, start, last)
+    statements.clear()
+    assert series_key(kind, terminal_id, start, last) == (key, present, resolution)
+    assert present
+    assert set(statements) <= WATERMARKS
+
+
+def test_watermark_uses_index_only(terminal):
+    terminal_id, first, last = terminal
+    with db.get_database().connection() as conn:
+        with conn.cursor() as cursor:
+            sql = re.sub(r'\$(\d)', r'%(p\1)s', db.STATEMENTS['window_watermark'][1])
+            cursor.execute("EXPLAIN " + sql, {'p1': terminal_id, 'p2': int(first.timestamp()),
+                                              'p3': int(last.timestamp())})
+            plan = '\n'.join(row[0] for row in cursor.fetchall())
+    assert 'Aggregate' not in plan
+    assert 'Seq Scan on messages' not in plan
+
+
+def test_aggregated_fuel_takes_stored_events(terminal):
+    # По почасовым агрегатам сливы не находятся: события берутся из таблицы events.
+    terminal_id, first, last = terminal
+    if not db.rollups_available() or not db.events_available():
+        pytest.skip("нет агрегатов или таблицы events")
+    rows, _ = db.fetch_events(None, terminal_id, first, last)
+    times, _, events = fuel_series(terminal_id, first, last, resolution='hour', points=0)
+    assert [(event['type'], int(event['start_time'].timestamp()), event['volume_change']) for event in events] == \
+        [(event_type, start, volume) for event_type, start, _, volume in rows]
+    for event in events:
+        assert abs(times[event['start_index']] - np.datetime64(event['start_time'])) <= np.timedelta64(3600, 's')
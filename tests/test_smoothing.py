@@ -0,0 +1,47 @@
+import numpy as np
+from smoothing import FRAC, MAX_WINDOW, StreamingSmoother, _lowess_window, _window, lowess, savgol, windowed_lowess
+
+
+def _series(n, seed):
+    rng = np.random.default_rng(seed)
+    return np.cumsum(rng.normal(0, 1, n)) + rng.normal(0, 3, n) + 300
+
+
+def test_windowed_matches_statsmodels_with_edges():
+    for n in (3, 20, 57, 400, 401, 1013, 3000):
+        values = _series(n, n)
+        assert np.abs(windowed_lowess(values, max_window=10 ** 9) - lowess(values)).max() < 1e-9, n
+
+
+def test_windowed_matches_statsmodels_with_outliers():
+    # Короткие ряды: в окне из нескольких точек робастные веса обнуляют почти всех соседей.
+    for n in (81, 109, 144, 151, 1000):
+        rng = np.random.default_rng(n)
+        values = _series(n, n)
+        outliers = rng.choice(n, n // 20, replace=False)
+        values[outliers] += rng.choice([-1, 1], len(outliers)) * rng.uniform(50, 200, len(outliers))
+        assert np.abs(windowed_lowess(values, max_window=10 ** 9) - lowess(values)).max() < 1e-9, n
+
+
+def test_streaming_matches_one_shot():
+    # Без робастных итераций масштаб по куску не влияет, и совпадение точное.
+    for n, step in ((100000, 777), (2500, 50), (30, 7)):
+        values = _series(n, n)
+        timestamps = np.arange(n)
+        smoother = StreamingSmoother('windowed', count=n, it=0)
+        parts = [smoother.feed(timestamps[k:k + step], values[k:k + step])[1] for k in range(0, n, step)]
+        parts.append(smoother.finish()[1])
+        expected = windowed_lowess(values, window=_lowess_window(n, FRAC, MAX_WINDOW), it=0)
+        assert np.abs(np.concatenate(parts) - expected).max() < 1e-9, n
+
+
+def test_streaming_savgol_keeps_window_at_edges():
+    # Кусок короче окна в начале ряда и конец ряда ровно на границе куска.
+    for n, step in ((100000, 50000), (100000, 777), (4002, 2001)):
+        values = _series(n, n)
+        timestamps = np.arange(n)
+        smoother = StreamingSmoother('savgol', count=n)
+        parts = [smoother.feed(timestamps[k:k + step], values[k:k + step])[1] for k in range(0, n, step)]
+        parts.append(smoother.finish()[1])
+        expected = savgol(values, window=_window(n, FRAC, MAX_WINDOW))
+        assert np.abs(np.concatenate(parts) - expected).max() < 1e-9, n
@@ -0,0 +1,31 @@
+import os
+import threading
+from workers import JobError, PlotQueue
+
+
+def _run(queue, function, args):
+    finished = threading.Event()
+    outcome = {}
+
+    def done(result):
+        outcome['result'] = result
+        finished.set()
+
+    def failed(error):
+        outcome['error'] = error
+        finished.set()
+
+    queue.submit(1, function, args, done, failed)
+    assert finished.wait(30)
+    return outcome
+
+
+def test_queue_survives_dead_worker():
+    queue = PlotQueue(workers=1, max_queue=4, per_chat=4, timeout=60)
+    try:
+        assert isinstance(_run(queue, os._exit, (1,))['error'], JobError)
+        # Следующие задания уходят в новый пул, а не застревают в очереди.
+        assert _run(queue, abs, (-3,)) == {'result': 3}
+        assert _run(queue, abs, (-4,)) == {'result': 4}
+    finally:
+        queue.shutdown()
@@ -1,26 +1,23 @@
 import telebot
-from datetime import datetime, timedelta
+import time
+from datetime import datetime
 import psycopg2
-import matplotlib.pyplot as plt
-import numpy as np
-from scipy.interpolate import interp1d
-import statsmodels.api as sm
 from telebot_calendar import CallbackData, Calendar, RUSSIAN_LANGUAGE
 import os
 from CONFIG import Config
+from db import calibration_cache_report, fetch_events, pool_report, search_terminals, warm_calibrations
+from detection import DRAIN
+from metrics import Trace, activate, serve_metrics
+from pipeline import series_key
+from plot_cache import PlotCache
+from workers import JobError, PlotQueue, QueueFull, fuel_job, run_traced, speed_job
 from dotenv import load_dotenv
 load_dotenv()
 API = os.getenv("TELEAPI")
 bot = telebot.TeleBot(API)
 calendar = Calendar(language=RUSSIAN_LANGUAGE)
 calendar_callback = CallbackData("calendar", "action", "year", "month", "day")
-
-DB_CONFIG = {
-    "database": Config.DATABASE,
-    "user": Config.USER,
-    "password": Config.PASSWORD,
-    "host": Config.HOST
-}
+plot_cache = PlotCache()
 
 user_data = {}
 user_states = {}
@@ -42,14 +39,6 @@ def ensure_user_data(chat_id):
         user_data[chat_id].setdefault("end_time", user_data[chat_id].get("end_time"))
         user_data[chat_id].setdefault("selecting", user_data[chat_id].get("selecting"))
 
-def connect_to_db():
-    try:
-        conn = psycopg2.connect(**DB_CONFIG)
-        return conn
-    except Exception as e:
-        print(f"Ошибка подключения к базе данных: {e}")
-        return None
-    
 @bot.message_handler(commands=['start'])
 def handle_start(message):
     ensure_user_data(message.chat.id)
@@ -59,30 +48,85 @@ def handle_start(message):
     user_data[message.chat.id] = {"start_time": None, "end_time": None}
     bot.reply_to(message, "Привет! Я бот для анализа показателей топлива в автомобилях.\n"
                           "Используй команды:\n"
-                          "/load_ids - Загрузить доступные ID\n"
+                          "/load_ids [начало ID] - Список доступных ID по страницам\n"
                           "/set_start_date - Выбрать начальную дату\n"
                           "/set_end_date - Выбрать конечную дату\n"
                           "/plot_fuel ID - Построить график остатка топлива\n"
-                          "/plot_speed ID - Построить график скорости")
+                          "/plot_speed ID - Построить график скорости\n"
+                          "/drains ID - Список сливов за выбранный период\n"
+                          "/stats - Состояние пула соединений, очереди и кэшей")
+
+def terminal_page(prefix, offset):
+    # Страница справочника терминалов: текст и кнопки листания. В callback_data
+    # смещение и префикс, чтобы листание не зависело от состояния чата.
+    rows, total = search_terminals(prefix, Config.TERMINAL_PAGE, offset)
+    if not rows:
+        return (f"ID, начинающихся с {prefix}, нет." if prefix else "ID не найдены."), None
+    lines = [f"ID {offset + 1}-{offset + len(rows)} из {total}:"]
+    for terminal_id, first_seen, last_seen, messages in rows:
+        if first_seen is None:
+            lines.append(terminal_id)
+        else:
+            lines.append(f"{terminal_id} — {datetime.fromtimestamp(first_seen):%d.%m.%Y}-"
+                         f"{datetime.fromtimestamp(last_seen):%d.%m.%Y}, сообщений: {messages}")
+    buttons = []
+    if offset > 0:
+        buttons.append(telebot.types.InlineKeyboardButton(
+            "◀", callback_data=f"ids:{max(offset - Config.TERMINAL_PAGE, 0)}:{prefix}"))
+    if offset + len(rows) < total:
+        buttons.append(telebot.types.InlineKeyboardButton(
+            "▶", callback_data=f"ids:{offset + Config.TERMINAL_PAGE}:{prefix}"))
+    markup = telebot.types.InlineKeyboardMarkup()
+    if buttons:
+        markup.row(*buttons)
+    return "\n".join(lines), markup
 
 @bot.message_handler(commands=['load_ids'])
 def load_ids(message):
     ensure_user_data(message.chat.id)
-    conn = connect_to_db()
-    if conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT DISTINCT terminal_id FROM messages")
-        ids = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        ids_list = [id_[0] for id_ in ids]
-        chunk_size = 50
-        for i in range(0, len(ids_list), chunk_size):
-            chunk = ids_list[i:i + chunk_size]
-            bot.send_message(message.chat.id, "\n".join(chunk))
-    else:
+    parts = message.text.split(maxsplit=1)
+    # callback_data в Telegram не длиннее 64 байт, а не символов: префикс режется
+    # по байтам UTF-8, недорезанный символ отбрасывается.
+    prefix = parts[1].strip().encode()[:40].decode(errors='ignore') if len(parts) > 1 else ""
+    try:
+        text, markup = terminal_page(prefix, 0)
+        bot.send_message(message.chat.id, text, reply_markup=markup)
+    except telebot.apihelper.ApiTelegramException as e:
+        print(f"Ошибка отправки списка ID: {e}")
+    except Exception as e:
+        print(f"Ошибка подключения к базе данных: {e}")
         bot.reply_to(message, "Ошибка подключения к базе данных.")
 
+@bot.callback_query_handler(func=lambda call: call.data.startswith("ids:"))
+def callback_ids(call):
+    _, offset, prefix = call.data.split(":", 2)
+    try:
+        text, markup = terminal_page(prefix, int(offset))
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, reply_markup=markup)
+    except telebot.apihelper.ApiTelegramException as e:
+        if "message is not modified" not in str(e):
+            raise
+    except Exception as e:
+        print(f"Ошибка подключения к базе данных: {e}")
+    bot.answer_callback_query(call.id)
+
+@bot.inline_handler(lambda query: True)
+def inline_ids(query):
+    # Inline-режим (@бот 4334...): подсказки ID по префиксу, выбранный ID
+    # отправляется в чат и подходит как ответ на «Введите ID автомобиля».
+    try:
+        rows, _ = search_terminals(query.query, 50)
+    except Exception as e:
+        print(f"Ошибка подключения к базе данных: {e}")
+        return
+    results = []
+    for terminal_id, first_seen, last_seen, messages in rows:
+        description = "" if first_seen is None else \
+            f"{datetime.fromtimestamp(first_seen):%d.%m.%Y}-{datetime.fromtimestamp(last_seen):%d.%m.%Y}, сообщений: {messages}"
+        results.append(telebot.types.InlineQueryResultArticle(
+            terminal_id, terminal_id, telebot.types.InputTextMessageContent(terminal_id), description=description))
+    bot.answer_inline_query(query.id, results, cache_time=60)
+
 @bot.message_handler(commands=['set_start_date', 'set_end_date'])
 def set_date(message):
     global user_data
@@ -145,7 +189,14 @@ def plot_speed_command(message):
     set_user_state(chat_id, "plot_speed_waiting_for_id")  
     bot.send_message(chat_id, "Введите ID автомобиля для построения графика скорости.")
 
-@bot.message_handler(func=lambda message: get_user_state(message.chat.id) in ["plot_fuel_waiting_for_id", "plot_speed_waiting_for_id"])
+@bot.message_handler(commands=['drains'])
+def drains_command(message):
+    ensure_user_data(message.chat.id)
+    chat_id = message.chat.id
+    set_user_state(chat_id, "drains_waiting_for_id")
+    bot.send_message(chat_id, "Введите ID автомобиля для списка сливов.")
+
+@bot.message_handler(func=lambda message: get_user_state(message.chat.id) in ["plot_fuel_waiting_for_id", "plot_speed_waiting_for_id", "drains_waiting_for_id"])
 def process_id_input(message):
     global user_data
     chat_id = message.chat.id
@@ -163,199 +214,155 @@ def process_id_input(message):
         plot_fuel(chat_id, user_id, start_datetime, end_datetime)
     elif state == "plot_speed_waiting_for_id":
         plot_speed(chat_id, user_id, start_datetime, end_datetime)
+    elif state == "drains_waiting_for_id":
+        list_drains(chat_id, user_id, start_datetime, end_datetime)
 
     reset_user_state(chat_id)  
 
+def send_plot(chat_id, image, trace, status='ok'):
+    try:
+        with trace.stage('send_photo', 1):
+            bot.send_photo(chat_id, image)
+    except Exception as e:
+        trace.finish('error', e)
+        raise
+    trace.finish(status)
+
+def enqueue_plot(chat_id, job, args, trace):
+    # Задание выполняется через run_traced: этапы из процесса пула приходят
+    # вместе с результатом и дописываются к трассе запроса.
+    def done(result):
+        (image, _), stages = result
+        trace.extend(stages)
+        send_plot(chat_id, image, trace)
+
+    def failed(e):
+        trace.extend(getattr(e, 'stages', []))
+        trace.finish('error', e)
+        bot.send_message(chat_id, str(e) if isinstance(e, JobError) else f"Ошибка при извлечении данных: {e}")
+
+    try:
+        position = plot_queue.submit(chat_id, run_traced, (job, args, trace.id, time.time()),
+                                     on_done=done, on_error=failed)
+    except QueueFull:
+        trace.finish('rejected')
+        bot.send_message(chat_id, "Бот перегружен, попробуйте позже.")
+        return
+    if position:
+        bot.send_message(chat_id, f"Бот занят, запрос поставлен в очередь: позиция {position}.")
+
+def lookup_plot(trace, kind, selected_id, start_datetime, end_datetime):
+    # Ключ графика и готовый PNG из кэша, с замером обоих этапов.
+    with activate(trace):
+        with trace.stage('series_key'):
+            key, present, resolution = series_key(kind, selected_id, start_datetime, end_datetime)
+        with trace.stage('cache_lookup'):
+            cached = plot_cache.get(key) if present else None
+    return key, present, resolution, cached
+
 def plot_fuel(chat_id, selected_id, start_datetime, end_datetime):
-    conn = connect_to_db()
-    if conn:
-        cursor = conn.cursor()
-        try:
-            cursor.execute("SELECT calibrating_data FROM calibrating WHERE deviceid_port LIKE %s", (f'{selected_id}_%',))
-            results = cursor.fetchall()
-            
-            input_values = []
-            output_values = []
-            for row in results:
-                calibrating_data = row[0]
-                if calibrating_data and isinstance(calibrating_data, list):
-                    for entry in calibrating_data:
-                        input_values.append(entry['input_value'])
-                        output_values.append(entry['output_value'])
-
-            interpolation_function = interp1d(input_values, output_values, kind='linear', fill_value="extrapolate")
-        except Exception as e:
-            bot.send_message(chat_id, f"Ошибка интерполяции: {e}")
-            cursor.close()
-            conn.close()
-            return
-
-        try:
-            cursor.execute("""
-                SELECT timestamp, can_data->>'LLS_0' AS fuel_level
-                FROM messages
-                WHERE terminal_id = %s AND timestamp BETWEEN %s AND %s
-                ORDER BY timestamp
-            """, (selected_id, start_datetime.timestamp(), end_datetime.timestamp()))
-            
-            results = cursor.fetchall()
-            timestamps = []
-            lls = []
-            
-            for row in results:
-                ts = datetime.fromtimestamp(row[0])
-                fuel_level_raw = row[1]
-                if fuel_level_raw is not None:
-                    lls_value = interpolation_function(float(fuel_level_raw))
-                    timestamps.append(ts)
-                    lls.append(lls_value)
-
-            cursor.close()
-            conn.close()
-            
-            if not timestamps or not lls:
-                bot.send_message(chat_id, "Нет данных для выбранного интервала.")
-                return
-
-            frac = 0.05
-            smoothed_values = sm.nonparametric.lowess(lls, np.arange(len(lls)), frac=frac)[:, 1]
-
-            threshold = 10  
-            rapid_change_duration = timedelta(minutes=10)  
-            events = []
-
-            i = 0
-            while i < len(smoothed_values) - 1:
-                start_time = timestamps[i]
-                start_volume = smoothed_values[i]
-                cumulative_change = 0
-                event_type = None
-                j = i + 1
-
-                while j < len(smoothed_values):
-                    change = smoothed_values[j] - smoothed_values[j - 1]
-                    cumulative_change += change
-                    if event_type is None:
-                        if cumulative_change > threshold:
-                            event_type = "Заправка"
-                        elif cumulative_change < -threshold:
-                            duration = timestamps[j] - start_time
-                            if duration <= rapid_change_duration:
-                                event_type = "Слив"
-                            else:
-                                cumulative_change = 0
-                                break  
-                    if (event_type == "Заправка" and change < 0) or (event_type == "Слив" and change > 0):
-                        end_time = timestamps[j - 1]
-                        end_volume = smoothed_values[j - 1]
-                        if abs(end_volume - start_volume) >= threshold:
-                            events.append({
-                                'type': event_type,
-                                'start_time': start_time,
-                                'end_time': end_time,
-                                'volume_change': abs(end_volume - start_volume)
-                            })
-                        i = j - 1  
-                        break
-                    j += 1
-                i += 1
-
-            plt.figure(figsize=(10, 6))
-            plt.plot(timestamps, smoothed_values, label="Остаток топлива в баке")
-
-            for event in events:
-                event_time = event['start_time'] if event['type'] == "Заправка" else event['end_time']
-                event_volume = smoothed_values[timestamps.index(event_time)]
-                annotation_text = f"{event['type']}: {event['volume_change']:.0f} л"
-                plt.annotate(
-                    annotation_text,
-                    xy=(event_time, event_volume),
-                    xytext=(event_time, event_volume + 20),
-                    bbox=dict(boxstyle="round,pad=0.3", edgecolor="green" if event['type'] == "Заправка" else "red", facecolor="white"),
-                    arrowprops=dict(arrowstyle="->", color="green" if event['type'] == "Заправка" else "red"),
-                    fontsize=10
-                )
-
-            plt.xlabel("Время")
-            plt.ylabel("Остаток топлива (л)")
-            plt.title(f"Остаток топлива для ID: {selected_id}")
-            plt.legend()
-            plt.grid()
-            file_name = "fuel_plot.png"
-            plt.savefig(file_name)
-            plt.close()
-            if os.path.exists(file_name):
-                print(f"Файл {file_name} успешно создан.")
-            else:
-                print(f"Ошибка: файл {file_name} не найден!")
-
-            with open(file_name, 'rb') as photo:
-                bot.send_photo(chat_id, photo)
-        except Exception as e:
-            bot.send_message(chat_id, f"Ошибка при извлечении данных: {e}")
-    else:
+    trace = Trace('plot_fuel', terminal_id=selected_id, chat_id=chat_id, start=start_datetime, end=end_datetime)
+    try:
+        key, present, resolution, cached = lookup_plot(trace, 'fuel', selected_id, start_datetime, end_datetime)
+    except psycopg2.Error as e:
+        trace.finish('error', e)
+        print(f"Ошибка подключения к базе данных: {e}")
         bot.send_message(chat_id, "Ошибка подключения к базе данных.")
+        return
+    except ValueError as e:
+        trace.finish('error', e)
+        bot.send_message(chat_id, f"Ошибка интерполяции: {e}")
+        return
+    except Exception as e:
+        trace.finish('error', e)
+        bot.send_message(chat_id, f"Ошибка при извлечении данных: {e}")
+        return
 
+    if cached is not None:
+        send_plot(chat_id, cached[0], trace, 'cached')
+    elif not present:
+        trace.finish('empty')
+        bot.send_message(chat_id, "Нет данных для выбранного интервала.")
+    else:
+        enqueue_plot(chat_id, fuel_job, (selected_id, start_datetime, end_datetime, key, resolution), trace)
 
-def plot_speed(chat_id, selected_id, start_datetime, end_datetime):
-    conn = connect_to_db()
-    if conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT timestamp, speed
-            FROM messages
-            WHERE terminal_id = %s AND timestamp BETWEEN %s AND %s
-            ORDER BY timestamp
-        """, (selected_id, start_datetime.timestamp(), end_datetime.timestamp()))
-        
-        results = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        
-        if not results:
-            bot.send_message(chat_id, "Нет данных для выбранного интервала.")
-            return
-
-        timestamps = []
-        speeds = []
-        
-        for row in results:
-            ts = datetime.fromtimestamp(row[0])
-            speed = row[1]
-            if speed is not None:
-                timestamps.append(ts)
-                speeds.append(float(speed))
-
-        if not timestamps or not speeds:
-            bot.send_message(chat_id, "Нет данных для построения графика.")
-            return
-
-        frac = 0.05
-        smoothed_values = sm.nonparametric.lowess(speeds, np.arange(len(speeds)), frac=frac)[:, 1]
-
-        plt.figure(figsize=(10, 6))
-        plt.plot(timestamps, smoothed_values, label="Скорость")
-        plt.xlabel("Время")
-        plt.ylabel("Скорость (км/ч)")
-        plt.title(f"Скорость для ID: {selected_id}")
-        plt.legend()
-        plt.grid()
-        file_name = "speed_plot.png"
-        plt.savefig(file_name)
-        plt.close()
-        if os.path.exists(file_name):
-            print(f"Файл {file_name} успешно создан.")
-        else:
-            print(f"Ошибка: файл {file_name} не найден!")
 
+def plot_speed(chat_id, selected_id, start_datetime, end_datetime):
+    trace = Trace('plot_speed', terminal_id=selected_id, chat_id=chat_id, start=start_datetime, end=end_datetime)
+    try:
+        key, present, resolution, cached = lookup_plot(trace, 'speed', selected_id, start_datetime, end_datetime)
+    except Exception as e:
+        trace.finish('error', e)
+        print(f"Ошибка подключения к базе данных: {e}")
+        bot.send_message(chat_id, "Ошибка подключения к базе данных.")
+        return
 
-        with open(file_name, 'rb') as photo:
-            bot.send_photo(chat_id, photo)
+    if cached is not None:
+        send_plot(chat_id, cached[0], trace, 'cached')
+    elif not present:
+        trace.finish('empty')
+        bot.send_message(chat_id, "Нет данных для выбранного интервала.")
     else:
+        enqueue_plot(chat_id, speed_job, (selected_id, start_datetime, end_datetime, key, resolution), trace)
+
+def list_drains(chat_id, selected_id, start_datetime, end_datetime):
+    # Ответ из таблицы events (scan.py), без выборки и пересчёта ряда.
+    trace = Trace('drains', terminal_id=selected_id, chat_id=chat_id, start=start_datetime, end=end_datetime)
+    try:
+        with activate(trace), trace.stage('events_query') as timer:
+            rows, watermark = fetch_events(DRAIN, selected_id, start_datetime, end_datetime)
+            timer.rows = len(rows)
+    except psycopg2.errors.UndefinedTable:
+        trace.finish('empty')
+        bot.send_message(chat_id, "События ещё не рассчитаны.")
+        return
+    except Exception as e:
+        trace.finish('error', e)
+        print(f"Ошибка подключения к базе данных: {e}")
         bot.send_message(chat_id, "Ошибка подключения к базе данных.")
+        return
+
+    if watermark is None:
+        trace.finish('empty')
+        bot.send_message(chat_id, f"События для ID {selected_id} ещё не рассчитаны.")
+        return
+    lines = [f"{datetime.fromtimestamp(start):%d.%m.%Y %H:%M} - {datetime.fromtimestamp(end):%d.%m.%Y %H:%M}: "
+             f"{volume:.0f} л" for start, end, volume in rows]
+    if not lines:
+        lines = ["Сливов за выбранный интервал не найдено."]
+    if watermark <= end_datetime.timestamp():
+        lines.append(f"События рассчитаны по {datetime.fromtimestamp(watermark):%d.%m.%Y %H:%M}.")
+    chunk_size = 50
+    with trace.stage('send_message', len(lines)):
+        for i in range(0, len(lines), chunk_size):
+            bot.send_message(chat_id, "\n".join(lines[i:i + chunk_size]))
+    trace.finish()
+
+@bot.message_handler(commands=['stats'])
+def stats_command(message):
+    # Состояние по запросу, а не в консоль после каждого графика. В базу не ходит.
+    reports = [pool_report(), calibration_cache_report(), plot_queue.report(), plot_cache.report()]
+    bot.send_message(message.chat.id, "\n".join(reports))
 
 @bot.message_handler(func=lambda message: True)
 def handle_unknown_messages(message):
     bot.send_message(message.chat.id, "Нажмите /start")
 
-bot.polling(none_stop=True, interval=0) 
\ No newline at end of file
+try:
+    print(f"Тарировки загружены в кэш: {warm_calibrations()} терминалов")
+except Exception as e:
+    print(f"Ошибка при работе с PostgreSQL: {e}")
+
+# Процессы пула создаются после прогрева и получают кэш тарировок при fork,
+# но до сервера метрик - пока у бота нет других потоков.
+plot_queue = PlotQueue()
+
+try:
+    if serve_metrics():
+        print(f"Метрики: http://localhost:{Config.METRICS_PORT}/metrics")
+except OSError as e:
+    print(f"Не удалось открыть порт метрик: {e}")
+
+# Без polling при импорте: bench.py вызывает обработчики с подменённым клиентом.
+if __name__ == '__main__':
+    bot.polling(none_stop=True, interval=0) 
\ No newline at end of file
@@ -1,184 +1,271 @@
+import threading
 import tkinter as tk
+from collections import OrderedDict
 from tkinter import ttk, messagebox
-from datetime import datetime
+from datetime import datetime, timedelta
 import psycopg2
-import matplotlib.pyplot as plt
-import numpy as np
-from scipy.interpolate import interp1d
-import statsmodels.api as sm
-from CONFIG import Config
+import matplotlib.dates as mdates
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
+from matplotlib.figure import Figure
+from db import fetch_terminal_ids, search_terminals
+from metrics import Trace, activate
+from pipeline import Cancelled, fuel_series, series_key, speed_series
 
-def connect_to_db():
+def load_all_ids():
     try:
-        conn = psycopg2.connect(database = Config.DATABASE,
-                                  user = Config.USER,
-                                  password = Config.PASSWORD,
-                                  host = Config.HOST)
-        return conn
+        ids = fetch_terminal_ids()
     except Exception as e:
         messagebox.showerror("Ошибка", f"Не удалось подключиться к базе данных: {e}")
-        return None
+        return
 
-def load_all_ids():
-    conn = connect_to_db()
-    if conn is not None:
-        cursor = conn.cursor()
-        cursor.execute("SELECT DISTINCT terminal_id FROM messages")
-        ids = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        
-        id_combobox['values'] = [id_[0] for id_ in ids]
-        messagebox.showinfo("Загрузка завершена", "Все уникальные ID автомобилей загружены.")
+    id_combobox['values'] = ids
+    messagebox.showinfo("Загрузка завершена", "Все уникальные ID автомобилей загружены.")
 
-def plot_fuel_level():
+search_job = None
+
+def filter_ids(event):
+    # Подсказки по набранному началу ID из справочника терминалов, запрос -
+    # через 300 мс после последней нажатой клавиши.
+    global search_job
+    if event.keysym in ('Up', 'Down', 'Return', 'Escape', 'Tab'):
+        return
+    if search_job is not None:
+        root.after_cancel(search_job)
+    search_job = root.after(300, search_ids)
+
+def search_ids():
+    global search_job
+    search_job = None
+    try:
+        rows, _ = search_terminals(id_combobox.get(), 100)
+    except Exception as e:
+        print(f"Ошибка при работе с PostgreSQL: {e}")
+        return
+    id_combobox['values'] = [row[0] for row in rows]
+
+RESULTS_KEPT = 8
+ZOOM_DELAY = 300
+LABELS = {'fuel': ("Остаток топлива в баке", "Остаток топлива (л)", "Остаток топлива для ID: {}"),
+          'speed': ("Скорость", "Скорость (км/ч)", "Скорость для ID: {}")}
+results = OrderedDict()
+job = None
+# Открытый график: вид, ID, окно целиком, линии обзора и детализации и
+# загруженный для детализации диапазон.
+view = None
+zoom_after = None
+
+def read_inputs():
     start_time = start_entry.get()
     end_time = end_entry.get()
     selected_id = id_combobox.get()
-    
+
     if not selected_id or not start_time or not end_time:
         messagebox.showwarning("Предупреждение", "Пожалуйста, заполните все поля.")
-        return
+        return None
 
     try:
         start_datetime = datetime.strptime(start_time, '%Y-%m-%d %H:%M')
         end_datetime = datetime.strptime(end_time, '%Y-%m-%d %H:%M')
     except ValueError:
         messagebox.showerror("Ошибка", "Неверный формат даты. Используйте YYYY-MM-DD HH:MM.")
-        return
-    
-    conn = connect_to_db()
-    if conn is not None:
-        cursor = conn.cursor()
-
-        try:
-            cursor.execute("SELECT calibrating_data FROM calibrating WHERE deviceid_port LIKE %s", (f'{selected_id}_%',))
-            results = cursor.fetchall()
-            
-            input_values = []
-            output_values = []
-            
-            for row in results:
-                calibrating_data = row[0]
-                if calibrating_data and isinstance(calibrating_data, list):
-                    for entry in calibrating_data:
-                        input_values.append(entry['input_value'])
-                        output_values.append(entry['output_value'])
-
-            interpolation_function = interp1d(input_values, output_values, kind='linear', fill_value="extrapolate")
-        
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Не удалось выполнить интерполяцию: {e}")
-            cursor.close()
-            conn.close()
-            return
+        return None
+    return selected_id, start_datetime, end_datetime
 
-        try:
-            cursor.execute("""
-                SELECT timestamp, can_data->>'LLS_0' AS fuel_level
-                FROM messages
-                WHERE terminal_id = %s AND timestamp BETWEEN %s AND %s
-                ORDER BY timestamp
-            """, (selected_id, start_datetime.timestamp(), end_datetime.timestamp()))
-            
-            results = cursor.fetchall()
-            
-            timestamps = []
-            lls = []
-            
-            for row in results:
-                ts = datetime.fromtimestamp(row[0])
-                fuel_level_raw = row[1]
-                if fuel_level_raw is not None:
-                    lls_value = interpolation_function(float(fuel_level_raw))
-                    timestamps.append(ts)
-                    lls.append(lls_value)
-        
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Ошибка при извлечении данных: {e}")
-            cursor.close()
-            conn.close()
-            return
-        
-        cursor.close()
-        conn.close()
-        
-        if not results or not lls:
-            messagebox.showinfo("Нет данных", "Данные для выбранного интервала не найдены.")
+def run_job(state):
+    # Рабочий поток: выборка и расчёт без обращений к Tk. Результат и ошибка
+    # кладутся в state, главный поток забирает их в poll_job().
+    def progress(done, total):
+        state['done'], state['total'] = done, total
+        if state['cancel'].is_set():
+            raise Cancelled()
+
+    kind = state['kind']
+    trace = state['trace']
+    try:
+        with activate(trace):
+            run_series(state, progress)
+    except Cancelled:
+        state['cancelled'] = True
+        trace.finish('cancelled')
+    except psycopg2.Error as e:
+        state['error'] = f"Не удалось подключиться к базе данных: {e}"
+        trace.finish('error', e)
+    except ValueError as e:
+        state['error'] = f"Не удалось выполнить интерполяцию: {e}" if kind == 'fuel' else \
+            f"Не удалось подключиться к базе данных: {e}"
+        trace.finish('error', e)
+    except Exception as e:
+        state['error'] = f"Ошибка при извлечении данных: {e}" if kind == 'fuel' else \
+            f"Не удалось подключиться к базе данных: {e}"
+        trace.finish('error', e)
+    finally:
+        state['finished'] = True
+
+def run_series(state, progress):
+    kind, selected_id = state['kind'], state['id']
+    start_datetime, end_datetime = state['start'], state['end']
+    # Разрешение выбирается по ширине окна: обзор длинного окна читается из
+    # агрегатов, приближенный участок - из более подробных данных.
+    with state['trace'].stage('series_key'):
+        key, present, resolution = series_key(kind, selected_id, start_datetime, end_datetime)
+    state['key'] = key
+    if key in results:
+        state['result'] = results[key]
+        state['status'] = 'cached'
+    elif not present:
+        state['result'] = ([], [])
+        state['status'] = 'empty'
+    elif kind == 'fuel':
+        timestamps, smoothed_values, _ = fuel_series(selected_id, start_datetime, end_datetime,
+                                                     resolution=resolution, progress=progress)
+        state['result'] = (timestamps, smoothed_values)
+    else:
+        state['result'] = speed_series(selected_id, start_datetime, end_datetime,
+                                       resolution=resolution, progress=progress)
+
+def start_job(kind, selected_id, start_datetime, end_datetime, detail=False):
+    global job
+    if job is not None:
+        if not job['detail']:
             return
+        # Незаконченная детализация устарела: её поток остановится на следующем куске.
+        job['cancel'].set()
+    state = {'kind': kind, 'id': selected_id, 'start': start_datetime, 'end': end_datetime, 'detail': detail,
+             'cancel': threading.Event(), 'done': 0, 'total': 0, 'key': None, 'result': None, 'error': None,
+             'cancelled': False, 'finished': False, 'status': 'ok',
+             'trace': Trace('gui_detail' if detail else f'gui_{kind}', terminal_id=selected_id,
+                            start=start_datetime, end=end_datetime)}
+    job = state
+    if not detail:
+        for button in (load_ids_button, fuel_button, speed_button):
+            button.config(state=tk.DISABLED)
+    cancel_button.config(state=tk.NORMAL)
+    progress_bar['value'] = 0
+    status_label.config(text="Детализация..." if detail else "Загрузка данных...")
+    threading.Thread(target=run_job, args=(state,), daemon=True).start()
+    root.after(100, poll_job, state)
 
-        frac = 0.05 
-        smoothed_values = sm.nonparametric.lowess(lls, np.arange(len(lls)), frac=frac)[:, 1]
+def cancel_job():
+    if job is not None:
+        job['cancel'].set()
+        status_label.config(text="Отмена...")
 
-        plt.figure(figsize=(10, 6))
-        plt.plot(timestamps, smoothed_values, label="Остаток топлива в баке")
-        plt.xlabel("Время")
-        plt.ylabel("Остаток топлива (л)")
-        plt.title(f"Остаток топлива для ID: {selected_id}")
-        plt.legend()
-        plt.grid()
-        plt.show()
+def poll_job(state):
+    global job
+    if state is not job:
+        # Задание заменено новым, его результат уже не нужен.
+        return
+    if state['total']:
+        progress_bar['value'] = min(state['done'] / state['total'], 1) * 100
+    if not state['cancel'].is_set() and state['total']:
+        status_label.config(text=f"Загрузка данных: {state['done']} из {state['total']} строк")
+    if not state['finished']:
+        root.after(100, poll_job, state)
+        return
 
-def plot_speed_time():
-    start_time = start_entry.get()
-    end_time = end_entry.get()
-    selected_id = id_combobox.get()
-    
-    if not selected_id or not start_time or not end_time:
-        messagebox.showwarning("Предупреждение", "Пожалуйста, заполните все поля.")
+    job = None
+    for button in (load_ids_button, fuel_button, speed_button):
+        button.config(state=tk.NORMAL)
+    cancel_button.config(state=tk.DISABLED)
+    progress_bar['value'] = 0
+    status_label.config(text="Отменено" if state['cancelled'] else "")
+    if state['cancelled']:
         return
-    
-    try:
-        start_datetime = datetime.strptime(start_time, '%Y-%m-%d %H:%M')
-        end_datetime = datetime.strptime(end_time, '%Y-%m-%d %H:%M')
-    except ValueError:
-        messagebox.showerror("Ошибка", "Неверный формат даты. Используйте YYYY-MM-DD HH:MM.")
+    if state['error'] is not None:
+        messagebox.showerror("Ошибка", state['error'])
         return
-    
-    conn = connect_to_db()
-    if conn is not None:
-        cursor = conn.cursor()
-
-        cursor.execute("""
-            SELECT timestamp, speed
-            FROM messages
-            WHERE terminal_id = %s AND timestamp BETWEEN %s AND %s
-            ORDER BY timestamp
-        """, (selected_id, start_datetime.timestamp(), end_datetime.timestamp()))
-        
-        results = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        
-        if not results:
-            messagebox.showinfo("Нет данных", "Данные для выбранного интервала не найдены.")
-            return
 
-        timestamps = []
-        speeds = []
-        
-        for row in results:
-            ts = datetime.fromtimestamp(row[0])
-            speed = row[1]
-            if speed is not None:
-                timestamps.append(ts)
-                speeds.append(float(speed))
-
-        if not timestamps or not speeds:
-            messagebox.showinfo("Нет данных", "Нет данных для построения графика.")
-            return
-        
-        frac = 0.05 
-        smoothed_values = sm.nonparametric.lowess(speeds, np.arange(len(speeds)), frac=frac)[:, 1]
-
-        plt.figure(figsize=(10, 6))
-        plt.plot(timestamps, smoothed_values, label="Скорость")
-        plt.xlabel("Время")
-        plt.ylabel("Скорость (км/ч)")
-        plt.title(f"Скорость для ID: {selected_id}")
-        plt.legend()
-        plt.grid()
-        plt.show()
+    timestamps, values = state['result']
+    results[state['key']] = state['result']
+    results.move_to_end(state['key'])
+    while len(results) > RESULTS_KEPT:
+        results.popitem(last=False)
+    trace = state['trace']
+    if state['detail']:
+        with trace.stage('draw', len(timestamps)):
+            show_detail(state, timestamps, values)
+    elif not len(timestamps):
+        trace.finish('empty')
+        messagebox.showinfo("Нет данных", "Данные для выбранного интервала не найдены.")
+        return
+    else:
+        with trace.stage('draw', len(timestamps)):
+            show_series(state, timestamps, values)
+    trace.finish(state['status'])
+
+def show_series(state, timestamps, values):
+    # Обзор всего окна. Детализация при приближении рисуется поверх него отдельной линией.
+    global view
+    label, ylabel, title = LABELS[state['kind']]
+    axes.clear()
+    overview_line, = axes.plot(timestamps, values, label=label, color='tab:blue')
+    detail_line, = axes.plot([], [], color='tab:blue')
+    axes.set_xlabel("Время")
+    axes.set_ylabel(ylabel)
+    axes.set_title(title.format(state['id']))
+    axes.legend()
+    axes.grid()
+    view = {'kind': state['kind'], 'id': state['id'], 'start': state['start'], 'end': state['end'],
+            'overview': overview_line, 'detail': detail_line, 'loaded': None}
+    # clear() сбрасывает подписки осей, поэтому подписка - после каждого нового графика.
+    axes.callbacks.connect('xlim_changed', schedule_detail)
+    toolbar.update()
+    # Отрисовка сразу, а не в простое цикла Tk: её время входит в этап draw.
+    canvas.draw()
+
+def show_detail(state, timestamps, values):
+    if view is None or (view['kind'], view['id'], view['loaded']) != (state['kind'], state['id'],
+                                                                        (state['start'], state['end'])):
+        return
+    view['detail'].set_data(timestamps, values)
+    view['overview'].set_alpha(0.3 if len(timestamps) else 1)
+    canvas.draw()
+
+def visible_range():
+    # Видимый участок оси X в локальном времени окна, с точностью до минуты.
+    left, right = axes.get_xlim()
+    start_datetime = mdates.num2date(left).replace(tzinfo=None, second=0, microsecond=0)
+    end_datetime = mdates.num2date(right).replace(tzinfo=None, second=0, microsecond=0) + timedelta(minutes=1)
+    return max(start_datetime, view['start']), min(end_datetime, view['end'])
+
+def schedule_detail(_):
+    # При масштабировании и прокрутке пределы меняются на каждое движение мыши,
+    # загрузка начинается, когда они не менялись ZOOM_DELAY мс.
+    global zoom_after
+    if zoom_after is not None:
+        root.after_cancel(zoom_after)
+    zoom_after = root.after(ZOOM_DELAY, load_detail)
+
+def load_detail():
+    global zoom_after
+    zoom_after = None
+    if view is None or (job is not None and not job['detail']):
+        return
+    start_datetime, end_datetime = visible_range()
+    if start_datetime >= end_datetime:
+        return
+    if start_datetime <= view['start'] and end_datetime >= view['end']:
+        # Видно всё окно - достаточно обзора.
+        view['loaded'] = None
+        view['detail'].set_data([], [])
+        view['overview'].set_alpha(1)
+        canvas.draw_idle()
+        return
+    if view['loaded'] == (start_datetime, end_datetime):
+        return
+    view['loaded'] = (start_datetime, end_datetime)
+    start_job(view['kind'], view['id'], start_datetime, end_datetime, detail=True)
+
+def start_plot(kind):
+    inputs = read_inputs()
+    if inputs is not None:
+        start_job(kind, *inputs)
+
+def plot_fuel_level():
+    start_plot('fuel')
+
+def plot_speed_time():
+    start_plot('speed')
 
 root = tk.Tk()
 root.title("Анализ данных автомобиля")
@@ -194,6 +281,7 @@ end_entry.insert(0, "2023-03-05 12:00")
 tk.Label(root, text="Выберите id:").grid(row=2, column=0, columnspan=2)
 id_combobox = ttk.Combobox(root, width=25)
 id_combobox.grid(row=3, column=0, columnspan=2)
+id_combobox.bind('<KeyRelease>', filter_ids)
 
 load_ids_button = tk.Button(root, text="Все id автомобилей", command=load_all_ids)
 load_ids_button.grid(row=4, column=0)
@@ -204,4 +292,19 @@ fuel_button.grid(row=4, column=1)
 speed_button = tk.Button(root, text="Скорость/время", command=plot_speed_time)
 speed_button.grid(row=5, column=0, columnspan=2)
 
+progress_bar = ttk.Progressbar(root, length=200, mode='determinate')
+progress_bar.grid(row=6, column=0)
+cancel_button = tk.Button(root, text="Отмена", command=cancel_job, state=tk.DISABLED)
+cancel_button.grid(row=6, column=1)
+status_label = tk.Label(root, text="")
+status_label.grid(row=7, column=0, columnspan=2)
+
+figure = Figure(figsize=(10, 6))
+axes = figure.add_subplot()
+canvas = FigureCanvasTkAgg(figure, master=root)
+canvas.get_tk_widget().grid(row=8, column=0, columnspan=2)
+toolbar_frame = tk.Frame(root)
+toolbar_frame.grid(row=9, column=0, columnspan=2)
+toolbar = NavigationToolbar2Tk(canvas, toolbar_frame)
+
 root.mainloop()
@@ -0,0 +1,213 @@
+import multiprocessing
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import psycopg2
+from CONFIG import Config
+from db import forget_connections
+from metrics import Trace, activate, profiled, stage
+from pipeline import events_note, fuel_series, speed_series
+from plot_cache import PlotCache
+from rendering import render_fuel, render_speed
+
+
+class JobError(Exception):
+    # Ошибка задания с готовым текстом для пользователя.
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+def _worker_init():
+    forget_connections()
+
+
+def _store(key, image, events=()):
+    try:
+        with stage('cache_store'):
+            PlotCache().put(key, image, events)
+    except OSError as e:
+        print(f"Ошибка записи в кэш графиков: {e}")
+
+
+def run_traced(function, args, trace_id, submitted):
+    # Выполняется в процессе пула вместо самого задания: этапы задания пишутся
+    # в свою трассу и возвращаются вместе с результатом (при ошибке - в
+    # атрибуте stages исключения), процесс бота добавляет их к трассе запроса.
+    trace = Trace('job')
+    trace.add('queue_wait', max(time.time() - submitted, 0.0))
+    with activate(trace), profiled(trace_id):
+        try:
+            result = function(*args)
+        except Exception as e:
+            e.stages = trace.stages
+            raise
+    return result, trace.stages
+
+
+def fuel_job(selected_id, start_datetime, end_datetime, key, resolution=None):
+    # Выполняется в процессе пула: выборка, тарировка, сглаживание, события и
+    # отрисовка. Возвращает (PNG, события) и кладёт результат в кэш графиков.
+    try:
+        timestamps, smoothed_values, events = fuel_series(selected_id, start_datetime, end_datetime,
+                                                          resolution=resolution)
+        note = events_note(selected_id, end_datetime, resolution)
+    except psycopg2.Error as e:
+        print(f"Ошибка подключения к базе данных: {e}")
+        raise JobError("Ошибка подключения к базе данных.")
+    except ValueError as e:
+        raise JobError(f"Ошибка интерполяции: {e}")
+    except Exception as e:
+        raise JobError(f"Ошибка при извлечении данных: {e}")
+
+    if not len(timestamps):
+        raise JobError("Нет данных для выбранного интервала.")
+
+    with stage('render', len(timestamps)):
+        image = render_fuel(selected_id, timestamps, smoothed_values, events, note)
+    _store(key, image, events)
+    return image, events
+
+
+def speed_job(selected_id, start_datetime, end_datetime, key, resolution=None):
+    try:
+        timestamps, smoothed_values = speed_series(selected_id, start_datetime, end_datetime,
+                                                   resolution=resolution)
+    except psycopg2.Error as e:
+        print(f"Ошибка подключения к базе данных: {e}")
+        raise JobError("Ошибка подключения к базе данных.")
+    except Exception as e:
+        raise JobError(f"Ошибка при извлечении данных: {e}")
+
+    if not len(timestamps):
+        raise JobError("Нет данных для выбранного интервала.")
+
+    with stage('render', len(timestamps)):
+        image = render_speed(selected_id, timestamps, smoothed_values)
+    _store(key, image)
+    return image, []
+
+
+class PlotQueue:
+    # Очередь тяжёлых заданий бота поверх пула процессов (numpy/matplotlib не
+    # упираются в GIL процесса бота). Задания одного чата выполняются строго
+    # по очереди, разные чаты - параллельно, не больше workers одновременно.
+    # Ожидающих заданий не больше max_queue всего и per_chat на чат: сверх
+    # этого submit() бросает QueueFull. Задание, прождавшее дольше timeout
+    # секунд, не запускается, а завершается ошибкой.
+    # on_done/on_error вызываются в отдельном потоке доставки. Если процесс
+    # пула умер (нехватка памяти, падение в numpy/matplotlib), его задания
+    # завершаются ошибкой, а пул пересоздаётся для следующих.
+    def __init__(self, workers=Config.WORKERS, max_queue=Config.QUEUE_SIZE,
+                 per_chat=Config.QUEUE_PER_CHAT, timeout=Config.QUEUE_TIMEOUT):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.per_chat = per_chat
+        self.timeout = timeout
+        # fork, а не spawn: spawn заново импортировал бы tgbotfinal.py, а он
+        # при импорте создаёт бота, прогревает тарировки и создаёт эту очередь.
+        # При fork процессы получают уже прогретый кэш тарировок. Соединения
+        # родителя в дочерних процессах сбрасывает forget_connections().
+        self._executor = self._start_executor()
+        self._delivery = ThreadPoolExecutor(2)
+        self._lock = threading.Lock()
+        self._waiting = deque()
+        self._busy = set()
+        self._running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.expired = 0
+        self._closed = False
+
+    def _start_executor(self):
+        executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('fork'),
+                                       initializer=_worker_init)
+        # Процессы запускаются сразу, пока у родителя нет других потоков и открытых соединений.
+        executor.submit(int).result()
+        return executor
+
+    def _replace_executor(self, broken):
+        # Вызывается под блокировкой. Пул заменяется один раз, сколько бы заданий
+        # ни увидели его сломанным.
+        if self._executor is broken and not self._closed:
+            broken.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._start_executor()
+
+    def submit(self, chat_id, function, args, on_done, on_error):
+        # Возвращает 0, если задание сразу ушло в работу, иначе его место в очереди.
+        with self._lock:
+            if len(self._waiting) >= self.max_queue or \
+                    sum(1 for job in self._waiting if job['chat_id'] == chat_id) >= self.per_chat:
+                self.rejected += 1
+                raise QueueFull()
+            job = {'chat_id': chat_id, 'function': function, 'args': args,
+                   'on_done': on_done, 'on_error': on_error, 'queued': time.monotonic()}
+            self._waiting.append(job)
+        self._dispatch()
+        with self._lock:
+            for position, waiting in enumerate(self._waiting, 1):
+                if waiting is job:
+                    return position
+        return 0
+
+    def _dispatch(self):
+        expired = []
+        started = []
+        with self._lock:
+            now = time.monotonic()
+            for job in list(self._waiting):
+                if now - job['queued'] > self.timeout:
+                    self._waiting.remove(job)
+                    expired.append(job)
+            while self._running < self.workers and not self._closed:
+                job = next((job for job in self._waiting if job['chat_id'] not in self._busy), None)
+                if job is None:
+                    break
+                try:
+                    future = self._executor.submit(job['function'], *job['args'])
+                except BrokenProcessPool:
+                    self._replace_executor(self._executor)
+                    continue
+                job['executor'] = self._executor
+                self._waiting.remove(job)
+                self._busy.add(job['chat_id'])
+                self._running += 1
+                started.append((job, future))
+            self.expired += len(expired)
+        # Колбэк уже завершившегося задания вызывается сразу, поэтому вешается вне блокировки.
+        for job, future in started:
+            future.add_done_callback(lambda future, job=job: self._finished(job, future))
+        for job in expired:
+            self._delivery.submit(job['on_error'], JobError("Запрос слишком долго ждал в очереди, повторите позже."))
+
+    def _finished(self, job, future):
+        error = future.exception()
+        with self._lock:
+            self._running -= 1
+            self._busy.discard(job['chat_id'])
+            self.completed += 1
+            if isinstance(error, BrokenProcessPool):
+                self._replace_executor(job['executor'])
+        if isinstance(error, BrokenProcessPool):
+            error = JobError("Процесс построения графика аварийно завершился, повторите запрос.")
+        if error is None:
+            self._delivery.submit(job['on_done'], future.result())
+        else:
+            self._delivery.submit(job['on_error'], error)
+        self._dispatch()
+
+    def report(self):
+        with self._lock:
+            return (f"Очередь графиков: выполняется {self._running}/{self.workers}, ждут {len(self._waiting)}/"
+                    f"{self.max_queue}, выполнено {self.completed}, отклонено {self.rejected}, "
+                    f"просрочено {self.expired}")
+
+    def shutdown(self):
+        with self._lock:
+            self._closed = True
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._delivery.shutdown(wait=True)